@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Append-only checkpoints for single level refinement, so that preempted runs can be resumed
+# The file is a sequence of pickled records: a header with the run parameters and the initial state, then one small record per iteration holding only what changed in it
+
+import logging
+import os
+import pickle
+import numpy as np
+
+
+class RefinementCheckpoint:
+    """
+    Checkpoint file of a refinement run
+    The header is written atomically (temporary file + rename); iteration records are appended and flushed, and a record torn by a kill in the middle of a write is discarded (and truncated away) on load
+    """
+
+    def __init__(self, path, sync=False):
+        """
+        :param sync: fsync after every record (survives node crashes, not only killed processes, at the cost of a disk flush per iteration)
+        """
+        self.path = path
+        self.sync = sync
+        self.f = None
+
+    def _write(self, f, record):
+        f.write(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+        f.flush()
+        if self.sync:
+            os.fsync(f.fileno())
+
+    def start(self, header):
+        """
+        Starts a new checkpoint file (replacing an existing one) with the given header
+        """
+        self.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            self._write(f, header)
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.f = open(self.path, 'ab')
+
+    def append(self, record):
+        self._write(self.f, record)
+
+    def load(self):
+        """
+        Reads the checkpoint and reopens it for appending after the last complete record
+        :return: header, list of iteration records
+        :rtype: tuple
+        """
+        self.close()
+        records = []
+        with open(self.path, 'rb') as f:
+            header = pickle.load(f)
+            good = f.tell()
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, TypeError,
+                        AttributeError, IndexError) as e:
+                    logging.warning(
+                        "Discarding torn record at the end of checkpoint {}: {}"
+                        .format(self.path, e))
+                    break
+                good = f.tell()
+        with open(self.path, 'r+b') as f:
+            f.truncate(good)
+        self.f = open(self.path, 'ab')
+        return header, records
+
+    def restore(self, params):
+        """
+        Replays the checkpoint
+        :param params: parameters of the current run, have to match the ones the checkpoint was written with
+        :return: refinement state (keys spins, curr_modularity, best_solution, best_modularity, visited, it, it_stuck, all_modularities, telemetry, np_random_state, random_state, ordering, finished), and initial_spins and changes (the vertices flipped by every iteration) to replay it from
+        :rtype: dict
+        """
+        header, records = self.load()
+        if header['params'] != params:
+            raise ValueError(
+                "Checkpoint {} was written by a run with different parameters: {} (current: {})"
+                .format(self.path, header['params'], params))
+        spins = np.array(header['spins'], dtype=np.int8)
+        res = {
+            'spins': spins,
+            'initial_spins': spins.copy(),
+            'changes': [],
+            'curr_modularity': header['modularity'],
+            'best_solution': spins.copy(),
+            'best_modularity': header['modularity'],
+            'visited': set(),
+            'it': 0,
+            'it_stuck': 0,
+            'all_modularities': [],
+            'telemetry': [],
+            'np_random_state': header['np_random_state'],
+            'random_state': header['random_state'],
+            'ordering': header['ordering'],
+            'finished': False
+        }
+        for record in records:
+            if record.get('finished'):
+                res['finished'] = True
+                res['it'] = record['it']
+                continue
+            spins[record['changed']] = -spins[record['changed']]
+            res['changes'].append(record['changed'])
+            res['visited'].update(record['visited'])
+            if record['best_updated']:
+                res['best_solution'] = spins.copy()
+            for key in [
+                    'curr_modularity', 'best_modularity', 'it', 'it_stuck',
+                    'np_random_state', 'random_state'
+            ]:
+                res[key] = record[key]
+            res['all_modularities'].append(record['all_modularities'])
+            res['telemetry'].append(record['telemetry'])
+        logging.info(
+            "Resuming from checkpoint {} at iteration {} ({} records)".format(
+                self.path, res['it'], len(records)))
+        return res
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+# Coarsening hierarchy for multilevel modularity optimization
+# Every level contracts a matching of the previous one. Vertices are matched along the edge maximizing the modularity of merging them, A_uv - k_u k_v / 2m (heavy-edge matching corrected for the degrees), and a pair is matched if both endpoints prefer each other (handshake), repeated for a few rounds.
+# Levels are built algebraically: the coarse adjacency is A_c = P^T A P (contracted edges become self-loops) and the coarse degrees are k_c = P^T k with the same 2m, so a coarse partition has exactly the modularity of its projection. Each level costs a sparse product, O(m), and no NetworkX graph is built.
+# The hierarchy does not depend on the random seed of the refinement and can be cached on disk (see load_or_coarsen), so repeated runs on the same graph skip coarsening
+
+import hashlib
+import logging
+import os
+import numpy as np
+import scipy.sparse as sp
+from qcommunity.modularity.modularity_operator import ModularityOperator
+
+
+def match(A, degrees=None, rounds=4, seed=None):
+    """
+    Modularity-aware heavy-edge matching
+    :param A: sparse symmetric adjacency matrix (self-loops are ignored for matching)
+    :param degrees: degree vector (default: row sums of A)
+    :param rounds: number of handshake rounds
+    :param seed: random seed used to break ties
+    :return: partner of every vertex (itself if unmatched)
+    :rtype: numpy.ndarray
+    """
+    A = sp.csr_matrix(A)
+    n_nodes = A.shape[0]
+    k = np.asarray(A.sum(axis=1)).ravel() if degrees is None else np.asarray(
+        degrees, dtype=np.float64)
+    two_m = k.sum()
+    rows = np.repeat(np.arange(n_nodes), np.diff(A.indptr))
+    cols = A.indices
+    keep = rows != cols
+    rows, cols = rows[keep], cols[keep]
+    scores = A.data[keep] - k[rows] * k[cols] / two_m
+    # random tie breaking, small enough not to change the order of different scores
+    jitter = np.random.RandomState(seed).rand(len(scores)) * 1e-12 * max(
+        1.0,
+        np.abs(scores).max() if len(scores) else 1.0)
+    scores = scores + jitter
+    partner = np.arange(n_nodes)
+    matched = np.zeros(n_nodes, dtype=bool)
+    for _ in range(rounds):
+        free = ~matched[rows] & ~matched[cols]
+        if not free.any():
+            break
+        r, c, s = rows[free], cols[free], scores[free]
+        # best free neighbour of every vertex: sort by row, then by decreasing score
+        order = np.lexsort((-s, r))
+        r, c = r[order], c[order]
+        first = np.ones(len(r), dtype=bool)
+        first[1:] = r[1:] != r[:-1]
+        best = np.full(n_nodes, -1)
+        best[r[first]] = c[first]
+        candidates = np.nonzero(best >= 0)[0]
+        mutual = candidates[best[best[candidates]] == candidates]
+        if len(mutual) == 0:
+            break
+        partner[mutual] = best[mutual]
+        matched[mutual] = True
+    return partner
+
+
+def aggregation(partner):
+    """
+    Aggregation operator of a matching
+    :return: coarse vertex of every fine vertex, sparse n x n_coarse 0/1 matrix P
+    :rtype: tuple
+    """
+    n_nodes = len(partner)
+    leader = np.minimum(np.arange(n_nodes), partner)
+    _, aggregate = np.unique(leader, return_inverse=True)
+    P = sp.csr_matrix((np.ones(n_nodes), (np.arange(n_nodes), aggregate)),
+                      shape=(n_nodes, aggregate.max() + 1))
+    return aggregate, P
+
+
+def coarsen(G, coarsest_size=30, min_reduction=0.05, max_levels=50, seed=0):
+    """
+    Builds the coarsening hierarchy of G
+    Coarsening stops once a level has at most coarsest_size vertices, or when a matching shrinks the graph by less than min_reduction
+    :param G: NetworkX graph with nodes 0..n-1 (edge attribute weight is used if present) or its ModularityOperator
+    :return: list of (B, aggregate) from the finest to the coarsest level, where B is the ModularityOperator of the level and aggregate maps its vertices to the ones of the next level (None on the coarsest level)
+    :rtype: list
+    """
+    if isinstance(G, ModularityOperator):
+        B = G
+    else:
+        B = ModularityOperator.from_graph(G,
+                                          nodelist=sorted(G.nodes()),
+                                          weight='weight')
+    hierarchy = []
+    for level in range(max_levels):
+        n_nodes = B.shape[0]
+        if n_nodes <= coarsest_size:
+            break
+        partner = match(B.A,
+                        degrees=B.k,
+                        seed=None if seed is None else seed + level)
+        aggregate, P = aggregation(partner)
+        if P.shape[1] > (1 - min_reduction) * n_nodes:
+            logging.info("Coarsening stalled at level {} ({} vertices)".format(
+                level, n_nodes))
+            break
+        hierarchy.append((B, aggregate))
+        B = ModularityOperator(P.T.dot(B.A).dot(P),
+                               degrees=P.T.dot(B.k),
+                               two_m=B.two_m)
+        logging.info("Level {}: {} vertices, {} nonzeros".format(
+            level + 1, B.shape[0], B.A.nnz))
+    hierarchy.append((B, None))
+    return hierarchy
+
+
+def restrict_ordering(ordering, aggregate):
+    """
+    Ordering of the next coarser level induced by an ordering of a level: coarse vertices are sorted by the mean position of their fine vertices
+    Lets the spectral ordering of the finest level be reused on the coarse ones
+    :rtype: numpy.ndarray
+    """
+    position = np.empty(len(ordering))
+    position[ordering] = np.arange(len(ordering))
+    mean_position = np.bincount(aggregate,
+                                weights=position) / np.bincount(aggregate)
+    return np.argsort(mean_position, kind='stable')
+
+
+def hierarchy_key(B, **params):
+    """
+    Hash of the adjacency and degrees of B and the coarsening parameters, used to name cached hierarchies
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    for arr in (B.A.indptr, B.A.indices, B.A.data, B.k):
+        h.update(np.ascontiguousarray(arr).tobytes())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+
+def save_hierarchy(path, hierarchy, ordering=None):
+    """
+    Writes the hierarchy (and the spectral ordering of the finest level, if given) to path atomically
+    """
+    arrays = {
+        'n_levels': np.array(len(hierarchy)),
+        'two_m': np.array(hierarchy[0][0].two_m)
+    }
+    for level, (B, aggregate) in enumerate(hierarchy):
+        arrays['indptr_{}'.format(level)] = B.A.indptr
+        arrays['indices_{}'.format(level)] = B.A.indices
+        arrays['data_{}'.format(level)] = B.A.data
+        arrays['degrees_{}'.format(level)] = B.k
+        if aggregate is not None:
+            arrays['aggregate_{}'.format(level)] = aggregate
+    if ordering is not None:
+        arrays['ordering'] = np.asarray(ordering)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_hierarchy(path):
+    """
+    Reads a hierarchy written by save_hierarchy
+    :return: hierarchy, spectral ordering of the finest level (None if it was not saved)
+    :rtype: tuple
+    """
+    with np.load(path) as f:
+        two_m = float(f['two_m'])
+        hierarchy = []
+        for level in range(int(f['n_levels'])):
+            degrees = f['degrees_{}'.format(level)]
+            A = sp.csr_matrix(
+                (f['data_{}'.format(level)], f['indices_{}'.format(level)],
+                 f['indptr_{}'.format(level)]),
+                shape=(len(degrees), len(degrees)))
+            aggregate_key = 'aggregate_{}'.format(level)
+            hierarchy.append(
+                (ModularityOperator(A, degrees=degrees, two_m=two_m),
+                 f[aggregate_key] if aggregate_key in f else None))
+        ordering = f['ordering'] if 'ordering' in f else None
+    return hierarchy, ordering
+
+
+def load_or_coarsen(G, cache_dir=None, **params):
+    """
+    Coarsening hierarchy of G, read from cache_dir if it was computed before with the same parameters
+    :param cache_dir: directory of cached hierarchies, created if missing (no caching if None)
+    :param params: passed to coarsen
+    :return: hierarchy (see coarsen), spectral ordering of the finest level if cached (else None), path of the cache file (None if cache_dir is None)
+    :rtype: tuple
+    """
+    B = ModularityOperator.from_graph(G,
+                                      nodelist=sorted(G.nodes()),
+                                      weight='weight')
+    if cache_dir is None:
+        return coarsen(B, **params), None, None
+    path = os.path.join(cache_dir, '{}.npz'.format(hierarchy_key(B, **params)))
+    if os.path.isfile(path):
+        logging.info("Loading coarsening hierarchy from {}".format(path))
+        hierarchy, ordering = load_hierarchy(path)
+        return hierarchy, ordering, path
+    hierarchy = coarsen(B, **params)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    save_hierarchy(path, hierarchy)
+    logging.info("Saved coarsening hierarchy to {}".format(path))
+    return hierarchy, None, path
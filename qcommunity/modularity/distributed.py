@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+
+# Domain-decomposed single level refinement across MPI ranks
+# The vertices are split into contiguous chunks of the spectral ordering, one region per rank. Only rank 0 reads the graph: it computes the ordering and the initial guess, and sends every rank the adjacency rows of its region (columns renumbered locally) and the indices it exchanges with its neighbours. The other ranks never hold the whole graph, only their region and its halo (the vertices of other regions adjacent to it).
+# Ranks refine subproblems inside their regions concurrently. Every sync_every iterations they send their boundary spins to the neighbouring ranks, update the fields of their boundary vertices and reduce k^T s and the global modularity.
+# Moves made on different ranks in the same round interact through the cut edges and the rank-one part of B, so a round that does not increase the global modularity is rolled back. After such a round the ranks switch between two splits whose boundaries are half a region apart. The regions of both splits are set up once, and the best partition is handed over between them point to point
+#
+# Example: mpirun -np 4 python -m mpi4py single_level_refinement.py --graph out.graphname --method brute --mpi --distributed
+
+import logging
+import os
+import time
+import numpy as np
+import scipy.sparse as sp
+import qcommunity.modularity.graphs as gm
+import qcommunity.modularity.single_level_refinement as slr
+import qcommunity.modularity.telemetry as tm
+from qcommunity.modularity.modularity_operator import ModularityOperator, SparseGraph
+from qcommunity.modularity.solver_pool import SerialSolver
+
+SETUP_TAG = 16
+HALO_TAG = 17
+HANDOFF_TAG = 18
+
+
+class Region:
+    """
+    Part of the partition owned by one rank in one split
+    Vertices are numbered locally: the region first (in the order of the spectral ordering), then its halo (by increasing global id). Only the adjacency rows of the region are stored
+    """
+
+    def __init__(self, comm, region):
+        """
+        :param region: local data of the region, see _regions
+        """
+        self.comm = comm
+        self.vertices = region['vertices']
+        self.n_owned = region['n_owned']
+        self.A = region['A']
+        # columns of A are the rows of the region's neighbours (A is symmetric), used to update the fields
+        self.A_columns = self.A.tocsc()
+        self.k = np.asarray(self.A.sum(axis=1)).ravel()
+        self.two_m = comm.allreduce(float(self.k.sum()))
+        self.diagonal = self.A.diagonal() - self.k**2 / self.two_m
+        self.spins = np.array(region['spins'], dtype=np.int8)
+        self.send = region['send']
+        self.recv = region['recv']
+        self.handoff = region['handoff']
+        # the region on its own, in local numbering, for the subset selection
+        self.graph = SparseGraph(
+            ModularityOperator(self.A[:, :self.n_owned],
+                               degrees=self.k,
+                               two_m=self.two_m))
+        logging.info(
+            "Rank {}: {} vertices, {} halo vertices, neighbours {}".format(
+                comm.Get_rank(), self.n_owned,
+                len(self.vertices) - self.n_owned,
+                sorted(set(self.recv) | set(self.send))))
+        self.refresh()
+
+    def refresh(self):
+        """
+        Recomputes the fields and k^T s from the spins (collective)
+        """
+        self.adj_field = self.A.dot(self.spins.astype(np.float64))
+        self.k_dot_s = self.comm.allreduce(
+            float(self.k.dot(self.spins[:self.n_owned])))
+
+    def gains(self):
+        """
+        Gains of flipping every vertex of the region, 4 (B_vv - s_v (B s)_v)
+        :rtype: numpy.ndarray
+        """
+        s = self.spins[:self.n_owned]
+        return 4 * (self.diagonal - s *
+                    (self.adj_field - self.k * self.k_dot_s / self.two_m))
+
+    def subproblem(self, subset):
+        """
+        B_sub and C (twice the field of all the other spins) of the subproblem on subset (local indices of vertices of the region)
+        :rtype: tuple
+        """
+        s = self.spins[subset].astype(np.float64)
+        k = self.k[subset]
+        A_sub = self.A[subset][:, subset].toarray()
+        B_sub = A_sub - np.outer(k, k) / self.two_m
+        C = 2 * (self.adj_field[subset] - A_sub.dot(s) - k *
+                 (self.k_dot_s - k.dot(s)) / self.two_m)
+        return B_sub, C
+
+    def flip(self, vertices):
+        """
+        Flips vertices (local indices) of the region; k^T s only accounts for the flips of this rank until the next exchange()
+        """
+        delta = -2.0 * self.spins[vertices]
+        self.adj_field += self.A_columns[:, vertices].dot(delta)
+        self.k_dot_s += self.k[vertices].dot(delta)
+        self.spins[vertices] = -self.spins[vertices]
+
+    def _receive_halo(self):
+        """
+        Sends the boundary spins to the neighbouring ranks and receives the spins of the halo
+        :return: local indices of the halo vertices whose spins changed (not flipped yet)
+        :rtype: numpy.ndarray
+        """
+        # imported here so that the decomposition can be used (and tested) without MPI
+        from mpi4py import MPI
+        requests = []
+        send_buffers = []
+        for r, vertices in self.send.items():
+            send_buffers.append(np.ascontiguousarray(self.spins[vertices]))
+            requests.append(
+                self.comm.Isend(send_buffers[-1], dest=r, tag=HALO_TAG))
+        recv_buffers = {}
+        for r, vertices in self.recv.items():
+            recv_buffers[r] = np.empty(len(vertices), dtype=np.int8)
+            requests.append(
+                self.comm.Irecv(recv_buffers[r], source=r, tag=HALO_TAG))
+        MPI.Request.Waitall(requests)
+        changed = [
+            vertices[recv_buffers[r] != self.spins[vertices]]
+            for r, vertices in self.recv.items()
+        ]
+        return np.concatenate(changed) if changed else np.empty(0,
+                                                                dtype=np.intp)
+
+    def exchange(self):
+        """
+        Sends the boundary spins to the neighbouring ranks, updates the halo and the fields it contributes to, and reduces k^T s (collective)
+        """
+        changed = self._receive_halo()
+        if len(changed):
+            self.adj_field += self.A_columns[:, changed].dot(
+                -2.0 * self.spins[changed])
+            self.spins[changed] = -self.spins[changed]
+        self.k_dot_s = self.comm.allreduce(
+            float(self.k.dot(self.spins[:self.n_owned])))
+
+    def hand_over(self, target, spins):
+        """
+        Sets the partition of target, the region of this rank in the other split, to spins (collective)
+        :param spins: spins of the vertices of this region, the parts owned by other ranks in the other split are sent to them
+        """
+        from mpi4py import MPI
+        rank = self.comm.Get_rank()
+        requests = []
+        send_buffers = []
+        for r, vertices in self.handoff.items():
+            if r == rank:
+                target.spins[target.handoff[r]] = spins[vertices]
+            else:
+                send_buffers.append(np.ascontiguousarray(spins[vertices]))
+                requests.append(
+                    self.comm.Isend(send_buffers[-1], dest=r, tag=HANDOFF_TAG))
+        recv_buffers = {}
+        for r, vertices in target.handoff.items():
+            if r != rank:
+                recv_buffers[r] = np.empty(len(vertices), dtype=np.int8)
+                requests.append(
+                    self.comm.Irecv(recv_buffers[r], source=r,
+                                    tag=HANDOFF_TAG))
+        MPI.Request.Waitall(requests)
+        for r, part in recv_buffers.items():
+            target.spins[target.handoff[r]] = part
+        changed = target._receive_halo()
+        target.spins[changed] = -target.spins[changed]
+        target.refresh()
+
+    def modularity(self):
+        """
+        Global s^T B s (collective, the halo has to be current)
+        """
+        return self.comm.allreduce(
+            float(self.spins[:self.n_owned].dot(
+                self.adj_field))) - self.k_dot_s**2 / self.two_m
+
+    def gather(self, values):
+        """
+        Assembles the full partition on rank 0 from the values of the regions of all ranks (collective)
+        :return: partition on rank 0, None on the other ranks
+        :rtype: numpy.ndarray
+        """
+        parts = self.comm.gather((self.vertices[:self.n_owned], values),
+                                 root=0)
+        if parts is None:
+            return None
+        res = np.empty(sum(len(owned) for owned, _ in parts), dtype=np.int8)
+        for owned, part in parts:
+            res[owned] = part
+        return res
+
+
+def decompose(ordering, size, shifted=False):
+    """
+    Splits the vertices into size contiguous chunks of ordering
+    :param shifted: move the chunk boundaries by half a chunk (the first chunk wraps around), so that the vertices on the boundaries of the unshifted split end up inside a region
+    :return: vertices of every region, in the order of ordering
+    :rtype: list
+    """
+    if shifted:
+        ordering = np.roll(ordering, len(ordering) // (2 * size))
+    return np.array_split(ordering, size)
+
+
+def _owners(chunks, n_nodes):
+    owner = np.empty(n_nodes, dtype=np.intp)
+    for r, chunk in enumerate(chunks):
+        owner[chunk] = r
+    return owner
+
+
+def _regions(A, chunks, other_chunks, spins):
+    """
+    Local data of the regions of one split (see Region), built on rank 0 with sparse slicing
+    :param A: adjacency matrix of the whole graph (csr)
+    :param chunks: vertices of every region, see decompose
+    :param other_chunks: vertices of every region of the other split
+    :param spins: partition of the whole graph
+    :return: for every rank: vertices (global ids in local order), n_owned, A (rows of the region, local columns), spins, send and recv (rank -> local indices of the boundary and halo vertices exchanged with it, in the same order on both sides), handoff (rank -> local indices of the vertices it owns in the other split, by increasing global id)
+    :rtype: list
+    """
+    n_nodes = A.shape[0]
+    owner = _owners(chunks, n_nodes)
+    other_owner = _owners(other_chunks, n_nodes)
+    local = np.empty(n_nodes, dtype=np.intp)
+    for chunk in chunks:
+        local[chunk] = np.arange(len(chunk))
+    regions = []
+    sends = [{} for _ in chunks]
+    for r, chunk in enumerate(chunks):
+        rows = A[chunk]
+        columns = np.unique(rows.indices)
+        halo = columns[owner[columns] != r]
+        n_owned = len(chunk)
+        inside = owner[rows.indices] == r
+        indices = np.where(inside, local[rows.indices],
+                           n_owned + np.searchsorted(halo, rows.indices))
+        recv = {}
+        for q in np.unique(owner[halo]):
+            from_q = owner[halo] == q
+            recv[int(q)] = n_owned + np.nonzero(from_q)[0]
+            sends[q][r] = local[halo[from_q]]
+        handoff = {}
+        for q in np.unique(other_owner[chunk]):
+            handoff[int(q)] = local[np.sort(chunk[other_owner[chunk] == q])]
+        vertices = np.concatenate([chunk, halo])
+        regions.append({
+            'vertices':
+            vertices,
+            'n_owned':
+            n_owned,
+            'A':
+            sp.csr_matrix((rows.data, indices, rows.indptr),
+                          shape=(n_owned, len(vertices))),
+            'spins':
+            spins[vertices],
+            'recv':
+            recv,
+            'handoff':
+            handoff
+        })
+    for region, send in zip(regions, sends):
+        region['send'] = send
+    return regions
+
+
+def select_region_subset(region, gains, visited, subset_selection,
+                         size_of_iteration):
+    """
+    Same as single_level_refinement.select_subset, restricted to the region of this rank
+    :param gains: gains of the region (see Region.gains)
+    :param visited: boolean mask of the region's vertices already used as roots, updated in place
+    :return: subset (local indices, empty if no vertex is available), root (None if none)
+    :rtype: tuple
+    """
+    if subset_selection == 'top_gain':
+        # increasing gain
+        return slr.largest_gains(gains, size_of_iteration)[::-1].tolist(), None
+    if visited.all():
+        return [], None
+    root = int(np.argmax(np.where(visited, -np.inf, gains)))
+    visited[root] = True
+    if subset_selection == 'spectral':
+        threshold = np.percentile(
+            gains,
+            25) if 0.75 * region.n_owned >= size_of_iteration else gains.min()
+        subset = slr.spectral_populate_subset(region.graph, root,
+                                              size_of_iteration, gains,
+                                              threshold)
+    elif subset_selection == 'bfs':
+        subset = slr.bfs_populate_subset(region.graph, root, size_of_iteration)
+    else:
+        raise ValueError(
+            "Invalid subset selection method: {}".format(subset_selection))
+    return subset, root
+
+
+def distributed_optimize_modularity(G,
+                                    comm,
+                                    random_seed=42,
+                                    size_of_iteration=12,
+                                    subset_selection='spectral',
+                                    stopping_criteria=3,
+                                    solver_params=None,
+                                    persistency=False,
+                                    sync_every=1,
+                                    deadline=None,
+                                    target=None,
+                                    telemetry=None,
+                                    initial_solution=None,
+                                    init='random'):
+    """
+    Single level refinement with the graph split between the ranks of comm; has to be called on every rank
+    :param G: NetworkX graph, only read on rank 0 (the other ranks can pass None)
+    :param solver_params: keyword arguments of single_level_refinement.solve_subproblem (method, method_params, qaoa_method, backend, backend_params)
+    :param sync_every: number of local iterations between two exchanges of the boundary spins
+    :param deadline: time.time() after which the refinement stops
+    :param target: stop once the modularity reaches target (optional, taken from rank 0)
+    :param initial_solution: partition to start from (optional, taken from rank 0)
+    :param init: initial guess without initial_solution, see single_level_refinement.initial_partition
+    :param telemetry: path of a JSONL (or .csv) file; every rank appends its records to its own copy, with the rank inserted before the extension
+    :return: best modularity, best bitstring (-1s and 1s, None on ranks other than 0), number of rounds, modularity after every round, telemetry records of this rank
+    :rtype: tuple
+    """
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    n_nodes = comm.bcast(G.number_of_nodes() if rank == 0 else None, root=0)
+    if n_nodes < size:
+        raise ValueError("Can not split {} vertices between {} ranks".format(
+            n_nodes, size))
+    if solver_params is None:
+        solver_params = {}
+    target = comm.bcast(target, root=0)
+    if rank == 0:
+        # Lanczos is not deterministic, so the ordering (and the initial guess, in case there is no seed) is computed here only
+        B = ModularityOperator.from_graph(G,
+                                          nodelist=sorted(G.nodes()),
+                                          weight='weight')
+        ordering = slr.get_spectral_ordering(G)[0]
+        np.random.seed(random_seed)
+        if initial_solution is not None:
+            spins = gm.to_spins(initial_solution, n_nodes)
+        else:
+            spins = slr.initial_partition(B, init)
+        spins = np.asarray(spins, dtype=np.int8)
+        splits = [
+            decompose(ordering, size, shifted) for shifted in (False, True)
+        ]
+        regions = list(
+            zip(_regions(B.A, splits[0], splits[1], spins),
+                _regions(B.A, splits[1], splits[0], spins)))
+        for r in range(1, size):
+            comm.send(regions[r], dest=r, tag=SETUP_TAG)
+        local = regions[0]
+        del regions
+    else:
+        local = comm.recv(source=0, tag=SETUP_TAG)
+    np.random.seed(None if random_seed is None else random_seed + rank)
+    regions = [Region(comm, part) for part in local]
+    del local
+    for region in regions:
+        # the region is a piece of the global ordering, no need to compute its own
+        identity = np.arange(region.n_owned)
+        slr._spectral_orderings[region.graph] = (identity, identity)
+    current = 0
+    region = regions[current]
+
+    pool = SerialSolver() if solver_params.get('method') == 'brute' else None
+    telemetry_writer = None
+    if telemetry is not None:
+        root, ext = os.path.splitext(telemetry)
+        telemetry_writer = tm.TelemetryWriter("{}.{}{}".format(
+            root, rank, ext))
+
+    curr_modularity = region.modularity()
+    best_spins = region.spins[:region.n_owned].copy()
+    if rank == 0:
+        print("Initial guess: {}, {} ranks".format(curr_modularity, size))
+    visited = np.zeros(region.n_owned, dtype=bool)
+    it = 0
+    n_local = 0
+    it_stuck = 0
+    all_modularities = []
+    telemetry_records = []
+    while True:
+        it += 1
+        # local iterations inside the region
+        for _ in range(sync_every):
+            n_local += 1
+            stats = tm.new_record(n_local)
+            stats['time_remaining'] = -1.0
+            time_limit = None
+            if deadline is not None:
+                time_limit = deadline - time.time()
+                stats['time_remaining'] = time_limit
+                if time_limit <= 0:
+                    break
+                stats['solver_time_limit'] = time_limit
+            start = time.time()
+            gains = region.gains()
+            stats['t_gains'] = time.time() - start
+            start = time.time()
+            subset, _ = select_region_subset(region, gains, visited,
+                                             subset_selection,
+                                             size_of_iteration)
+            stats['t_selection'] = time.time() - start
+            if not subset:
+                break
+            subset = np.asarray(subset, dtype=np.intp)
+            start = time.time()
+            B_sub, C = region.subproblem(subset)
+            stats['t_construction'] = time.time() - start
+            initial = region.spins[subset]
+            cand = slr.reduce_and_solve_subproblem(B_sub,
+                                                   C,
+                                                   initial,
+                                                   persistency,
+                                                   dict(solver_params,
+                                                        pool=pool,
+                                                        time_limit=time_limit),
+                                                   stats=stats)
+            start = time.time()
+            gain = (cand.dot(B_sub).dot(cand) + C.dot(cand)) - (
+                initial.dot(B_sub).dot(initial) + C.dot(initial))
+            stats['subset_size'] = len(subset)
+            stats['n_subproblems'] = 1
+            stats['gain'] = gain
+            stats['accepted'] = bool(gain > 0)
+            if gain > 0:
+                region.flip(subset[cand != initial])
+            stats['t_evaluation'] = time.time() - start
+            telemetry_records.append(stats)
+            if telemetry_writer is not None:
+                telemetry_writer.write(stats)
+
+        region.exchange()
+        cand_modularity = region.modularity()
+        if rank == 0:
+            print('round', it, 'cand_modularity', cand_modularity, 'curr_best',
+                  curr_modularity)
+        all_modularities.append({
+            'it': it,
+            'cand_modularity': cand_modularity,
+            'curr_best': curr_modularity
+        })
+        if cand_modularity > curr_modularity:
+            best_spins = region.spins[:region.n_owned].copy()
+            curr_modularity = cand_modularity
+            it_stuck = 0
+        else:
+            # concurrent moves cancelled out or nothing was found: back to the best partition, and switch to the other split so that the region boundaries get refined too
+            region.hand_over(regions[1 - current], best_spins)
+            current = 1 - current
+            region = regions[current]
+            best_spins = region.spins[:region.n_owned].copy()
+            visited = np.zeros(region.n_owned, dtype=bool)
+            it_stuck += 1
+
+        exhausted = subset_selection != 'top_gain' and visited.all()
+        out_of_time = deadline is not None and time.time() > deadline
+        flags = comm.allreduce(np.array([exhausted, out_of_time], dtype=int))
+        if flags[0] == size:
+            logging.info("All regions exhausted at round {}".format(it))
+            break
+        if flags[1] > 0:
+            if rank == 0:
+                print("Time budget exhausted at round {}".format(it))
+            break
+        if it_stuck > stopping_criteria:
+            logging.info("Exiting at round {}".format(it))
+            break
+        if target is not None and curr_modularity >= target:
+            logging.info(
+                "Found really good solution at round {}, exiting".format(it))
+            break
+    if telemetry_writer is not None:
+        telemetry_writer.close()
+    best_solution = region.gather(best_spins)
+    return curr_modularity, best_solution, it, all_modularities, telemetry_records
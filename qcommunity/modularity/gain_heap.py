@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# Max-heap over the single vertex flip gains of a partition, used to pick roots and candidates in single level refinement
+# For B = A - k k^T / 2m the gain of flipping v is 4 (B_vv - s_v (A s)_v) + c s_v k_v with c = 4 k^T s / 2m. A move changes the first part only for the flipped vertices and their neighbours, which are pushed again with a new version (older entries are dropped when they reach the top), as in local_search.fm_pass.
+# The second part shifts every gain a little, so the key of an entry is off by at most (max c - min c) max k over the values c took since the heap was built. Queries re-key the entries they pop and stop once no key can still beat the answer, so they are exact and cost O((count + entries within the bound) log n).
+# The heap and the gain threshold of spectral selection are rebuilt every resync_every updates, which resets the bound and drops the outdated entries; an update costs O(touched log n + n / resync_every) amortized
+
+import heapq
+import numpy as np
+
+
+class GainHeap:
+    """
+    Lazily updated max-heap over the flip gains of a PartitionState (state.B has to be a ModularityOperator)
+    Call update() with the vertices every accepted move changed
+    """
+
+    def __init__(self, state, resync_every=100, percentile=25):
+        """
+        :param percentile: percentile of the gains returned by threshold()
+        """
+        self.A = state.B.A
+        self.k = state.B.k
+        self.two_m = state.B.two_m
+        self.k_max = float(self.k.max()) if len(self.k) else 0.0
+        self.resync_every = resync_every
+        self.percentile = percentile
+        self.masked = np.zeros(self.A.shape[0], dtype=bool)
+        self.reset(state)
+
+    def reset(self, state):
+        """
+        Rebuilds the heap and the threshold from scratch, O(n)
+        """
+        self.gains = state.gains
+        self.version = np.zeros(len(self.gains), dtype=np.int64)
+        self.n_updates = 0
+        self.shift = 4 * float(self.k.dot(state.spins)) / self.two_m
+        self.shift_min = self.shift_max = self.shift
+        available = np.flatnonzero(~self.masked)
+        self.heap = list(
+            zip((-self.gains[available]).tolist(), available.tolist(),
+                [0] * len(available)))
+        heapq.heapify(self.heap)
+        self._threshold = float(np.percentile(self.gains, self.percentile))
+
+    def update(self, vertices, state):
+        """
+        Re-keys the vertices a move flipped and their neighbours
+        :param state: partition after the move
+        """
+        vertices = np.asarray(vertices, dtype=np.intp)
+        self.gains = state.gains
+        if len(vertices) == 0:
+            return
+        self.n_updates += 1
+        if self.n_updates >= self.resync_every:
+            self.reset(state)
+            return
+        # each flipped vertex moved k^T s by 2 k_v s_v
+        self.shift += 8 * float(self.k[vertices].dot(
+            state.spins[vertices])) / self.two_m
+        self.shift_min = min(self.shift_min, self.shift)
+        self.shift_max = max(self.shift_max, self.shift)
+        touched = np.union1d(vertices, self.A[vertices].indices)
+        self.version[touched] += 1
+        for v in touched[~self.masked[touched]]:
+            heapq.heappush(
+                self.heap,
+                (-float(self.gains[v]), int(v), int(self.version[v])))
+
+    def mask(self, v):
+        """
+        Excludes v from largest() (e.g. a visited root)
+        """
+        self.masked[v] = True
+
+    def unmask(self, v):
+        """
+        Makes a masked vertex available to largest() again
+        """
+        if self.masked[v]:
+            self.masked[v] = False
+            # the entry pushed before v was masked may still be in the heap
+            self.version[v] += 1
+            heapq.heappush(
+                self.heap,
+                (-float(self.gains[v]), int(v), int(self.version[v])))
+
+    def threshold(self):
+        """
+        Percentile of the gains, as of the last rebuild
+        :rtype: float
+        """
+        return self._threshold
+
+    def largest(self, count=1, skip=None):
+        """
+        Vertices with the largest gains, in decreasing order of gain (ties go to the smaller vertex)
+        :param skip: vertices to leave out of this query only (optional)
+        :rtype: list
+        """
+        bound = (self.shift_max - self.shift_min) * self.k_max
+        # the count best (gain, -v) so far, worst first
+        best = []
+        popped = []
+        while self.heap:
+            if len(best) == count and -self.heap[0][0] + bound < best[0][0]:
+                break
+            _, v, version = heapq.heappop(self.heap)
+            if self.masked[v] or version != self.version[v]:
+                continue
+            gain = float(self.gains[v])
+            popped.append((-gain, v, version))
+            if skip is not None and v in skip:
+                continue
+            if len(best) < count:
+                heapq.heappush(best, (gain, -v))
+            elif (gain, -v) > best[0]:
+                heapq.heapreplace(best, (gain, -v))
+        for entry in popped:
+            heapq.heappush(self.heap, entry)
+        return [-v for _, v in sorted(best, reverse=True)]
@@ -7,59 +7,167 @@ import matplotlib.pyplot as plt
 from networkx.generators.classic import barbell_graph
 from networkx.algorithms.community.community_generators import LFR_benchmark_graph
 import warnings
-from itertools import product
-from operator import itemgetter
-import math
-import copy
+import time
 import multiprocessing
-from multiprocessing import Pool
 import numpy as np
+from qcommunity.modularity.modularity_operator import ModularityOperator, as_dense
 
 
-# added to support python2, use with p.map
-def _test_all_with_prefix_tuple(args):
-    return _test_all_with_prefix(args[0], args[1], args[2], args[3])
-
-
-def _test_all_with_prefix(prefix, n_nodes, B, C):
-    suffix_len = n_nodes - len(prefix)
-    curr_best_str = [0] * n_nodes
-    curr_best = compute_modularity(n_nodes, B, curr_best_str, C)
-    for x in product([0, 1], repeat=suffix_len):
-        s = prefix + list(x)
-        curr = compute_modularity(n_nodes, B, s, C)
-        if curr > curr_best:
-            curr_best = curr
-            curr_best_str = s
-    return (curr_best, curr_best_str)
+# number of trailing spins that are enumerated at once as a dense block in _gray_code_search
+GRAY_CODE_BLOCK_SIZE = 12
 
 
-def optimize_modularity(n_nodes, B, C=None):
+def _gray_code_search(prefix, B, C, should_stop=None):
+    """
+    Exhaustively maximizes s^T B s + C^T s over all s with s[0] = +1 and s[1:len(prefix)+1] given by prefix (0s and 1s)
+    The global flip s -> -s leaves s^T B s unchanged and flips the sign of C^T s, so the better of s and -s has value s^T B s + |C^T s|. This halves the search space.
+    The remaining spins are split into a high part, walked in Gray code order so that each step flips exactly one spin and updates the fields in O(n), and a low block of GRAY_CODE_BLOCK_SIZE spins whose 2^GRAY_CODE_BLOCK_SIZE assignments are scored at once with a single matrix-vector product.
+    :param should_stop: callable polled during the enumeration; if it returns True, the best bitstring found so far is returned
+    :return: best value, best bitstring (0s and 1s), number of bitstrings evaluated
+    :rtype: tuple
+    """
+    n_nodes = B.shape[0]
+    fixed = np.array([1] + [2 * x - 1 for x in prefix], dtype=np.float64)
+    n_fixed = len(fixed)
+    n_low = min(GRAY_CODE_BLOCK_SIZE, n_nodes - n_fixed)
+    n_high = n_nodes - n_fixed - n_low
+    F = np.arange(0, n_fixed)
+    H = np.arange(n_fixed, n_fixed + n_high)
+    L = np.arange(n_fixed + n_high, n_nodes)
+    FH = np.arange(0, n_fixed + n_high)
+
+    # all assignments of the low block
+    S_low = 2.0 * ((np.arange(2**n_low)[:, None] >> np.arange(n_low)) & 1) - 1
+    q_low = np.einsum('ij,ij->i', S_low.dot(B[np.ix_(L, L)]), S_low)
+    c_low = S_low.dot(C[L])
+
+    # high part starts at all -1 (Gray code 0)
+    s = np.concatenate((fixed, -np.ones(n_high)))
+    # field of all non-low spins on spins in F and H, and (twice) on the low block
+    g = B[np.ix_(FH, FH)].dot(s)
+    f = 2 * B[np.ix_(L, FH)].dot(s)
+    q_const = s.dot(g)
+    c_const = C[FH].dot(s)
+    B_low_high = B[np.ix_(L, H)]
+    B_high = B[np.ix_(FH, H)]
+
+    best = -np.inf
+    best_s = None
+    n_steps = 0
+    for t in range(2**n_high):
+        if t and not t & 63 and should_stop is not None and should_stop():
+            break
+        n_steps += 1
+        if t:
+            k = (t & -t).bit_length() - 1  # spin flipped by Gray code at step t
+            old = s[n_fixed + k]
+            q_const += -4 * old * g[n_fixed + k] + 4 * B_high[n_fixed + k, k]
+            g -= 2 * old * B_high[:, k]
+            f -= 4 * old * B_low_high[:, k]
+            c_const -= 2 * old * C[n_fixed + k]
+            s[n_fixed + k] = -old
+        vals = q_low + S_low.dot(f) + q_const + np.abs(c_low + c_const)
+        i = int(np.argmax(vals))
+        if vals[i] > best:
+            best = vals[i]
+            sign = 1 if c_low[i] + c_const >= 0 else -1
+            best_s = sign * np.concatenate((s, S_low[i]))
+    bitstring = [int(x > 0) for x in best_s]
+    return (compute_modularity(n_nodes, B, bitstring, C), bitstring,
+            n_steps * 2**n_low)
+
+
+def optimize_modularity(n_nodes,
+                        B,
+                        C=None,
+                        pool=None,
+                        target=None,
+                        deadline=None):
+    """
+    Finds the bitstring maximizing s^T B s + C^T s by exhaustive Gray code enumeration
+    :param pool: solver_pool.SolverPool to run on. If None, a temporary pool using all cores is created for this call
+    :param target: stop as soon as a bitstring with value >= target is found (optional)
+    :param deadline: time.time() after which the best bitstring found so far is returned (optional)
+    :return: best value, best bitstring (0s and 1s)
+    :rtype: tuple
+    """
     if isinstance(n_nodes, nx.Graph) or isinstance(n_nodes, nx.DiGraph):
         # legacy
         n_nodes = n_nodes.number_of_nodes()
-    num_cores = min(multiprocessing.cpu_count(), 16)
-    prefix_len = int(math.log(num_cores, 2))
-    prefixes = list(product([0, 1], repeat=prefix_len))
-    p = Pool(num_cores)
-    params = [(list(x), n_nodes, B, C) for x in prefixes]
-    results = p.map(_test_all_with_prefix_tuple, params)
-    p.close()
-    return max(results, key=itemgetter(0))
+    if pool is not None:
+        return pool.optimize_modularity(n_nodes,
+                                        B,
+                                        C,
+                                        target=target,
+                                        deadline=deadline)
+    if multiprocessing.current_process().daemon:
+        # already inside a pool worker (e.g. parallel subproblems), which can not fork its own workers
+        if C is None:
+            C = np.zeros(n_nodes)
+        value, bitstring, _ = _gray_code_search(
+            [],
+            as_dense(B),
+            np.asarray(C, dtype=np.float64).ravel(),
+            should_stop=None if deadline is None else
+            lambda: time.time() > deadline)
+        return value, bitstring
+    from qcommunity.modularity.solver_pool import SolverPool
+    with SolverPool() as pool:
+        return pool.optimize_modularity(n_nodes,
+                                        B,
+                                        C,
+                                        target=target,
+                                        deadline=deadline)
+
+
+def _check_length(spins, n_nodes):
+    if n_nodes is not None and (spins.ndim == 0 or
+                                spins.shape[-1] != n_nodes):
+        raise ValueError(
+            "Incorrect bistring encountered. Expected {} nodes, got shape {}".
+            format(n_nodes, spins.shape))
+
+
+def to_spins(bitstring, n_nodes=None):
+    """
+    Converts a bitstring (0s and 1s or -1s and 1s), or a matrix with one bitstring per row, to the int8 array of -1s and 1s used as the partition representation throughout
+    All validation happens here, at the boundary. int8 arrays are taken to be spins already (the package holds partitions only as returned by this function) and are returned as is, checking only their length, so that hot paths (compute_gain, PartitionState.apply, compute_modularity_batch) do not validate them again
+    :param n_nodes: expected length of the bitstring(s) (optional)
+    :rtype: numpy.ndarray
+    """
+    bitstring = np.asarray(bitstring)
+    if bitstring.dtype == np.int8:
+        _check_length(bitstring, n_nodes)
+        return bitstring
+    if bitstring.dtype.kind not in 'biuf':
+        raise ValueError(
+            "Incorrect bistring encountered. Only accepts bitstrings containing 0s and 1s or -1s and 1s, got dtype {}"
+            .format(bitstring.dtype))
+    spins = bitstring.astype(np.int8, copy=False)
+    if spins is not bitstring and np.any(spins != bitstring):
+        raise ValueError(
+            "Incorrect bistring encountered. Only accepts bitstrings containing 0s and 1s or -1s and 1s"
+        )
+    _check_length(spins, n_nodes)
+    if spins.size and spins.min() >= 0:
+        # assuming bitstring is of zeros and ones
+        if spins.max() > 1:
+            raise ValueError(
+                "Incorrect bistring encountered. Only accepts bitstrings containing 0s and 1s or -1s and 1s"
+            )
+        spins = 2 * spins - 1
+    elif not np.all(np.abs(spins) == 1):
+        raise ValueError(
+            "Incorrect bistring encountered. Only accepts bitstrings containing 0s and 1s or -1s and 1s"
+        )
+    return spins
 
 
 def get_optimal_modularity_bitstring(G):
     # Guaranteed to return a string of +1 / -1
-    B = nx.modularity_matrix(G).A
+    B = ModularityOperator.from_graph(G)
     _, bitstring = optimize_modularity(G, B)
-    if 0 in bitstring:
-        # assuming bitstring is of zeros and ones
-        bitstring = [
-            -1 if x == 0 else 1 if x == 1 else 'Error' for x in bitstring
-        ]
-    if 'Error' in bitstring or len(bitstring) != G.number_of_nodes():
-        raise ValueError("Incorrect bistring returned by nx.erdos_renyi_graph")
-    return bitstring
+    return to_spins(bitstring, G.number_of_nodes())
 
 
 # added to support python2, use with p.map
@@ -70,22 +178,64 @@ def compute_gain_tuple(args):
 def compute_gain(G, B, curr_bitstring, v, return_v=False):
     """
     Computes gain in modularity from reassigning v to a different community, given the current assignment curr_bitstring
-    For now, this is done stupidly
     return_v parameter to support nice parallelisation with multiprocessing.Pool
     """
-    reassigned = copy.deepcopy(curr_bitstring)
-    reassigned[v] = -curr_bitstring[v]
-    gain = (
-        compute_modularity(G.number_of_nodes(), B, reassigned) -
-        compute_modularity(G.number_of_nodes(), B, curr_bitstring))
+    s = to_spins(curr_bitstring, G.number_of_nodes())
+    # flipping s_v changes s^T B s by 4 (B_vv - s_v (B s)_v)
+    if isinstance(B, ModularityOperator):
+        field_v = B.rows_dot([v], s)[0]
+    else:
+        field_v = np.asarray(B)[v].dot(s)
+    gain = float(4 * (B[v, v] - s[v] * field_v))
     if return_v:
         return gain, v
     else:
         return gain
 
 
+def compute_all_gains(B, s, field=None, diagonal=None):
+    """
+    Computes gains in modularity from reassigning every vertex v to a different community, given the current assignment s (-1s and 1s)
+    Flipping s_v changes s^T B s by 4 (B_vv - s_v (B s)_v)
+    :param field: precomputed B s (optional)
+    :param diagonal: precomputed diagonal of B (optional)
+    :return: gains, indexed by vertex
+    :rtype: numpy.ndarray
+    """
+    s = np.asarray(s, dtype=np.float64).ravel()
+    if field is None:
+        field = np.asarray(B.dot(s), dtype=np.float64).ravel()
+    if diagonal is None:
+        if isinstance(B, ModularityOperator):
+            diagonal = B.diagonal()
+        else:
+            diagonal = np.diag(np.asarray(B))
+    return 4 * (diagonal - s * field)
+
+
+def compute_subset_bias(B, s, subset, field=None, B_sub=None):
+    """
+    Computes the linear coefficients of the subproblem over subset with all other spins fixed to s, C_i = 2 sum_{j not in subset} B_ij s_j
+    Done as 2 (B[subset, :] s - B[subset, subset] s[subset]) instead of looping over the vertices outside of the subset
+    :param field: precomputed B s (optional), then B[subset, :] s is just a lookup
+    :param B_sub: precomputed B[subset, subset] (optional)
+    :rtype: numpy.ndarray
+    """
+    s = np.asarray(s, dtype=np.float64).ravel()
+    subset = np.asarray(subset, dtype=np.intp)
+    if field is not None:
+        rows = np.asarray(field, dtype=np.float64).ravel()[subset]
+    elif isinstance(B, ModularityOperator):
+        rows = B.rows_dot(subset, s)
+    else:
+        rows = np.asarray(B)[subset].dot(s)
+    if B_sub is None:
+        B_sub = B[np.ix_(subset, subset)]
+    return 2 * (rows - np.asarray(B_sub).dot(s[subset]))
+
+
 def compute_modularity_c(G, bitstring):
-    B = nx.modularity_matrix(G).A
+    B = ModularityOperator.from_graph(G)
     return compute_modularity(G, B, bitstring)
 
 
@@ -93,25 +243,49 @@ def compute_modularity(n_nodes, B, bitstring, C=None):
     if isinstance(n_nodes, nx.Graph) or isinstance(n_nodes, nx.DiGraph):
         # legacy
         n_nodes = n_nodes.number_of_nodes()
-    if 0 in bitstring:
-        # assuming bitstring is of zeros and ones
-        bitstring = [
-            -1 if x == 0 else 1 if x == 1 else 'Error' for x in bitstring
-        ]
-    if 'Error' in bitstring or len(bitstring) != n_nodes:
+    bitstring = to_spins(bitstring, n_nodes)
+    if bitstring.ndim != 1:
         raise ValueError(
-            "Incorrect bistring encountered. Only accepts bitstrings containing 0s and 1s or -1s and 1s of the size equal to number of nodes in G"
-        )
-    if not isinstance(bitstring, np.ndarray):
-        bitstring = np.asarray(bitstring)
+            "Incorrect bistring encountered. Expected a single bitstring, got shape {}"
+            .format(bitstring.shape))
     if not isinstance(C, np.ndarray) and C is not None:
         C = np.asarray(C)
-    cost = (bitstring.dot(B)).dot(bitstring.T)
+    if isinstance(B, ModularityOperator):
+        cost = B.quadratic_form(bitstring)
+    else:
+        cost = (bitstring.dot(B)).dot(bitstring.T)
     if C is not None:
         cost += C.T.dot(bitstring)
     return float(cost)
 
 
+def compute_modularity_batch(B, S, C=None):
+    """
+    Computes modularity for every bitstring (row) of S with a single matrix product
+    :param B: modularity matrix, n x n (dense or ModularityOperator)
+    :param S: n_shots x n matrix of bitstrings, either all 0s and 1s or all -1s and 1s
+    :param C: coefficients of the linear term (optional)
+    :return: modularities, one per row of S
+    :rtype: numpy.ndarray
+    """
+    S = to_spins(S)
+    if S.ndim == 1:
+        S = S.reshape(1, -1)
+    if S.ndim != 2 or S.shape[1] != B.shape[0]:
+        raise ValueError(
+            "Incorrect bitstrings encountered. Expected a matrix with {} columns, got shape {}"
+            .format(B.shape[0], S.shape))
+    S = S.astype(np.float64)
+    if isinstance(B, ModularityOperator):
+        SB = B.dot(S.T).T
+    else:
+        SB = S.dot(np.asarray(B))
+    cost = np.einsum('ij,ij->i', SB, S)
+    if C is not None:
+        cost += S.dot(np.asarray(C, dtype=S.dtype))
+    return cost
+
+
 def get_simple_graph():
     G = nx.Graph()
 
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Fiduccia-Mattheyses (Kernighan-Lin style) local search for modularity bisection
+# A pass moves every vertex at most once, always the unlocked one with the largest flip gain (even if negative, to get out of local optima), and then rolls back to the best prefix of moves, so it never makes the partition worse.
+# Gains are kept in a max-heap: moving v only changes the adjacency part of the gains of v's neighbours (pushed again with a new version), the rank-one part k k^T / 2m shifts all gains a little and is refreshed lazily when an entry reaches the top. A pass costs O(m log n).
+
+import heapq
+import numpy as np
+import qcommunity.modularity.graphs as gm
+
+
+def fm_pass(B, spins, max_stall=100):
+    """
+    One FM pass
+    :param B: ModularityOperator
+    :param spins: partition to improve (-1s and 1s or 0s and 1s), not modified
+    :param max_stall: the pass ends after this many moves without a new best prefix (None to move every vertex)
+    :return: spins after rolling back to the best prefix, gain in modularity (>= 0)
+    :rtype: tuple
+    """
+    n_nodes = B.shape[0]
+    spins = np.array(gm.to_spins(spins, n_nodes), dtype=np.int8)
+    s_float = spins.astype(np.float64)
+    adj_field_arr = B.A.dot(s_float)
+    base_arr = 4 * (B.diagonal() - s_float * adj_field_arr)
+    # plain lists are much faster than numpy arrays for the per-vertex updates below
+    indptr = B.A.indptr.tolist()
+    indices = B.A.indices.tolist()
+    data = B.A.data.tolist()
+    k = B.k.tolist()
+    diagonal = B.diagonal().tolist()
+    s = spins.tolist()
+    adj_field = adj_field_arr.tolist()
+    base = base_arr.tolist()
+    k_dot_s = float(B.k.dot(s_float))
+    scale = 4.0 / B.two_m
+    version = [0] * n_nodes
+    locked = [False] * n_nodes
+    heap = [(-(base[v] + scale * k_dot_s * s[v] * k[v]), v, 0)
+            for v in range(n_nodes)]
+    heapq.heapify(heap)
+
+    moves = []
+    total = 0.0
+    best = 0.0
+    best_len = 0
+    while heap:
+        _, v, v_version = heapq.heappop(heap)
+        if locked[v] or v_version != version[v]:
+            continue
+        gain = base[v] + scale * k_dot_s * s[v] * k[v]
+        if heap and gain < -heap[0][0]:
+            # outdated key, put back with the current gain
+            heapq.heappush(heap, (-gain, v, v_version))
+            continue
+        locked[v] = True
+        old = s[v]
+        s[v] = -old
+        k_dot_s -= 2 * old * k[v]
+        for idx in range(indptr[v], indptr[v + 1]):
+            u = indices[idx]
+            adj_field[u] -= 2 * old * data[idx]
+            if not locked[u]:
+                base[u] = 4 * (diagonal[u] - s[u] * adj_field[u])
+                version[u] += 1
+                heapq.heappush(heap,
+                               (-(base[u] + scale * k_dot_s * s[u] * k[u]), u,
+                                version[u]))
+        total += gain
+        moves.append(v)
+        if total > best + 1e-9:
+            best = total
+            best_len = len(moves)
+        elif max_stall is not None and len(moves) - best_len >= max_stall:
+            break
+    # roll back to the best prefix
+    moved = np.array(moves[:best_len], dtype=np.intp)
+    spins[moved] = -spins[moved]
+    return spins, best
+
+
+def fm_refine(B, spins, max_passes=10, max_stall=100):
+    """
+    Repeats FM passes until one does not improve the partition
+    :param max_passes: maximum number of passes
+    :param max_stall: see fm_pass
+    :return: improved spins, total gain, number of passes made
+    :rtype: tuple
+    """
+    spins = gm.to_spins(spins, B.shape[0])
+    total = 0.0
+    n_passes = 0
+    while n_passes < max_passes:
+        spins, gain = fm_pass(B, spins, max_stall=max_stall)
+        n_passes += 1
+        total += gain
+        if gain <= 0:
+            break
+    return spins, total, n_passes
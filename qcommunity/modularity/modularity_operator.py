@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+# Implicit (sparse) modularity matrix B = A - k k^T / 2m
+# Stores only the sparse adjacency A, the degree vector k and 2m, so memory and matvecs are O(m)
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+try:
+    _to_scipy_sparse = nx.to_scipy_sparse_array
+except AttributeError:
+    _to_scipy_sparse = nx.to_scipy_sparse_matrix
+
+
+class ModularityOperator:
+    """
+    Modularity matrix B = A - k k^T / 2m represented as a sparse part minus a rank-one part.
+    Supports B.dot(x), s^T B s, rows, columns, diagonal and (dense) sub-blocks via B[rows, cols], so it can be passed wherever a dense B is accepted
+    """
+
+    def __init__(self, A, degrees=None, two_m=None):
+        self.A = sp.csr_matrix(A, dtype=np.float64)
+        if degrees is None:
+            degrees = np.asarray(self.A.sum(axis=1)).ravel()
+        self.k = np.asarray(degrees, dtype=np.float64).ravel()
+        self.two_m = float(self.k.sum()) if two_m is None else float(two_m)
+        if self.A.shape[0] != self.A.shape[1] or self.A.shape[0] != len(
+                self.k):
+            raise ValueError(
+                "Incompatible adjacency matrix of shape {} and degree vector of length {}"
+                .format(self.A.shape, len(self.k)))
+
+    @classmethod
+    def from_graph(cls, G, nodelist=None, weight=None):
+        """
+        Same as nx.modularity_matrix(G, nodelist=nodelist, weight=weight), without forming the dense matrix
+        For a SparseGraph the wrapped operator is returned as is (nodelist and weight are ignored)
+        """
+        if isinstance(G, SparseGraph):
+            return G.B
+        if nodelist is None:
+            nodelist = list(G.nodes())
+        A = _to_scipy_sparse(G, nodelist=nodelist, weight=weight, format='csr')
+        return cls(A)
+
+    @property
+    def shape(self):
+        return self.A.shape
+
+    @property
+    def dtype(self):
+        return self.A.dtype
+
+    @property
+    def ndim(self):
+        return 2
+
+    def dot(self, x):
+        """
+        B x for a vector or an n x p matrix x
+        """
+        x = np.asarray(x, dtype=np.float64)
+        Ax = self.A.dot(x)
+        if x.ndim == 1:
+            return Ax - self.k * (self.k.dot(x) / self.two_m)
+        return Ax - np.outer(self.k, self.k.dot(x) / self.two_m)
+
+    def __matmul__(self, x):
+        return self.dot(x)
+
+    def rows_dot(self, rows, x):
+        """
+        B[rows, :] x in O(sum of degrees of rows + n)
+        """
+        rows = np.asarray(rows, dtype=np.intp).ravel()
+        x = np.asarray(x, dtype=np.float64)
+        return self.A[rows].dot(x) - self.k[rows] * (self.k.dot(x) /
+                                                     self.two_m)
+
+    def quadratic_form(self, s):
+        """
+        s^T B s
+        """
+        s = np.asarray(s, dtype=np.float64).ravel()
+        return float(s.dot(self.A.dot(s)) - self.k.dot(s)**2 / self.two_m)
+
+    def diagonal(self):
+        return self.A.diagonal() - self.k**2 / self.two_m
+
+    def row(self, i):
+        """
+        i-th row of B as a dense vector (B is symmetric, so this is also the i-th column)
+        """
+        return self.A.getrow(
+            i).toarray().ravel() - self.k[i] * self.k / self.two_m
+
+    def column(self, j):
+        return self.A.getcol(
+            j).toarray().ravel() - self.k * self.k[j] / self.two_m
+
+    def columns(self, cols):
+        """
+        Dense n x len(cols) block B[:, cols], extracted through the rows of the (symmetric) adjacency
+        """
+        cols = np.asarray(cols, dtype=np.intp).ravel()
+        return self.A[cols].toarray().T - np.outer(self.k,
+                                                   self.k[cols]) / self.two_m
+
+    def submatrix(self, rows, cols=None):
+        """
+        Dense block B[rows][:, cols]
+        """
+        rows = np.asarray(rows, dtype=np.intp).ravel()
+        cols = rows if cols is None else np.asarray(cols,
+                                                    dtype=np.intp).ravel()
+        return self.A[rows][:, cols].toarray() - np.outer(
+            self.k[rows], self.k[cols]) / self.two_m
+
+    def generalized(self, nodes):
+        """
+        Generalized modularity matrix of the community nodes, B^(g)_ij = B_ij - delta_ij sum_{l in g} B_il (Newman, 2006), built from this operator in O(sum of degrees of nodes)
+        It is again a ModularityOperator (with the same 2m), and s^T B^(g) s is the change of s^T B s of the whole graph when the community is split by s
+        """
+        nodes = np.asarray(nodes, dtype=np.intp).ravel()
+        A_g = self.A[nodes][:, nodes]
+        k_g = self.k[nodes]
+        row_sums = np.asarray(
+            A_g.sum(axis=1)).ravel() - k_g * k_g.sum() / self.two_m
+        return ModularityOperator(A_g - sp.diags(row_sums),
+                                  degrees=k_g,
+                                  two_m=self.two_m)
+
+    def leading_eigenvector(self, tol=1e-4, v0=None):
+        """
+        Largest eigenvalue of B and its eigenvector, computed with sparse Lanczos (falling back to LOBPCG if it does not converge) using only matvecs, B is never formed
+        :param v0: starting vector (default: random); should not be close to the all-ones vector, which is in the null space of B
+        :return: eigenvalue, eigenvector
+        :rtype: tuple
+        """
+        n_nodes = self.shape[0]
+        if n_nodes < 3:
+            vals, vecs = np.linalg.eigh(self.toarray())
+            return vals[-1], vecs[:, -1]
+        if v0 is None:
+            v0 = np.random.rand(n_nodes) - 0.5
+        op = spla.LinearOperator(self.shape,
+                                 matvec=self.dot,
+                                 matmat=self.dot,
+                                 dtype=np.float64)
+        try:
+            vals, vecs = spla.eigsh(op, k=1, which='LA', v0=v0, tol=tol)
+        except spla.ArpackNoConvergence:
+            vals, vecs = spla.lobpcg(op,
+                                     v0.reshape(-1, 1),
+                                     tol=tol,
+                                     maxiter=200,
+                                     largest=True)
+        return vals[0], vecs[:, 0]
+
+    def toarray(self):
+        return self.submatrix(np.arange(self.shape[0]))
+
+    def _index(self, key):
+        if isinstance(key, slice):
+            return np.arange(self.shape[0])[key], False
+        if np.ndim(key) == 0:
+            return np.array([int(key)]), True
+        return np.asarray(key, dtype=np.intp).ravel(), False
+
+    def __getitem__(self, key):
+        """
+        B[i, j], B[np.ix_(rows, cols)], B[rows, :] etc. Always returns dense values
+        """
+        if not isinstance(key, tuple) or len(key) != 2:
+            raise IndexError(
+                "ModularityOperator only supports two-dimensional indexing")
+        rows, squeeze_rows = self._index(key[0])
+        cols, squeeze_cols = self._index(key[1])
+        if squeeze_rows and squeeze_cols:
+            return self.A[
+                rows[0],
+                cols[0]] - self.k[rows[0]] * self.k[cols[0]] / self.two_m
+        if isinstance(key[0], slice) and key[0] == slice(None):
+            block = self.columns(cols)
+        else:
+            block = self.submatrix(rows, cols)
+        if squeeze_rows:
+            return block[0]
+        if squeeze_cols:
+            return block[:, 0]
+        return block
+
+
+class SparseGraph:
+    """
+    Read-only graph on the adjacency of a ModularityOperator, with the part of the NetworkX graph interface used by single_level_refinement (number_of_nodes, nodes, neighbors, number_of_edges, size)
+    Used for the coarse levels of the multilevel solver, so they can be refined without building NetworkX graphs
+    """
+
+    def __init__(self, B):
+        self.B = B
+
+    def number_of_nodes(self):
+        return self.B.shape[0]
+
+    def __len__(self):
+        return self.B.shape[0]
+
+    def nodes(self):
+        return range(self.B.shape[0])
+
+    def neighbors(self, v):
+        A = self.B.A
+        return (int(u) for u in A.indices[A.indptr[v]:A.indptr[v + 1]]
+                if u != v)
+
+    def number_of_edges(self):
+        n_loops = np.count_nonzero(self.B.A.diagonal())
+        return (self.B.A.nnz + n_loops) // 2
+
+    def size(self, weight=None):
+        """
+        Total edge weight (number of edges if weight is None), self-loops counted once
+        """
+        if weight is None:
+            return self.number_of_edges()
+        return (self.B.A.sum() + self.B.A.diagonal().sum()) / 2.0
+
+
+def as_dense(B):
+    """
+    Dense ndarray for B given either as a ModularityOperator or as a dense matrix
+    Use only for small (sub)problems
+    """
+    if isinstance(B, ModularityOperator):
+        return B.toarray()
+    return np.asarray(B, dtype=np.float64)
@@ -4,80 +4,204 @@
 
 # Example:
 # ./multiscale.py --graph /zfs/safrolab/users/rshaydu/quantum/data/graphs/subelj_cora/out.subelj_cora_cora
-# ./multiscale.py --graph /zfs/safrolab/users/hushiji/graphs/ego-facebook/out.ego-facebook
+# ./multiscale.py --graph /zfs/safrolab/users/hushiji/graphs/ego-facebook/out.ego-facebook --subset top_gain --method bnb --iter-size 30
 """
-    Plan:
+    V-cycle:
 
-    1. Build coarsening hierarchy
-    2. Salvage as much code as possible from single_level_refinement, with previous level as initial guess (should be fairly straightforward)
+    1. Build coarsening hierarchy (see coarsening.py), or load it from the cache
+    2. Solve the coarsest level exactly
+    3. Project the solution to the next finer level (modularity is preserved) and refine it there with single_level_refinement, with previous level as initial guess (optionally polished by FM local search first, see local_search.py)
 
 """
 
 import networkx as nx
+import numpy as np
 import logging
 import argparse
+import multiprocessing
 import qcommunity.modularity.graphs as gm
-from qcommunity.modularity.single_level_refinement import spectral_populate_subset, iteration_step
-from qcommunity.utils.import_graph import import_konect, generate_graph
-from pycoarsen.coarsen import coarsen
+import qcommunity.modularity.single_level_refinement as slr
+from qcommunity.modularity.coarsening import load_or_coarsen, restrict_ordering, save_hierarchy
+from qcommunity.modularity.modularity_operator import SparseGraph
+from qcommunity.modularity.solver_pool import SolverPool
+from qcommunity.utils.import_graph import import_konect, import_pajek, import_edgelist, generate_graph
 
 
-def cluster(G):
+def cluster(G,
+            coarsest_size=30,
+            random_seed=None,
+            size_of_iteration=12,
+            method='brute',
+            subset_selection='spectral',
+            stopping_criteria=3,
+            method_params=None,
+            cache_dir=None,
+            fm_passes=0,
+            **refinement_params):
     """
     Splits graph G into two communities
-    :param G: NetworkX graph to cluster
-    :return: solution bitstring
-    :rtype: list
+    :param G: NetworkX graph to cluster (nodes 0..n-1)
+    :param coarsest_size: coarsening stops at this many vertices, which are then solved exactly by brute force (if coarsening stalls earlier, the coarsest level is solved by single level refinement from a random guess)
+    :param cache_dir: directory where the coarsening hierarchy (and the spectral ordering) of G is cached for later runs (optional)
+    :param fm_passes: number of FM local search passes polishing the projected solution on every level, and every solution accepted by the refinement (see local_search.py)
+    :param refinement_params: passed to single_level_optimize_modularity on every level, as are the other parameters
+    :return: modularity, solution (-1s and 1s)
+    :rtype: tuple
     """
 
     logging.info("Computing coarsening hierarchy...")
-    hierarchy = coarsen(G)
-    logging.info("Done computing coarsening hierarchy")
-    curr_solution = None
-    for level, (graph, matching) in zip(
-            range(len(hierarchy) - 1, -1, -1), reversed(hierarchy)
-    ):  # http://christophe-simonis-at-tiny.blogspot.com/2008/08/python-reverse-enumerate.html
-        logging.info("Now at level {}".format(level))
-        B = nx.modularity_matrix(graph)
-        print(graph.number_of_nodes(), B)
-        if curr_solution is None:
-            # first level -- initial solution
+    hierarchy, ordering, cache_path = load_or_coarsen(
+        G, cache_dir=cache_dir, coarsest_size=coarsest_size)
+    logging.info("Done computing coarsening hierarchy: {} levels".format(
+        len(hierarchy)))
+    # levels are refined on their ModularityOperator directly
+    graphs = [SparseGraph(B) for B, _ in hierarchy]
+    if subset_selection == 'spectral':
+        if ordering is None:
+            ordering = slr.get_spectral_ordering(G)[0]
+            if cache_path is not None:
+                save_hierarchy(cache_path, hierarchy, ordering)
+        # coarse levels inherit the ordering of the finest one
+        for graph, (_, aggregate) in zip(graphs, hierarchy):
+            position = np.empty(len(ordering), dtype=int)
+            position[ordering] = np.arange(len(ordering))
+            slr._spectral_orderings[graph] = (ordering, position)
+            if aggregate is not None:
+                ordering = restrict_ordering(ordering, aggregate)
+    refinement_params = dict(refinement_params,
+                             random_seed=random_seed,
+                             size_of_iteration=size_of_iteration,
+                             method=method,
+                             subset_selection=subset_selection,
+                             stopping_criteria=stopping_criteria,
+                             method_params=method_params,
+                             fm_passes=fm_passes)
+
+    # one pool of brute force workers for the coarsest level and the refinement of every level, instead of forking one per level
+    pool = None if multiprocessing.current_process().daemon else SolverPool()
+    refinement_params['solver_pool'] = pool
+    try:
+        B, _ = hierarchy[-1]
+        graph = graphs[-1]
+        if graph.number_of_nodes() <= coarsest_size:
+            # coarsest level -- exact solution
             _, curr_solution = gm.optimize_modularity(graph.number_of_nodes(),
-                                                      B)
+                                                      B,
+                                                      pool=pool)
+            curr_solution = gm.to_spins(curr_solution)
+            curr_modularity = B.quadratic_form(curr_solution)
+        else:
+            curr_modularity, curr_solution, _, _ = slr.single_level_optimize_modularity(
+                graph, **refinement_params)
+            curr_solution = np.array(curr_solution, dtype=np.int8)
+        logging.info("Level {}: {} vertices, modularity {}".format(
+            len(hierarchy) - 1, graph.number_of_nodes(), curr_modularity))
 
-        print(curr_solution)
-        break
+        for level in range(len(hierarchy) - 2, -1, -1):
+            _, aggregate = hierarchy[level]
+            graph = graphs[level]
+            # projection keeps the modularity, refinement can only improve it
+            curr_solution = curr_solution[aggregate]
+            curr_modularity, curr_solution, _, _ = slr.single_level_optimize_modularity(
+                graph, initial_solution=curr_solution, **refinement_params)
+            curr_solution = np.array(curr_solution, dtype=np.int8)
+            logging.info("Level {}: {} vertices, modularity {}".format(
+                level, graph.number_of_nodes(), curr_modularity))
+    finally:
+        if pool is not None:
+            pool.close()
+    return curr_modularity, curr_solution.tolist()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument("-g",
+                        "--graph-generator",
+                        type=str,
+                        default="get_random_partition_graph",
+                        help="graph generator function")
+    parser.add_argument("-l",
+                        type=int,
+                        default=15,
+                        help="number of vtx in the left (first) community")
+    parser.add_argument("-r",
+                        type=int,
+                        default=17,
+                        help="number of vtx in the right (second) community")
+    parser.add_argument("--graph",
+                        type=str,
+                        help="path to KONECT edgelist (out.graphname file)")
+    parser.add_argument("--pajek",
+                        type=str,
+                        help="path to graph in pajek format")
     parser.add_argument(
-        "-g",
-        "--graph-generator",
+        "--edgelist",
         type=str,
-        default="get_random_partition_graph",
-        help="graph generator function")
+        help="path to graph in edgelist format (nx.write_edgelist)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    parser.add_argument("--coarsest-size",
+                        type=int,
+                        default=30,
+                        help="number of vertices at which coarsening stops")
     parser.add_argument(
-        "-l",
+        "--iter-size",
         type=int,
-        default=15,
-        help="number of vtx in the left (first) community")
+        default=12,
+        help="size of subproblem in each iteration of the refinement")
     parser.add_argument(
-        "-r",
+        "--stopping-criteria",
         type=int,
-        default=17,
-        help="number of vtx in the right (second) community")
+        default=3,
+        help=
+        "number of iterations of no improvement after which the refinement of a level is stopped"
+    )
     parser.add_argument(
-        "--graph",
+        "--method",
         type=str,
-        help="path to KONECT edgelist (out.graphname file)")
-    parser.add_argument("--seed", type=int, default=None, help="random seed")
+        default='brute',
+        choices=['brute', 'bnb'],
+        help=
+        "subproblem solver (brute is brute force, bnb is exact branch-and-bound)"
+    )
+    parser.add_argument("--subset",
+                        type=str,
+                        default='spectral',
+                        choices=['spectral', 'top_gain', 'bfs'],
+                        help="subset (subproblem) selection method")
+    parser.add_argument(
+        "--hierarchy-cache",
+        type=str,
+        default=None,
+        help=
+        "directory to cache coarsening hierarchies in, so that repeated runs on the same graph skip coarsening"
+    )
+    parser.add_argument(
+        "--fm-passes",
+        type=int,
+        default=0,
+        help="number of FM local search passes on every level (0 to disable)")
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
     if args.graph:
         G = import_konect(args.graph)
+    elif args.pajek:
+        G = import_pajek(args.pajek)
+    elif args.edgelist:
+        G = import_edgelist(args.edgelist)
     else:
-        G, _ = generate_graph(
-            args.graph_generator, args.l, args.r, seed=args.seed)
-    cluster(G)
+        G, _ = generate_graph(args.graph_generator,
+                              args.l,
+                              args.r,
+                              seed=args.seed)
+    modularity, _ = cluster(G,
+                            coarsest_size=args.coarsest_size,
+                            random_seed=args.seed,
+                            size_of_iteration=args.iter_size,
+                            method=args.method,
+                            subset_selection=args.subset,
+                            stopping_criteria=args.stopping_criteria,
+                            cache_dir=args.hierarchy_cache,
+                            fm_passes=args.fm_passes)
+    print("Found modularity {}".format(modularity /
+                                       (4.0 * G.size(weight='weight'))))
@@ -3,6 +3,7 @@
 import os
 import tempfile
 import multiprocessing
+import numpy as np
 import minimize_ising_model
 from pyomo.environ import *
 
@@ -61,16 +62,11 @@ def pyomo_solve(sub_B_matrix, bias, time_limit=100):
     part0 = []
     part1 = []
     n = sub_B_matrix.shape[0]
-    ising_partition = ['unset' for i in range(n)]
+    # every variable is set below, so no spin is left at 0
+    ising_partition = np.zeros(n, dtype=np.int8)
     for index in sorted(varobject):
         x_val = varobject[index].value
-        s_val = 2 * x_val - 1
-        if s_val < 0:
-            s_val = -1
-        else:
-            s_val = 1
-        assert s_val != 0
-        ising_partition[index] = s_val
+        ising_partition[index] = -1 if 2 * x_val - 1 < 0 else 1
 
     return energy, ising_partition
 
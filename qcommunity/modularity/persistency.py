@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# Roof duality (QPBO) preprocessing for max s^T B s + C^T s
+# Finds spins that take the same value in an optimal solution (persistencies) so they can be stripped from the subproblem before it is sent to an exponential-cost solver
+
+import logging
+from collections import deque
+import numpy as np
+from qcommunity.modularity.modularity_operator import as_dense
+
+
+def _bfs_levels(R, source, eps):
+    level = -np.ones(R.shape[0], dtype=int)
+    level[source] = 0
+    queue = deque([source])
+    while queue:
+        u = queue.popleft()
+        for v in np.nonzero((R[u] > eps) & (level < 0))[0]:
+            level[v] = level[u] + 1
+            queue.append(v)
+    return level
+
+
+def _max_flow(R, source, sink, eps):
+    """
+    Dinic's algorithm on a dense residual capacity matrix R (modified in place)
+    """
+    while True:
+        level = _bfs_levels(R, source, eps)
+        if level[sink] < 0:
+            return R
+        # admissible arcs of the level graph, consumed from the front while looking for augmenting paths
+        arcs = [
+            deque(np.nonzero((R[u] > eps) & (level == level[u] + 1))[0])
+            for u in range(R.shape[0])
+        ]
+        while True:
+            path = [source]
+            while path[-1] != sink:
+                u = path[-1]
+                while arcs[u] and R[u, arcs[u][0]] <= eps:
+                    arcs[u].popleft()
+                if arcs[u]:
+                    path.append(arcs[u][0])
+                elif u == source:
+                    break
+                else:
+                    # dead end, retreat
+                    path.pop()
+                    arcs[path[-1]].popleft()
+            if path[-1] != sink:
+                break
+            edges = (np.array(path[:-1]), np.array(path[1:]))
+            bottleneck = R[edges].min()
+            R[edges] -= bottleneck
+            R[edges[1], edges[0]] += bottleneck
+
+
+def persistent_spins(B, C=None, strong=False):
+    """
+    Finds spins of max s^T B s + C^T s that are fixed by roof duality
+    The problem is written as minimization of a quadratic pseudo-boolean function in x = (s + 1) / 2 and the standard QPBO network (nodes x_i and their complements) is cut with max flow.
+    With strong=False (weak persistency) there is an optimal solution that agrees with all returned spins, so fixing them does not change the optimal value.
+    With strong=True only spins that agree with every optimal solution are returned.
+    :return: indices of fixed spins, their values (-1s and 1s)
+    :rtype: tuple
+    """
+    B = as_dense(B)
+    n_nodes = B.shape[0]
+    if C is None:
+        C = np.zeros(n_nodes)
+    C = np.asarray(C, dtype=np.float64).ravel()
+    # node i is x_i, node n + i is its complement, then source and sink
+    # x_i = 0 (s_i = -1) if i is on the source side
+    source, sink = 2 * n_nodes, 2 * n_nodes + 1
+    R = np.zeros((2 * n_nodes + 2, 2 * n_nodes + 2))
+    p = np.arange(n_nodes)
+    p_bar = p + n_nodes
+
+    # unary terms -C_i s_i, in normal form
+    R[p, sink] += np.maximum(C, 0)
+    R[source, p_bar] += np.maximum(C, 0)
+    R[source, p] += np.maximum(-C, 0)
+    R[p_bar, sink] += np.maximum(-C, 0)
+
+    # pairwise terms -2 B_ij s_i s_j (i < j), in normal form:
+    # B_ij > 0 costs 4 B_ij if x_i != x_j (submodular), B_ij < 0 costs 4 |B_ij| if x_i == x_j
+    W = np.triu(B, 1)
+    i, j = np.nonzero(W > 0)
+    w = 2 * W[i, j]
+    R[i, j] += w
+    R[j, i] += w
+    R[j + n_nodes, i + n_nodes] += w
+    R[i + n_nodes, j + n_nodes] += w
+    i, j = np.nonzero(W < 0)
+    w = -2 * W[i, j]
+    R[i, j + n_nodes] += w
+    R[j, i + n_nodes] += w
+    R[i + n_nodes, j] += w
+    R[j + n_nodes, i] += w
+
+    eps = 1e-12 * max(1.0, R.max())
+    _max_flow(R, source, sink, eps)
+    # smallest source set of a minimum cut
+    in_source = _bfs_levels(R, source, eps) >= 0
+    if strong:
+        # complement of the largest source set: nodes that can reach the sink in the residual graph
+        in_sink = _bfs_levels(R.T, sink, eps) >= 0
+        minus = in_source[p] & in_sink[p_bar]
+        plus = in_source[p_bar] & in_sink[p]
+    else:
+        minus = in_source[p] & ~in_source[p_bar]
+        plus = in_source[p_bar] & ~in_source[p]
+    fixed = np.nonzero(minus | plus)[0]
+    values = np.where(plus[fixed], 1, -1)
+    logging.info("Roof duality fixed {} of {} spins".format(
+        len(fixed), n_nodes))
+    return fixed, values
+
+
+def reduce_subproblem(B, C, fixed, values):
+    """
+    Strips fixed spins from max s^T B s + C^T s
+    :return: indices of free spins, B and C of the residual problem over the free spins
+    :rtype: tuple
+    """
+    B = as_dense(B)
+    C = np.asarray(C, dtype=np.float64).ravel()
+    free = np.setdiff1d(np.arange(B.shape[0]), fixed)
+    C_free = C[free] + 2 * B[np.ix_(free, fixed)].dot(values)
+    return free, B[np.ix_(free, free)], C_free
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+# Pipelined single level refinement: the subproblems are solved asynchronously in worker processes while the main process prepares the next ones
+# While the solvers are busy, the next subsets are selected and their subproblems (B_sub, C) built against the current partition. A finished solver is handed the next prepared subproblem before its result is even looked at.
+# When a result is accepted, prepared subproblems that contain a changed vertex are dropped (their root is released) and the others get C patched for the changed spins. Subproblems already handed to a solver can not be patched, so their results are scored against the partition they come back to, and kept only if they still improve it
+
+import logging
+import queue
+import time
+from multiprocessing import Pool
+from collections import deque
+import numpy as np
+import qcommunity.modularity.graphs as gm
+import qcommunity.modularity.single_level_refinement as slr
+import qcommunity.modularity.telemetry as tm
+
+
+def _prepare(G, B, state, heap, visited, subset_selection, size_of_iteration,
+             taken):
+    """
+    Selects the next subset (disjoint from taken) and builds its subproblem against state
+    :return: candidate (dict) or None if no vertex is available
+    """
+    stats = tm.new_record(0)
+    start = time.time()
+    subset, root = slr.select_subset(G,
+                                     heap,
+                                     visited,
+                                     subset_selection,
+                                     size_of_iteration,
+                                     taken=taken)
+    stats['t_selection'] = time.time() - start
+    if not subset:
+        return None
+    start = time.time()
+    indices = np.array(subset)
+    B_sub = B[np.ix_(indices, indices)]
+    C = gm.compute_subset_bias(B,
+                               state.spins,
+                               indices,
+                               field=state.field,
+                               B_sub=B_sub)
+    stats['t_construction'] = time.time() - start
+    stats['subset_size'] = len(subset)
+    stats['n_subproblems'] = 1
+    return {
+        'subset': subset,
+        'indices': indices,
+        'root': root,
+        'B_sub': B_sub,
+        'C': C,
+        'initial': state.spins[indices],
+        'stats': stats
+    }
+
+
+def pipelined_refinement(G,
+                         B,
+                         state,
+                         heap,
+                         visited,
+                         subset_selection='spectral',
+                         size_of_iteration=12,
+                         stopping_criteria=3,
+                         solver_params=None,
+                         persistency=False,
+                         depth=1,
+                         deadline=None,
+                         target=None,
+                         telemetry_writer=None):
+    """
+    Refines state with up to depth subproblems in flight at any time
+    :param heap: GainHeap of state
+    :param visited: roots used so far, updated in place
+    :param solver_params: keyword arguments of single_level_refinement.solve_subproblem (method, method_params, qaoa_method, backend, backend_params)
+    :param depth: number of worker processes, and of subproblems prepared ahead
+    :param deadline: time.time() after which no more subproblems are dispatched (the ones in flight get the time left as their limit)
+    :param target: stop dispatching once the modularity reaches target (optional)
+    :param telemetry_writer: telemetry.TelemetryWriter the records are written to (optional)
+    :return: final state (the best one, moves are only accepted if they improve it), number of results evaluated, all_modularities, telemetry records
+    :rtype: tuple
+    """
+    if solver_params is None:
+        solver_params = {}
+    n_nodes = G.number_of_nodes()
+    workers = Pool(depth)
+    done = queue.Queue()
+    in_flight = 0
+    prepared = deque()
+    # vertices of the subproblems in flight, by candidate
+    flying = {}
+    it = 0
+    it_stuck = 0
+    n_dropped = 0
+    all_modularities = []
+    telemetry_records = []
+    stopping = False
+
+    def taken():
+        res = set()
+        for cand in prepared:
+            res.update(cand['subset'])
+        for subset in flying.values():
+            res.update(subset)
+        return res
+
+    def dispatch(cand):
+        time_limit = None
+        if deadline is not None:
+            time_limit = max(0.0, deadline - time.time())
+            cand['stats']['solver_time_limit'] = time_limit
+        flying[id(cand)] = cand['subset']
+        task = (cand['B_sub'], cand['C'], cand['initial'], persistency,
+                dict(solver_params, pool=None, time_limit=time_limit))
+        workers.apply_async(slr.reduce_and_solve_subproblem_wrapper, (task, ),
+                            callback=lambda res, cand=cand: done.put(
+                                (cand, res, None)),
+                            error_callback=lambda e, cand=cand: done.put(
+                                (cand, None, e)))
+
+    def release(cand):
+        # root of a dropped candidate can be picked again
+        if cand['root'] is not None:
+            visited.discard(cand['root'])
+            if subset_selection == 'spectral':
+                heap.unmask(cand['root'])
+
+    try:
+        while True:
+            if not stopping:
+                if deadline is not None and time.time() > deadline:
+                    print("Time budget exhausted at iteration {}".format(it))
+                    stopping = True
+                elif target is not None and state.modularity >= target:
+                    logging.info(
+                        "Found really good solution at iter {}, exiting".
+                        format(it))
+                    stopping = True
+            if stopping:
+                for cand in prepared:
+                    release(cand)
+                prepared.clear()
+            # speculative preparation while the solvers are busy
+            while not stopping and len(prepared) < depth and done.empty(
+            ) and len(visited) < n_nodes:
+                cand = _prepare(G, B, state, heap, visited, subset_selection,
+                                size_of_iteration, taken())
+                if cand is None:
+                    break
+                prepared.append(cand)
+                if in_flight < depth:
+                    dispatch(prepared.popleft())
+                    in_flight += 1
+            if in_flight == 0:
+                break
+
+            cand, res, error = done.get()
+            in_flight -= 1
+            del flying[id(cand)]
+            if error is not None:
+                raise error
+            # keep the freed solver busy before doing any bookkeeping
+            if prepared and not stopping:
+                dispatch(prepared.popleft())
+                in_flight += 1
+
+            it += 1
+            stats = cand['stats']
+            stats['it'] = it
+            stats[
+                'time_remaining'] = -1.0 if deadline is None else deadline - time.time(
+                )
+            solution, subproblem_stats = res
+            for key, value in subproblem_stats.items():
+                stats[key] = stats.get(key, 0) + value
+            start = time.time()
+            cand_state = state.copy()
+            cand_state.apply(cand['indices'], solution)
+            stats['t_gains'] = cand_state.t_gains - state.t_gains
+            stats['t_evaluation'] = time.time() - start - stats['t_gains']
+            cand_modularity = cand_state.modularity
+            print('it', it, 'cand_modularity', cand_modularity, 'curr_best',
+                  state.modularity)
+            all_modularities.append({
+                'it': it,
+                'cand_modularity': cand_modularity,
+                'curr_best': state.modularity
+            })
+            stats['gain'] = cand_modularity - state.modularity
+            stats['accepted'] = bool(cand_modularity > state.modularity)
+            if cand_modularity > state.modularity:
+                changed = cand['indices'][state.spins[cand['indices']] !=
+                                          cand_state.spins[cand['indices']]]
+                delta = -2.0 * state.spins[changed]
+                start = time.time()
+                heap.update(changed, cand_state)
+                stats['t_gains'] += time.time() - start
+                state = cand_state
+                it_stuck = 0
+                # drop or patch the subproblems prepared against the old partition
+                kept = deque()
+                for other in prepared:
+                    if np.intersect1d(other['indices'], changed).size:
+                        release(other)
+                        n_dropped += 1
+                        continue
+                    other['C'] = other['C'] + 2 * np.asarray(B[np.ix_(
+                        other['indices'], changed)]).dot(delta)
+                    kept.append(other)
+                prepared = kept
+            else:
+                it_stuck += 1
+                if it_stuck > stopping_criteria and not stopping:
+                    logging.info("Exiting at iteration {}".format(it))
+                    stopping = True
+            telemetry_records.append(stats)
+            if telemetry_writer is not None:
+                telemetry_writer.write(stats)
+    finally:
+        workers.terminate()
+        workers.join()
+    logging.info(
+        "Pipelined refinement: {} results, {} prepared subproblems dropped".
+        format(it, n_dropped))
+    return state, it, all_modularities, telemetry_records
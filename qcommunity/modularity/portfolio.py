@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# Multi-start portfolio of single level refinements on one host
+# K instances with different seeds and subset selection methods run in a process pool and share the best solution found so far (the incumbent) through shared memory.
+# An instance that is stuck below the incumbent restarts from it; the portfolio stops once enough instances have reached the incumbent value on their own (consensus)
+
+import logging
+import multiprocessing
+import time
+from multiprocessing import Pool
+import numpy as np
+
+# the incumbent of the current worker process, set by the pool initializer
+_worker_incumbent = None
+
+
+class SharedIncumbent:
+    """
+    Best modularity and partition shared by the instances of a portfolio
+    Has to be created before the pool and handed to the workers through the pool initializer (inheritance); each instance then works through instance(i)
+    """
+
+    def __init__(self, n_nodes, n_instances, consensus=None, restart_after=1):
+        """
+        :param consensus: number of instances that have to reach the incumbent value independently for the portfolio to stop; default is a majority, None or 0 disables early stopping
+        :param restart_after: number of iterations without improvement after which an instance below the incumbent restarts from it
+        """
+        if consensus is None and n_instances > 1:
+            consensus = n_instances // 2 + 1
+        self.consensus = consensus
+        self.restart_after = restart_after
+        self.lock = multiprocessing.Lock()
+        self._modularity = multiprocessing.RawValue('d', -float('inf'))
+        self._spins = multiprocessing.RawArray('b', n_nodes)
+        # agree[i] is set if instance i found the current incumbent value itself (adopting it in a restart does not count)
+        self._agree = multiprocessing.RawArray('b', n_instances)
+        self._stop = multiprocessing.RawValue('b', 0)
+        self._restarts = multiprocessing.RawArray('i', n_instances)
+        self.index = None
+
+    def instance(self, index):
+        """
+        View of the incumbent used by instance index
+        """
+        view = SharedIncumbent.__new__(SharedIncumbent)
+        view.__dict__.update(self.__dict__)
+        view.index = index
+        return view
+
+    def _tolerance(self, modularity):
+        return 1e-9 * max(1.0, abs(modularity))
+
+    def publish(self, modularity, spins):
+        """
+        Offers the best solution of this instance
+        """
+        with self.lock:
+            best = self._modularity.value
+            tolerance = self._tolerance(modularity)
+            if modularity > best + tolerance:
+                self._modularity.value = modularity
+                np.frombuffer(self._spins, dtype=np.int8)[:] = spins
+                np.frombuffer(self._agree, dtype=np.int8)[:] = 0
+                self._agree[self.index] = 1
+            elif modularity >= best - tolerance:
+                self._agree[self.index] = 1
+            if self.consensus and sum(self._agree) >= self.consensus:
+                self._stop.value = 1
+
+    def get(self):
+        """
+        :return: incumbent modularity, incumbent partition (copy)
+        :rtype: tuple
+        """
+        with self.lock:
+            return (self._modularity.value,
+                    np.frombuffer(self._spins, dtype=np.int8).copy())
+
+    def restart_from(self, curr_modularity, it_stuck):
+        """
+        Incumbent to restart from if this instance is lagging behind it, None otherwise
+        :return: incumbent modularity, incumbent partition, or None
+        """
+        if it_stuck < self.restart_after:
+            return None
+        modularity, spins = self.get()
+        if modularity <= curr_modularity + self._tolerance(curr_modularity):
+            return None
+        self._restarts[self.index] += 1
+        return modularity, spins
+
+    def should_stop(self):
+        return self._stop.value != 0
+
+    @property
+    def n_restarts(self):
+        return list(self._restarts)
+
+
+def _init_worker(incumbent):
+    global _worker_incumbent
+    _worker_incumbent = incumbent
+
+
+def _run_instance(args):
+    import qcommunity.modularity.single_level_refinement as slr
+    index, G, seed, subset_selection, params = args
+    start = time.time()
+    best_modularity, best_solution, it, all_modularities, telemetry = slr.single_level_optimize_modularity(
+        G,
+        random_seed=seed,
+        subset_selection=subset_selection,
+        incumbent=_worker_incumbent.instance(index),
+        return_telemetry=True,
+        **params)
+    return {
+        'instance': index,
+        'seed': seed,
+        'subset_selection': subset_selection,
+        'best_modularity': best_modularity,
+        'best_solution': best_solution,
+        'n_iter': it,
+        'all_modularities': all_modularities,
+        'telemetry': telemetry,
+        'time': time.time() - start
+    }
+
+
+def portfolio_optimize_modularity(G,
+                                  n_instances=None,
+                                  random_seed=42,
+                                  seeds=None,
+                                  strategies=('spectral', 'bfs', 'top_gain'),
+                                  consensus=None,
+                                  restart_after=1,
+                                  processes=None,
+                                  time_budget=None,
+                                  **params):
+    """
+    Runs n_instances single level refinements concurrently, sharing the incumbent
+    Instance i uses seeds[i] (default random_seed + i) and subset selection strategies[i % len(strategies)]; the remaining parameters are passed to single_level_optimize_modularity
+    :param processes: size of the process pool (default: n_instances, at most the number of cores)
+    :param time_budget: wall-clock budget in seconds shared by all instances
+    :return: best modularity, best bitstring (-1s and 1s), list of per-instance results (dicts)
+    :rtype: tuple
+    """
+    if n_instances is None:
+        n_instances = len(seeds) if seeds is not None else min(
+            multiprocessing.cpu_count(), 16)
+    if seeds is None:
+        seeds = [
+            None if random_seed is None else random_seed + i
+            for i in range(n_instances)
+        ]
+    if len(seeds) != n_instances:
+        raise ValueError("Got {} seeds for {} instances".format(
+            len(seeds), n_instances))
+    for key in ['checkpoint', 'resume', 'telemetry']:
+        if params.get(key):
+            raise ValueError(
+                "{} is not supported in portfolio mode".format(key))
+    if params.get('parallel_subproblems', 1) > 1:
+        # pool workers can not fork their own pools
+        raise ValueError(
+            "parallel_subproblems is not supported in portfolio mode")
+    if params.get('qaoa_method') == 'libensemble':
+        raise ValueError("libensemble is not supported in portfolio mode")
+    if time_budget is not None:
+        deadline = time.time() + time_budget
+        if params.get('deadline') is not None:
+            deadline = min(deadline, params['deadline'])
+        params['deadline'] = deadline
+    if processes is None:
+        processes = min(n_instances, multiprocessing.cpu_count())
+    incumbent = SharedIncumbent(G.number_of_nodes(),
+                                n_instances,
+                                consensus=consensus,
+                                restart_after=restart_after)
+    tasks = [(i, G, seeds[i], strategies[i % len(strategies)], params)
+             for i in range(n_instances)]
+    logging.info("Running a portfolio of {} instances on {} processes".format(
+        n_instances, processes))
+    workers = Pool(processes, initializer=_init_worker, initargs=(incumbent, ))
+    try:
+        results = workers.map(_run_instance, tasks, chunksize=1)
+    finally:
+        workers.close()
+        workers.join()
+    for res, n_restarts in zip(results, incumbent.n_restarts):
+        res['n_restarts'] = n_restarts
+    best = max(results, key=lambda res: res['best_modularity'])
+    if incumbent.should_stop():
+        print("Portfolio stopped on consensus of {} instances".format(
+            incumbent.consensus))
+    return best['best_modularity'], best['best_solution'], results
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+# Community detection into k communities by recursive bisection
+# Every community g is split with single level refinement on its generalized modularity matrix B^(g) (ModularityOperator.generalized), a view over the modularity matrix of the whole graph, so s^T B^(g) s is exactly the change of modularity of the whole partition. Splits that do not increase the modularity are rejected and the community is final.
+# The communities of one round are split concurrently in a process pool; the accepted halves are split in the next round
+
+# Example:
+# ./recursive_bisection.py --pajek data/graphs/random_modular_graph_2000_12_2_q_0.45.p --communities 8 --subset top_gain
+
+import logging
+import argparse
+import multiprocessing
+from multiprocessing import Pool
+import numpy as np
+from qcommunity.modularity.modularity_operator import ModularityOperator, SparseGraph
+
+
+def labels_modularity(B, labels):
+    """
+    Modularity of a partition into any number of communities, in the units of s^T B s for two communities (divide by 4m to normalize)
+    :param B: ModularityOperator of the graph
+    :param labels: community of every vertex
+    :rtype: float
+    """
+    labels = np.asarray(labels)
+    rows = np.repeat(np.arange(B.shape[0]), np.diff(B.A.indptr))
+    inside = B.A.data[labels[rows] == labels[B.A.indices]].sum()
+    volumes = np.bincount(labels, weights=B.k)
+    return float(2 * (inside - volumes.dot(volumes) / B.two_m))
+
+
+def bisect(B_g,
+           random_seed=42,
+           subset_selection='spectral',
+           **refinement_params):
+    """
+    Splits a community in two
+    :param B_g: generalized modularity matrix of the community (see ModularityOperator.generalized)
+    :param refinement_params: passed to single_level_optimize_modularity
+    :return: gain in modularity (s^T B_g s), spins of the community (-1s and 1s)
+    :rtype: tuple
+    """
+    import qcommunity.modularity.single_level_refinement as slr
+    graph = SparseGraph(B_g)
+    if subset_selection == 'spectral' and B_g.shape[0] > 2:
+        # modularity (rather than Laplacian) spectral ordering of the community
+        np.random.seed(random_seed)
+        _, eigenvector = B_g.leading_eigenvector()
+        ordering = np.argsort(eigenvector, kind='stable')
+        position = np.empty(len(ordering), dtype=int)
+        position[ordering] = np.arange(len(ordering))
+        slr._spectral_orderings[graph] = (ordering, position)
+    gain, spins, _, _ = slr.single_level_optimize_modularity(
+        graph,
+        random_seed=random_seed,
+        subset_selection=subset_selection,
+        **refinement_params)
+    return gain, np.array(spins, dtype=np.int8)
+
+
+def bisect_wrapper(args):
+    # Pool.map passes a single argument
+    B_g, params = args
+    return bisect(B_g, **params)
+
+
+def recursive_bisection(G,
+                        n_communities=None,
+                        random_seed=42,
+                        processes=None,
+                        min_gain=1e-9,
+                        **refinement_params):
+    """
+    Splits G into communities by recursive bisection
+    :param G: NetworkX graph (nodes 0..n-1)
+    :param n_communities: maximum number of communities (None to split as long as the modularity increases); when a round offers more splits than allowed, the ones with the largest gains are accepted
+    :param random_seed: the i-th split attempted uses seed random_seed + i
+    :param processes: size of the process pool (default: number of cores)
+    :param min_gain: splits that increase the modularity (s^T B s units) by at most this are rejected
+    :param refinement_params: passed to single_level_optimize_modularity for every split
+    :return: modularity (s^T B s units, divide by 4m to normalize), community of every vertex, number of splits rejected
+    :rtype: tuple
+    """
+    for key in [
+            'checkpoint', 'resume', 'telemetry', 'incumbent', 'comm',
+            'pipeline', 'initial_solution', 'solution_bitstring'
+    ]:
+        if refinement_params.get(key):
+            raise ValueError(
+                "{} is not supported by recursive bisection".format(key))
+    if refinement_params.get('parallel_subproblems', 1) > 1:
+        # pool workers can not fork their own pools
+        raise ValueError(
+            "parallel_subproblems is not supported by recursive bisection")
+    if refinement_params.get('qaoa_method') == 'libensemble':
+        raise ValueError("libensemble is not supported by recursive bisection")
+    if n_communities is not None and n_communities < 1:
+        raise ValueError(
+            "Invalid number of communities: {}".format(n_communities))
+    B = ModularityOperator.from_graph(G,
+                                      nodelist=sorted(G.nodes()),
+                                      weight='weight')
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    labels = np.zeros(B.shape[0], dtype=int)
+    pending = [np.arange(B.shape[0])]
+    n_created = 1
+    n_tasks = 0
+    n_final = 0
+    n_rejected = 0
+    modularity = 0.0
+    workers = Pool(processes)
+    try:
+        while pending and (n_communities is None or
+                           n_final + len(pending) < n_communities):
+            tasks = []
+            for nodes in pending:
+                params = dict(
+                    refinement_params,
+                    random_seed=None if random_seed is None else random_seed +
+                    n_tasks)
+                tasks.append((B.generalized(nodes), params))
+                n_tasks += 1
+            results = workers.map(bisect_wrapper, tasks, chunksize=1)
+            splits = []
+            for nodes, (gain, spins) in zip(pending, results):
+                if gain > min_gain and 0 < np.count_nonzero(
+                        spins > 0) < len(nodes):
+                    splits.append((gain, nodes, spins))
+                else:
+                    n_rejected += 1
+                    n_final += 1
+            # largest gains first, in case not all splits are allowed
+            splits.sort(key=lambda split: split[0], reverse=True)
+            pending = []
+            n_current = n_final + len(splits)
+            for gain, nodes, spins in splits:
+                if n_communities is not None and n_current >= n_communities:
+                    n_final += 1
+                    continue
+                n_current += 1
+                labels[nodes[spins > 0]] = n_created
+                modularity += gain
+                for half in (nodes[spins < 0], nodes[spins > 0]):
+                    if len(half) > 1:
+                        pending.append(half)
+                    else:
+                        n_final += 1
+                n_created += 1
+                logging.info(
+                    "Split {} vertices into {} and {}, gain {}".format(
+                        len(nodes), np.count_nonzero(spins < 0),
+                        np.count_nonzero(spins > 0), gain))
+    finally:
+        workers.close()
+        workers.join()
+    # relabel to 0..number of communities - 1
+    _, labels = np.unique(labels, return_inverse=True)
+    return modularity, labels.tolist(), n_rejected
+
+
+if __name__ == "__main__":
+    from qcommunity.utils.import_graph import import_konect, import_pajek, import_edgelist, generate_graph
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-g",
+                        "--graph-generator",
+                        type=str,
+                        default="get_random_partition_graph",
+                        help="graph generator function")
+    parser.add_argument("-l",
+                        type=int,
+                        default=15,
+                        help="number of vtx in the left (first) community")
+    parser.add_argument("-r",
+                        type=int,
+                        default=17,
+                        help="number of vtx in the right (second) community")
+    parser.add_argument("--graph",
+                        type=str,
+                        help="path to KONECT edgelist (out.graphname file)")
+    parser.add_argument("--pajek",
+                        type=str,
+                        help="path to graph in pajek format")
+    parser.add_argument(
+        "--edgelist",
+        type=str,
+        help="path to graph in edgelist format (nx.write_edgelist)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    parser.add_argument(
+        "--communities",
+        type=int,
+        default=None,
+        help=
+        "maximum number of communities (default: split while the modularity increases)"
+    )
+    parser.add_argument("--processes",
+                        type=int,
+                        default=None,
+                        help="size of the process pool")
+    parser.add_argument(
+        "--iter-size",
+        type=int,
+        default=12,
+        help="size of subproblem in each iteration of the refinement")
+    parser.add_argument(
+        "--stopping-criteria",
+        type=int,
+        default=3,
+        help=
+        "number of iterations of no improvement after which the refinement of a split is stopped"
+    )
+    parser.add_argument(
+        "--method",
+        type=str,
+        default='brute',
+        choices=['brute', 'bnb'],
+        help=
+        "subproblem solver (brute is brute force, bnb is exact branch-and-bound)"
+    )
+    parser.add_argument("--subset",
+                        type=str,
+                        default='spectral',
+                        choices=['spectral', 'top_gain', 'bfs'],
+                        help="subset (subproblem) selection method")
+    parser.add_argument("--init",
+                        type=str,
+                        default='random',
+                        choices=['random', 'spectral'],
+                        help="initial guess of every split")
+    parser.add_argument(
+        "--fm-passes",
+        type=int,
+        default=0,
+        help="number of FM local search passes in every split (0 to disable)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.graph:
+        G = import_konect(args.graph)
+    elif args.pajek:
+        G = import_pajek(args.pajek)
+    elif args.edgelist:
+        G = import_edgelist(args.edgelist)
+    else:
+        G, _ = generate_graph(args.graph_generator,
+                              args.l,
+                              args.r,
+                              seed=args.seed)
+    modularity, labels, n_rejected = recursive_bisection(
+        G,
+        n_communities=args.communities,
+        random_seed=args.seed,
+        processes=args.processes,
+        size_of_iteration=args.iter_size,
+        method=args.method,
+        subset_selection=args.subset,
+        stopping_criteria=args.stopping_criteria,
+        init=args.init,
+        fm_passes=args.fm_passes)
+    print(
+        "Found modularity {} with {} communities ({} splits rejected)".format(
+            modularity / (4.0 * G.size(weight='weight')),
+            max(labels) + 1, n_rejected))
@@ -10,6 +10,7 @@
 # ./single_level_refinement.py -g get_random_partition_graph -l 10 -r 15
 # ./single_level_refinement.py --graph /zfs/safrolab/share/dwave_vs_qaoa/graphs/brunson_revolution/out.brunson_revolution_revolution --method brute --iter-size 15 --verbose
 # mpirun -np 4 python -m mpi4py single_level_refinement.py --method qaoa --qaoa-method libensemble --mpi --verbose
+# mpirun -np 4 python -m mpi4py single_level_refinement.py --graph /zfs/safrolab/share/dwave_vs_qaoa/graphs/arenas-jazz/out.arenas-jazz --method brute --mpi --distributed
 #
 # ./single_level_refinement.py --graph /zfs/safrolab/share/dwave_vs_qaoa/graphs/arenas-jazz/out.arenas-jazz --method optimal --verbose --stopping-criteria 3 --seed 0
 
@@ -18,7 +19,6 @@ import numpy as np
 import matplotlib.pyplot as plt
 import sys
 import os.path
-import copy
 import random
 import argparse
 import logging
@@ -28,9 +28,19 @@ import multiprocessing
 from multiprocessing import Pool
 import pickle
 import time
-import progressbar
+import weakref
 import qcommunity.modularity.graphs as gm
 import qcommunity.modularity.optimal as opt
+import qcommunity.modularity.bnb as bnb
+import qcommunity.modularity.persistency as pers
+from qcommunity.modularity.modularity_operator import ModularityOperator
+from qcommunity.modularity.partition import PartitionState
+from qcommunity.modularity.gain_heap import GainHeap
+from qcommunity.modularity.local_search import fm_refine
+from qcommunity.modularity.checkpoint import RefinementCheckpoint
+from qcommunity.modularity.coarsening import hierarchy_key
+import qcommunity.modularity.telemetry as tm
+from qcommunity.modularity.solver_pool import SolverPool
 from qcommunity.utils.import_graph import import_konect, generate_graph, import_pajek, import_edgelist
 
 
@@ -55,109 +65,466 @@ def top_gains_populate_subset(G, subset_size, gains):
     ]
 
 
-def spectral_populate_subset(G, root, subset_size, gains, threshold):
+# spectral orderings computed so far, see get_spectral_ordering
+_spectral_orderings = weakref.WeakKeyDictionary()
+
+
+def get_spectral_ordering(G):
+    """
+    Spectral ordering of G (computed with sparse Lanczos) and the inverse permutation (position of every node in the ordering)
+    Computed once per graph and reused across iterations, seeds and levels, so G should not be modified afterwards
+    :rtype: tuple
+    """
+    if G not in _spectral_orderings:
+        ordering = np.array(nx.spectral_ordering(G, method='lanczos'))
+        position = np.empty(len(ordering), dtype=int)
+        position[ordering] = np.arange(len(ordering))
+        logging.info("Ordering: {}".format(ordering))
+        _spectral_orderings[G] = (ordering, position)
+    return _spectral_orderings[G]
+
+
+def spectral_populate_subset(G, root, subset_size, gains, threshold,
+                             taken=None):
     if G.number_of_nodes() <= subset_size:
         return list(G.nodes())
-    ordering = nx.spectral_ordering(G)
-    logging.info("Ordering: {}, root: {}, threshold: {}".format(
-        ordering, root, threshold))
-    left_it = ordering.index(root) - 1
+    ordering, position = get_spectral_ordering(G)
+    logging.info("Root: {}, threshold: {}".format(root, threshold))
+    left_it = position[root] - 1
     right_it = left_it + 2
     res_subset = {root}
     while len(res_subset) < subset_size:
         # move two pointers and add encountered vertices if the gain is larger than threshold
+        exhausted = 0
         try:
-            left_cand = ordering[left_it]
-            if gains[left_cand] >= threshold:
+            left_cand = int(ordering[left_it])
+            if gains[left_cand] >= threshold and (taken is None or
+                                                  left_cand not in taken):
                 res_subset.add(left_cand)
                 logging.info("Adding ordering[{}]={} with gain {}".format(
                     left_it, left_cand, gains[left_cand]))
             left_it -= 1
         except IndexError:
-            pass
+            exhausted += 1
         try:
-            right_cand = ordering[right_it]
-            if gains[right_cand] >= threshold:
+            right_cand = int(ordering[right_it])
+            if gains[right_cand] >= threshold and (taken is None or
+                                                   right_cand not in taken):
                 res_subset.add(right_cand)
                 logging.info("Adding ordering[{}]={} with gain {}".format(
                     right_it, right_cand, gains[right_cand]))
             right_it += 1
         except IndexError:
-            pass
+            exhausted += 1
+        if exhausted == 2:
+            # not enough vertices above the threshold
+            break
     return list(res_subset)
 
 
-def iteration_step(G,
-                   B,
-                   curr_solution,
-                   subset,
-                   method='brute',
-                   method_params=None,
-                   qaoa_method='bayes',
-                   backend='IBMQX',
-                   backend_params={
-                       'backend_device': None,
-                       'depth': 3
-                   }):
-    # subset should be a list
+def largest_gains(gains, count, excluded=None):
+    """
+    Vertices with the largest gains, in decreasing order of gain (ties go to the smaller vertex)
+    Costs O(n + count log count) with a partial sort
+    :param gains: flip gains indexed by vertex (PartitionState.gains)
+    :param excluded: vertices to leave out (optional)
+    :rtype: numpy.ndarray
+    """
+    gains = np.asarray(gains, dtype=np.float64)
+    if excluded:
+        gains = gains.copy()
+        gains[list(excluded)] = -np.inf
+    available = np.flatnonzero(gains > -np.inf)
+    if count < len(available):
+        kth = len(available) - count
+        cutoff = np.partition(gains[available], kth)[kth]
+        above = available[gains[available] > cutoff]
+        ties = available[gains[available] == cutoff][:count - len(above)]
+        available = np.concatenate([above, ties])
+    return available[np.lexsort((available, -gains[available]))]
 
-    # indices conversion
-    subset2global = dict((x, subset[x]) for x in range(0, len(subset)))
-    global2subset = dict((subset[x], x) for x in range(0, len(subset)))
 
-    # \Sigma_{i>j\in V_m}B_{ij}s_is_j + \Sigma_{i\in V_m}C_{i}s_i
-    # Coefficients for the second part (C_i)
-    C = [0.0] * len(subset)
-    for i in subset:
-        for j in set(G.nodes()) - set(subset):
-            C[global2subset[i]] += 2 * B[i, j] * curr_solution[j]
-    indices = np.array(subset)  # rows and columns of B to keep for subset
+def select_subset(G,
+                  heap,
+                  visited,
+                  subset_selection,
+                  size_of_iteration,
+                  it=None,
+                  taken=None):
+    """
+    Picks the subproblem for the next iteration
+    :param heap: GainHeap of the current partition
+    :param visited: vertices already used as roots, updated in place
+    :param taken: vertices that can not be included (they belong to another subproblem of the same round)
+    :return: subset (empty if no vertex is available), root added to visited (None if none)
+    :rtype: tuple
+    """
+    if subset_selection == 'spectral':
+        # visited roots are masked in the heap
+        top = heap.largest(1, skip=taken)
+        if not top:
+            return [], None
+        # if stuck, try selecting random vertex to climb out of local optima
+        n = top[0]
+        threshold = heap.threshold() if 0.75 * G.number_of_nodes(
+        ) >= size_of_iteration else heap.gains.min()
+        visited.add(n)
+        heap.mask(n)
+        subset = spectral_populate_subset(G,
+                                          n,
+                                          size_of_iteration,
+                                          heap.gains,
+                                          threshold,
+                                          taken=taken)
+        logging.info(
+            "Iter {}, looking at vertex {} and its neighbors {}, potential gain {}"
+            .format(it, n, subset, heap.gains[n]))
+    elif subset_selection == 'bfs':
+        top = heap.largest(1, skip=taken)
+        if not top:
+            return [], None
+        n = top[0]
+        visited.add(n)
+        subset = bfs_populate_subset(G, n, size_of_iteration)
+        logging.info(
+            "Iter {}, looking at vertex {} and its neighbors {}, potential gain {}"
+            .format(it, n, subset, heap.gains[n]))
+    elif subset_selection == 'top_gain':
+        # same order as top_gains_populate_subset (increasing gain)
+        subset = heap.largest(size_of_iteration, skip=taken)[::-1]
+        n = None
+        logging.info("Iter {}, looking at {}".format(it, subset))
+    else:
+        raise ValueError(
+            "Invalid subset selection method: {}".format(subset_selection))
+    if taken:
+        subset = [v for v in subset if v not in taken]
+    return subset, n
+
+
+def _min_time_limit(a, b):
+    # None is no limit
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def solve_subproblem(B_sub,
+                     C,
+                     initial,
+                     method='brute',
+                     method_params=None,
+                     qaoa_method='bayes',
+                     backend='IBMQX',
+                     backend_params={
+                         'backend_device': None,
+                         'depth': 3
+                     },
+                     pool=None,
+                     stats=None,
+                     time_limit=None,
+                     max_evaluations=None):
+    """
+    Maximizes s^T B_sub s + C^T s with the chosen method
+    :param initial: current assignment of the subproblem (-1s and 1s)
+    :param stats: dictionary to add the statistics reported by the solver to (see telemetry.TELEMETRY_DTYPE, optional)
+    :param time_limit: seconds the solver may use, on top of its own limit (optional). Applied to the time limits of optimal and bnb and as a deadline for brute
+    :param max_evaluations: cap on the number of objective evaluations of the qaoa parameter optimizer (optional)
+    :return: optimized assignment (int8, -1s and 1s)
+    :rtype: numpy.ndarray
+    """
+    n_sub = len(C)
     if method == 'qaoa':
+        # imported here: the module is also used without running its CLI (pipeline, portfolio and distributed workers)
+        import qcommunity.optimization.optimize as qaoa_opt
         if backend_params['backend_device'] is None:
             params = {'init_points': 15, 'n_iter': 15}
         else:
             # running on very expensive device, makes sense to spend more time optimizing parameters
             params = {'init_points': 20, 'n_iter': 80}
+        n_evaluations = params['init_points'] + params['n_iter']
+        if max_evaluations is not None and n_evaluations > max_evaluations:
+            # deadline is close, shrink the optimizer budget proportionally
+            init_points = max(
+                1, params['init_points'] * max_evaluations // n_evaluations)
+            params = {
+                'init_points': init_points,
+                'n_iter': max(1, max_evaluations - init_points)
+            }
+        if stats is not None:
+            stats['solver_evaluated'] = stats.get(
+                'solver_evaluated',
+                0) + params['init_points'] + params['n_iter']
         _, optimized_subset = qaoa_opt.optimize_modularity(
-            len(subset),
-            B[np.ix_(indices, indices)],
+            n_sub,
+            B_sub,
             C,
             params=params,
             method=qaoa_method,
             backend=backend,
             backend_params=backend_params)
         if qaoa_method == 'libensemble':
+            from mpi4py import MPI
             print("rank {} optimized_subset {}".format(
                 MPI.COMM_WORLD.Get_rank(), optimized_subset))
             MPI.COMM_WORLD.Barrier()
     elif method == 'brute':
         # good ol' brute force
         _, optimized_subset = gm.optimize_modularity(
-            len(subset), B[np.ix_(indices, indices)], C)
+            n_sub,
+            B_sub,
+            C,
+            pool=pool,
+            deadline=None if time_limit is None else time.time() + time_limit)
+        if pool is not None and stats is not None:
+            stats['solver_evaluated'] = stats.get('solver_evaluated', 0) + sum(
+                x['evaluated'] for x in pool.chunk_stats)
     elif method == 'dwave':
         _, optimized_subset = dwave_opt.optimize_modularity(
-            len(subset), B[np.ix_(indices, indices)], C,
-            method_params['solver'], method_params['embedding'])
+            n_sub, B_sub, C, method_params['solver'],
+            method_params['embedding'])
     elif method == 'optimal':
         _, optimized_subset = opt.optimize_modularity(
-            len(subset), B[np.ix_(indices, indices)], C,
-            method_params['timelimit'])
+            n_sub, B_sub, C, _min_time_limit(method_params['timelimit'],
+                                             time_limit))
+    elif method == 'bnb':
+        # exact branch-and-bound, warm started from the current assignment of the subset
+        _, optimized_subset = bnb.optimize_modularity(
+            n_sub,
+            B_sub,
+            C,
+            initial=initial,
+            time_limit=_min_time_limit(
+                method_params.get('timelimit') if method_params else None,
+                time_limit),
+            stats=stats)
     else:
         raise ValueError("Invalid method {}".format(method))
-    if 0 in optimized_subset:
-        # assuming optimized_subset is of zeros and ones
-        optimized_subset = [
-            -1 if x == 0 else 1 if x == 1 else 'Error' for x in optimized_subset
-        ]
-    if 'Error' in optimized_subset or len(optimized_subset) != len(subset):
-        raise ValueError(
-            "Incorrect bistring encountered. Only accepts bitstrings containing 0s and 1s or -1s and 1s of the size equal to number of nodes in G. optimized_subset: {}, len(optimized_subset)={}, len(subset)={}"
-            .format(optimized_subset, len(optimized_subset), len(subset)))
-    for i in range(0, len(optimized_subset)):
-        curr_solution[subset2global[i]] = optimized_subset[i]
+    # solvers return either 0s and 1s or -1s and 1s
+    return gm.to_spins(optimized_subset, n_sub)
+
+
+def reduce_and_solve_subproblem(B_sub,
+                                C,
+                                initial,
+                                persistency,
+                                solver_params,
+                                stats=None):
+    """
+    Optionally strips the spins fixed by roof duality, then calls solve_subproblem on the rest
+    :param solver_params: keyword arguments of solve_subproblem
+    :param stats: dictionary to add the time spent in the reduction (t_construction) and in the solver (t_solve) and the solver statistics to (optional)
+    :return: optimized assignment (int8, -1s and 1s)
+    :rtype: numpy.ndarray
+    """
+    if stats is None:
+        stats = {}
+    if not persistency:
+        start = time.time()
+        optimized_subset = solve_subproblem(B_sub,
+                                            C,
+                                            initial,
+                                            stats=stats,
+                                            **solver_params)
+        stats['t_solve'] = stats.get('t_solve', 0.0) + time.time() - start
+        return optimized_subset
+    start = time.time()
+    fixed, fixed_values = pers.persistent_spins(B_sub, C)
+    free, B_free, C_free = pers.reduce_subproblem(B_sub, C, fixed,
+                                                  fixed_values)
+    stats['n_fixed'] = stats.get('n_fixed', 0) + len(fixed)
+    stats['t_construction'] = stats.get('t_construction',
+                                        0.0) + time.time() - start
+    optimized_subset = np.empty(len(initial), dtype=np.int8)
+    optimized_subset[fixed] = fixed_values
+    if len(free):
+        start = time.time()
+        optimized_subset[free] = solve_subproblem(B_free,
+                                                  C_free,
+                                                  np.asarray(initial)[free],
+                                                  stats=stats,
+                                                  **solver_params)
+        stats['t_solve'] = stats.get('t_solve', 0.0) + time.time() - start
+    return optimized_subset
+
+
+# single tuple argument and module level, so that it can be pickled by Pool.map and Pool.apply_async; returns the statistics of the subproblem, as the worker can not update the caller's dictionary
+def reduce_and_solve_subproblem_wrapper(args):
+    stats = {}
+    return reduce_and_solve_subproblem(*args, stats=stats), stats
+
+
+def iteration_step(G,
+                   B,
+                   curr_solution,
+                   subset,
+                   method='brute',
+                   method_params=None,
+                   qaoa_method='bayes',
+                   backend='IBMQX',
+                   backend_params={
+                       'backend_device': None,
+                       'depth': 3
+                   },
+                   pool=None,
+                   persistency=False,
+                   field=None,
+                   stats=None,
+                   time_limit=None,
+                   max_evaluations=None):
+    # subset should be a list, curr_solution an int8 array of -1s and 1s (see graphs.to_spins)
+    # pool is a SolverPool reused across iterations by method 'brute'
+    # persistency strips spins fixed by roof duality before calling the solver
+    # field is B * curr_solution if already known (e.g. PartitionState.field)
+    # stats is a dictionary the phase timings and solver statistics are added to (see telemetry.TELEMETRY_DTYPE)
+    # time_limit and max_evaluations bound the solver, see solve_subproblem
+    if stats is None:
+        stats = {}
+
+    start = time.time()
+    indices = np.array(subset)  # rows and columns of B to keep for subset
+    B_sub = B[np.ix_(indices, indices)]
+    # \Sigma_{i>j\in V_m}B_{ij}s_is_j + \Sigma_{i\in V_m}C_{i}s_i
+    # Coefficients for the second part (C_i)
+    C = gm.compute_subset_bias(B,
+                               curr_solution,
+                               indices,
+                               field=field,
+                               B_sub=B_sub)
+    initial = curr_solution[indices]
+    stats['t_construction'] = stats.get('t_construction',
+                                        0.0) + time.time() - start
+    solver_params = dict(method=method,
+                         method_params=method_params,
+                         qaoa_method=qaoa_method,
+                         backend=backend,
+                         backend_params=backend_params,
+                         pool=pool,
+                         time_limit=time_limit,
+                         max_evaluations=max_evaluations)
+    optimized_subset = reduce_and_solve_subproblem(B_sub,
+                                                   C,
+                                                   initial,
+                                                   persistency,
+                                                   solver_params,
+                                                   stats=stats)
+    curr_solution[indices] = optimized_subset
     return curr_solution
 
 
+def parallel_iteration_step(B,
+                            state,
+                            subsets,
+                            solver_params,
+                            persistency=False,
+                            workers=None,
+                            stats=None):
+    """
+    Solves several disjoint subproblems against the same partition and merges the results
+    Every subproblem sees the other ones at their current assignment, so the proposals are applied greedily (largest individual gain first) and each one is kept only if it still improves the combined modularity
+    :param state: PartitionState of the current partition (not modified)
+    :param subsets: disjoint lists of vertices
+    :param workers: multiprocessing.Pool solving the subproblems (serial if None)
+    :param stats: dictionary to add the phase timings (wall-clock) and the solver statistics summed over the subproblems to (optional)
+    :return: candidate PartitionState, number of accepted subproblems
+    :rtype: tuple
+    """
+    if stats is None:
+        stats = {}
+    start = time.time()
+    tasks = []
+    for subset in subsets:
+        indices = np.array(subset)
+        B_sub = B[np.ix_(indices, indices)]
+        C = gm.compute_subset_bias(B,
+                                   state.spins,
+                                   indices,
+                                   field=state.field,
+                                   B_sub=B_sub)
+        initial = state.spins[indices]
+        tasks.append((B_sub, C, initial, persistency, solver_params))
+    stats['t_construction'] = stats.get('t_construction',
+                                        0.0) + time.time() - start
+    start = time.time()
+    if workers is None:
+        results = [reduce_and_solve_subproblem_wrapper(x) for x in tasks]
+    else:
+        results = workers.map(reduce_and_solve_subproblem_wrapper, tasks)
+    # the reductions run in the workers, so they are counted as solve time
+    stats['t_solve'] = stats.get('t_solve', 0.0) + time.time() - start
+    for _, subproblem_stats in results:
+        for key in ['n_fixed', 'solver_evaluated', 'solver_nodes']:
+            if key in subproblem_stats:
+                stats[key] = stats.get(key, 0) + subproblem_stats[key]
+    results = [optimized_subset for optimized_subset, _ in results]
+
+    start = time.time()
+    t_gains = 0.0
+    proposals = []
+    for subset, optimized_subset in zip(subsets, results):
+        proposal = state.copy()
+        proposal.apply(subset, optimized_subset)
+        t_gains += proposal.t_gains - state.t_gains
+        proposals.append(
+            (proposal.modularity - state.modularity, subset, optimized_subset))
+    proposals.sort(key=itemgetter(0), reverse=True)
+
+    cand_state = state.copy()
+    n_accepted = 0
+    for gain, subset, optimized_subset in proposals:
+        if gain <= 0:
+            break
+        merged = cand_state.copy()
+        merged.apply(subset, optimized_subset)
+        t_gains += merged.t_gains - cand_state.t_gains
+        if merged.modularity > cand_state.modularity:
+            cand_state = merged
+            n_accepted += 1
+    logging.info("Accepted {} of {} parallel subproblems".format(
+        n_accepted, len(subsets)))
+    stats['t_gains'] = stats.get('t_gains', 0.0) + t_gains
+    stats['t_evaluation'] = stats.get('t_evaluation',
+                                      0.0) + time.time() - start - t_gains
+    return cand_state, n_accepted
+
+
+def initial_partition(B, init='random'):
+    """
+    Initial guess for the refinement
+    :param B: ModularityOperator
+    :param init: 'random' (random spins) or 'spectral' (signs of the leading eigenvector of B)
+    :return: spins (-1s and 1s)
+    :rtype: numpy.ndarray
+    """
+    n_nodes = B.shape[0]
+    if init == 'random':
+        return 1 - 2 * np.random.randint(2, size=(n_nodes, ))
+    if init == 'spectral':
+        start = time.time()
+        eigenvalue, eigenvector = B.leading_eigenvector()
+        logging.info("Leading eigenvalue {} computed in {:.3f}s".format(
+            eigenvalue, time.time() - start))
+        return np.where(eigenvector >= 0, 1, -1)
+    raise ValueError("Unknown init: {}".format(init))
+
+
+def polish(state, fm_passes):
+    """
+    Improves state with up to fm_passes passes of FM local search (see local_search.fm_refine)
+    :return: the improved PartitionState (state itself if the search found nothing)
+    """
+    spins, gain, _ = fm_refine(state.B, state.spins, max_passes=fm_passes)
+    if gain <= 0:
+        return state
+    logging.info("Local search gained {}".format(gain))
+    return PartitionState(state.B,
+                          spins,
+                          resync_every=state.resync_every,
+                          diagonal=state.diagonal)
+
+
 # for MPI allreduce
 def opTupleMax(a, b):
     return max(a, b, key=itemgetter(0))
@@ -176,19 +543,119 @@ def single_level_optimize_modularity(G,
                                      backend_params={
                                          'backend_device': None,
                                          'depth': 3
-                                     }):
+                                     },
+                                     persistency=False,
+                                     parallel_subproblems=1,
+                                     checkpoint=None,
+                                     resume=False,
+                                     telemetry=None,
+                                     return_telemetry=False,
+                                     time_budget=None,
+                                     deadline=None,
+                                     incumbent=None,
+                                     comm=None,
+                                     sync_every=1,
+                                     pipeline=0,
+                                     initial_solution=None,
+                                     init='random',
+                                     fm_passes=0,
+                                     solver_pool=None):
+    # parallel_subproblems > 1 solves that many disjoint subproblems per iteration on a process pool
+    # checkpoint is the path of an append-only checkpoint written every iteration; with resume=True an existing one is continued
+    # telemetry is the path of a JSONL (or .csv) file every per-iteration telemetry record is appended to
+    # return_telemetry=True also returns the records as a structured array (dtype telemetry.TELEMETRY_DTYPE)
+    # time_budget (seconds from now) and deadline (time.time() value) stop the refinement and return the best solution found so far; solver time limits are shrunk to the time left
+    # incumbent is the portfolio.SharedIncumbent view of this instance when running as a part of a portfolio (see portfolio.portfolio_optimize_modularity)
+    # comm is an MPI communicator with more than one rank to split the graph between the ranks (see distributed.distributed_optimize_modularity), exchanging boundary spins every sync_every iterations; has to be called on every rank, G and solution_bitstring are only read on rank 0 and the solution is only returned there (None on the other ranks)
+    # initial_solution is the partition to start from (0s and 1s or -1s and 1s, e.g. projected from a coarser level) instead of a random one
+    # init is the initial guess used without initial_solution: 'random' or 'spectral' (signs of the leading eigenvector of the modularity matrix, see initial_partition)
+    # fm_passes > 0 polishes the initial guess and every accepted solution with up to that many passes of FM local search (see local_search.fm_refine)
+    # pipeline > 0 solves that many subproblems asynchronously in worker processes while the next subsets are prepared (see pipeline.pipelined_refinement)
+    # solver_pool is a SolverPool the brute force runs on instead of one started for this run (e.g. shared by the levels of multiscale.cluster); it is left open
+    start_time = time.time()
+    if init not in ('random', 'spectral'):
+        raise ValueError("Unknown init: {}".format(init))
+    if parallel_subproblems > 1 and qaoa_method == 'libensemble':
+        raise ValueError(
+            "parallel_subproblems is not supported with libensemble")
+    if checkpoint is not None and qaoa_method == 'libensemble':
+        raise ValueError("checkpoint is not supported with libensemble")
+    if (time_budget is not None or
+            deadline is not None) and qaoa_method == 'libensemble':
+        # ranks would stop at different iterations
+        raise ValueError(
+            "time_budget and deadline are not supported with libensemble")
+    if pipeline > 0 and (qaoa_method == 'libensemble' or
+                         parallel_subproblems > 1 or checkpoint is not None or
+                         incumbent is not None or fm_passes > 0):
+        raise ValueError(
+            "pipeline is not supported with libensemble, parallel_subproblems, checkpoint, incumbent or fm_passes"
+        )
+    if incumbent is not None and (checkpoint is not None or
+                                  qaoa_method == 'libensemble'):
+        # restarts from the incumbent are not recorded in the checkpoint
+        raise ValueError(
+            "incumbent is not supported with checkpoint or libensemble")
+    run_deadline = deadline
+    if time_budget is not None:
+        run_deadline = _min_time_limit(run_deadline, start_time + time_budget)
+    if comm is not None and comm.Get_size() > 1:
+        if (qaoa_method == 'libensemble' or parallel_subproblems > 1 or
+                checkpoint is not None or incumbent is not None or
+                pipeline > 0 or fm_passes > 0):
+            raise ValueError(
+                "Distributed refinement is not supported with libensemble, parallel_subproblems, checkpoint, incumbent, pipeline or fm_passes"
+            )
+        from qcommunity.modularity.distributed import distributed_optimize_modularity
+        target = None
+        if solution_bitstring is not None:
+            target = 0.95 * gm.compute_modularity(
+                G,
+                ModularityOperator.from_graph(G,
+                                              nodelist=sorted(G.nodes()),
+                                              weight='weight'),
+                gm.to_spins(solution_bitstring, G.number_of_nodes()))
+        best_modularity, best_solution, it, all_modularities, telemetry_records = distributed_optimize_modularity(
+            G,
+            comm,
+            random_seed=random_seed,
+            size_of_iteration=size_of_iteration,
+            subset_selection=subset_selection,
+            stopping_criteria=stopping_criteria,
+            solver_params=dict(method=method,
+                               method_params=method_params,
+                               qaoa_method=qaoa_method,
+                               backend=backend,
+                               backend_params=backend_params),
+            persistency=persistency,
+            sync_every=sync_every,
+            deadline=run_deadline,
+            target=target,
+            telemetry=telemetry,
+            initial_solution=initial_solution,
+            init=init)
+        if best_solution is not None:
+            best_solution = best_solution.tolist()
+        if return_telemetry:
+            return (best_modularity, best_solution, it, all_modularities,
+                    tm.to_array(telemetry_records))
+        return best_modularity, best_solution, it, all_modularities
     np.random.seed(random_seed)
     random.seed(random_seed)
-    B = nx.modularity_matrix(G, nodelist=sorted(G.nodes()), weight='weight')
+    B = ModularityOperator.from_graph(
+        G, nodelist=sorted(G.nodes()), weight='weight')
     if solution_bitstring is not None:
+        solution_bitstring = gm.to_spins(solution_bitstring,
+                                         G.number_of_nodes())
         logging.info("Solution: {}".format(solution_bitstring))
 
-    # random initial guess
-    curr_solution = [
-        1 - 2 * x
-        for x in list(np.random.randint(2, size=(G.number_of_nodes(),)))
-    ]
-    curr_modularity = gm.compute_modularity(G, B, curr_solution)
+    state = PartitionState(
+        B,
+        initial_partition(B, init)
+        if initial_solution is None else initial_solution)
+    if fm_passes > 0:
+        state = polish(state, fm_passes)
+    curr_modularity = state.modularity
     if solution_bitstring is not None:
         optimal_modularity = gm.compute_modularity(G, B, solution_bitstring)
     else:
@@ -197,105 +664,350 @@ def single_level_optimize_modularity(G,
                                                   optimal_modularity))
 
     # We will keep track of all time guess so when we reset after getting stuck in local optima, we don't lose it
-    all_time_best_solution = curr_solution
+    all_time_best_solution = state.spins.copy()
     all_time_best_modularity = curr_modularity
 
     visited = set()
     it = 0
     it_stuck = 0
     all_modularities = []
-    num_cores = min(multiprocessing.cpu_count(), 16)
-    logging.info(
-        "Using {} for subset selection, {} for subset optimization".format(
-            subset_selection, method))
-    while set(G.nodes()) - visited:
-        # if using mpi, sync the best solution at the start of each iteration
+    telemetry_records = []
+    finished = False
+    heap = None
+    ckpt = None
+    pool = None
+    workers = None
+    telemetry_writer = None
+    try:
+        if checkpoint is not None:
+            ckpt = RefinementCheckpoint(checkpoint)
+            run_params = {
+                'n_nodes': G.number_of_nodes(),
+                'n_edges': G.number_of_edges(),
+                # hash of the (weighted) adjacency, so a checkpoint is not resumed on another graph of the same size
+                'graph': hierarchy_key(B),
+                'random_seed': random_seed,
+                'size_of_iteration': size_of_iteration,
+                'method': method,
+                'subset_selection': subset_selection,
+                'stopping_criteria': stopping_criteria,
+                'persistency': persistency,
+                'parallel_subproblems': parallel_subproblems,
+                'method_params': method_params,
+                'qaoa_method': qaoa_method,
+                'backend': backend,
+                'backend_params': backend_params,
+                'time_budget': time_budget,
+                'init': init,
+                'fm_passes': fm_passes
+            }
+            if resume and os.path.isfile(checkpoint):
+                restored = ckpt.restore(run_params)
+                if restored['ordering'] is not None:
+                    ordering = np.asarray(restored['ordering'])
+                    position = np.empty(len(ordering), dtype=int)
+                    position[ordering] = np.arange(len(ordering))
+                    _spectral_orderings[G] = (ordering, position)
+                # the moves are replayed (instead of starting from the final spins) so that the field and the gain heap are bit for bit the ones of an uninterrupted run
+                state = PartitionState(B, restored['initial_spins'])
+                heap = GainHeap(state)
+                for changed in restored['changes']:
+                    state.apply(changed, -state.spins[changed])
+                    heap.update(changed, state)
+                curr_modularity = restored['curr_modularity']
+                all_time_best_solution = restored['best_solution']
+                all_time_best_modularity = restored['best_modularity']
+                visited = restored['visited']
+                it = restored['it']
+                it_stuck = restored['it_stuck']
+                all_modularities = restored['all_modularities']
+                telemetry_records = restored['telemetry']
+                finished = restored['finished']
+                np.random.set_state(restored['np_random_state'])
+                random.setstate(restored['random_state'])
+                print(
+                    "Resumed at iteration {}, curr_modularity {}, curr_best {}"
+                    .format(it, curr_modularity, all_time_best_modularity))
+            else:
+                # computed now (the same random state as on the first iteration) so that a resumed run uses the same ordering
+                ordering = get_spectral_ordering(
+                    G)[0] if subset_selection == 'spectral' else None
+                ckpt.start({
+                    'params': run_params,
+                    'spins': state.spins,
+                    'modularity': curr_modularity,
+                    'ordering': ordering,
+                    'np_random_state': np.random.get_state(),
+                    'random_state': random.getstate()
+                })
+        if heap is None:
+            heap = GainHeap(state)
+        if subset_selection == 'spectral':
+            for v in visited:
+                heap.mask(v)
+        solver_params = dict(method=method,
+                             method_params=method_params,
+                             qaoa_method=qaoa_method,
+                             backend=backend,
+                             backend_params=backend_params)
+        if pipeline > 0:
+            from qcommunity.modularity.pipeline import pipelined_refinement
+            telemetry_writer = tm.TelemetryWriter(
+                telemetry) if telemetry is not None else None
+            state, it, all_modularities, telemetry_records = pipelined_refinement(
+                G,
+                B,
+                state,
+                heap,
+                visited,
+                subset_selection=subset_selection,
+                size_of_iteration=size_of_iteration,
+                stopping_criteria=stopping_criteria,
+                solver_params=solver_params,
+                persistency=persistency,
+                depth=pipeline,
+                deadline=run_deadline,
+                target=0.95 * optimal_modularity,
+                telemetry_writer=telemetry_writer)
+            if telemetry_writer is not None:
+                telemetry_writer.close()
+            if state.modularity > all_time_best_modularity:
+                all_time_best_solution = state.spins.copy()
+                all_time_best_modularity = state.modularity
+            if return_telemetry:
+                return (all_time_best_modularity,
+                        all_time_best_solution.tolist(), it, all_modularities,
+                        tm.to_array(telemetry_records))
+            return (all_time_best_modularity, all_time_best_solution.tolist(),
+                    it, all_modularities)
+        if parallel_subproblems > 1:
+            # each subproblem is solved serially in its own worker
+            workers = Pool(parallel_subproblems)
+        elif method == 'brute' and solver_pool is not None:
+            pool = solver_pool
+        elif method == 'brute' and not multiprocessing.current_process(
+        ).daemon:
+            # brute force workers live for the whole run instead of being forked on every iteration
+            # (not inside a pool worker, e.g. a portfolio instance, which solves serially)
+            pool = SolverPool()
+        telemetry_writer = tm.TelemetryWriter(
+            telemetry) if telemetry is not None else None
+        # measured on previous iterations, used to fit the qaoa optimizer into the time left
+        seconds_per_evaluation = None
         if qaoa_method == 'libensemble':
-            curr_modularity, curr_solution = MPI.COMM_WORLD.allreduce(
-                (all_time_best_modularity, all_time_best_solution),
-                op=opTupleMax)
-        it += 1
-        if it_stuck > stopping_criteria:
-            logging.info("Exiting at iteration {}".format(it))
-            break
+            from mpi4py import MPI
+        logging.info(
+            "Using {} for subset selection, {} for subset optimization".format(
+                subset_selection, method))
+        while not finished and len(visited) < G.number_of_nodes():
+            # if using mpi, sync the best solution at the start of each iteration
+            if qaoa_method == 'libensemble':
+                curr_modularity, curr_solution = MPI.COMM_WORLD.allreduce(
+                    (all_time_best_modularity, all_time_best_solution),
+                    op=opTupleMax)
+                state = PartitionState(B, curr_solution)
+                heap.reset(state)
+            if incumbent is not None:
+                if incumbent.should_stop():
+                    print(
+                        "Portfolio reached consensus, exiting at iteration {}".
+                        format(it))
+                    break
+                restart = incumbent.restart_from(curr_modularity, it_stuck)
+                if restart is not None:
+                    logging.info(
+                        "Restarting from the incumbent {} at iteration {} (curr_modularity {})"
+                        .format(restart[0], it, curr_modularity))
+                    state = PartitionState(B, restart[1])
+                    curr_modularity = state.modularity
+                    heap = GainHeap(state)
+                    visited = set()
+                    it_stuck = 0
+                    if curr_modularity > all_time_best_modularity:
+                        all_time_best_solution = state.spins.copy()
+                        all_time_best_modularity = curr_modularity
+            it += 1
+            if it_stuck > stopping_criteria:
+                logging.info("Exiting at iteration {}".format(it))
+                break
 
-        gains_list = []
-        for v in progressbar.progressbar(G.nodes()):
-            gains_list.append(gm.compute_gain(G, B, curr_solution, v, True))
-        gains = {v: gain for gain, v in gains_list}
-
-        if subset_selection == 'spectral':
-            notvisited_gains = {
-                v: gain for v, gain in gains.items() if v not in visited
-            }
-            # if stuck, try selecting random vertex to climb out of local optima
-            n, curr_gain = max(notvisited_gains.items(), key=itemgetter(1))
-            threshold = np.percentile(
-                list(gains.values()),
-                25) if 0.75 * G.number_of_nodes() >= size_of_iteration else min(
-                    list(gains.values()))
-            visited.add(n)
-            subset = spectral_populate_subset(G, n, size_of_iteration, gains,
-                                              threshold)
-            logging.info(
-                "Iter {}, looking at vertex {} and its neighbors {}, potential gain {}"
-                .format(it, n, subset, curr_gain))
-        elif subset_selection == 'bfs':
-            n, curr_gain = max(gains.items(), key=itemgetter(1))
-            visited.add(n)
-            subset = bfs_populate_subset(G, n, size_of_iteration)
-            logging.info(
-                "Iter {}, looking at vertex {} and its neighbors {}, potential gain {}"
-                .format(it, n, subset, curr_gain))
-        elif subset_selection == 'top_gain':
-            subset = top_gains_populate_subset(G, size_of_iteration, gains)
-            logging.info("Iter {}, looking at {}".format(it, subset))
-        else:
-            raise ValueError(
-                "Invalid subset selection method: {}".format(subset_selection))
-        logging.info("curr_solution:\t{}".format(curr_solution))
-        if logging.getLogger().getEffectiveLevel() >= logging.INFO:
-            subproblem = copy.deepcopy(curr_solution)
-            for v in subset:
-                subproblem[v] = "*"
-            logging.info("Subproblem:\t{}\tcurr_modularity\t{}".format(
-                subproblem, curr_modularity))
-        cand_solution = iteration_step(
-            G,
-            B,
-            copy.deepcopy(curr_solution),
-            list(subset),
-            method=method,
-            method_params=method_params,
-            qaoa_method=qaoa_method,
-            backend=backend,
-            backend_params=backend_params)
-        cand_modularity = gm.compute_modularity(G, B, cand_solution)
-        logging.info("Solution:\t{}\tcand_modularity\t{}".format(
-            cand_solution, cand_modularity))
-        print('it', it, 'cand_modularity', cand_modularity, 'curr_best',
-              all_time_best_modularity)
-        all_modularities.append({
-            'it': it,
-            'cand_modularity': cand_modularity,
-            'curr_best': all_time_best_modularity
-        })
-        if cand_modularity > curr_modularity:
-            curr_solution = cand_solution
-            curr_modularity = cand_modularity
-            it_stuck = 0
-        #    logging.info("New modularity found: {}".format(curr_modularity))
-        else:
-            it_stuck += 1
-        #    logging.info("Ignoring modularity: {}".format(cand_modularity))
-        if curr_modularity > all_time_best_modularity:
-            all_time_best_solution = curr_solution
-            all_time_best_modularity = curr_modularity
-        if all_time_best_modularity >= 0.95 * optimal_modularity:
-            logging.info(
-                "Found really good solution at iter {}, exiting".format(it))
-            break
-    return (all_time_best_modularity, all_time_best_solution, it,
+            stats = tm.new_record(it)
+            stats['time_remaining'] = -1.0
+            if run_deadline is not None:
+                stats['time_remaining'] = run_deadline - time.time()
+                if stats['time_remaining'] <= 0:
+                    print("Time budget exhausted at iteration {}".format(it))
+                    break
+            start = time.time()
+            if parallel_subproblems > 1:
+                # several non-overlapping subproblems per round, solved concurrently
+                subsets = []
+                roots = []
+                taken = set()
+                for _ in range(parallel_subproblems):
+                    subset, root = select_subset(G, heap, visited,
+                                                 subset_selection,
+                                                 size_of_iteration, it, taken)
+                    if root is not None:
+                        roots.append(root)
+                    if not subset:
+                        break
+                    subsets.append(subset)
+                    taken.update(subset)
+                subset = sorted(taken)
+            else:
+                subset, root = select_subset(G, heap, visited,
+                                             subset_selection,
+                                             size_of_iteration, it)
+                roots = [] if root is None else [root]
+            stats['t_selection'] = time.time() - start
+            stats['subset_size'] = len(subset)
+            stats['n_subproblems'] = len(
+                subsets) if parallel_subproblems > 1 else 1
+            time_limit = None
+            max_evaluations = None
+            if run_deadline is not None:
+                time_limit = run_deadline - time.time()
+                if time_limit <= 0:
+                    print("Time budget exhausted at iteration {}".format(it))
+                    break
+                stats['solver_time_limit'] = time_limit
+                if seconds_per_evaluation is not None:
+                    max_evaluations = max(
+                        1, int(time_limit / seconds_per_evaluation))
+            logging.info("curr_solution:\t{}".format(state.spins))
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                subproblem = state.spins.astype(str)
+                subproblem[subset] = "*"
+                logging.info("Subproblem:\t{}\tcurr_modularity\t{}".format(
+                    subproblem, curr_modularity))
+            record = {'it': it}
+            if parallel_subproblems > 1:
+                cand_state, n_accepted = parallel_iteration_step(
+                    B,
+                    state,
+                    subsets,
+                    dict(solver_params,
+                         pool=None,
+                         time_limit=time_limit,
+                         max_evaluations=max_evaluations),
+                    persistency=persistency,
+                    workers=workers,
+                    stats=stats)
+                record['n_subproblems'] = len(subsets)
+                record['n_accepted'] = n_accepted
+            else:
+                cand_solution = iteration_step(G,
+                                               B,
+                                               state.spins.copy(),
+                                               list(subset),
+                                               pool=pool,
+                                               persistency=persistency,
+                                               field=state.field,
+                                               stats=stats,
+                                               time_limit=time_limit,
+                                               max_evaluations=max_evaluations,
+                                               **solver_params)
+                start = time.time()
+                cand_state = state.copy()
+                cand_state.apply(subset, cand_solution[subset])
+                stats['t_gains'] = cand_state.t_gains - state.t_gains
+                stats['t_evaluation'] = time.time(
+                ) - start - stats['t_gains']
+            cand_modularity = cand_state.modularity
+            if method == 'qaoa' and stats['solver_evaluated']:
+                seconds_per_evaluation = stats['t_solve'] / stats[
+                    'solver_evaluated']
+            logging.info("Solution:\t{}\tcand_modularity\t{}".format(
+                cand_state.spins, cand_modularity))
+            print('it', it, 'cand_modularity', cand_modularity, 'curr_best',
+                  all_time_best_modularity)
+            record['cand_modularity'] = cand_modularity
+            record['curr_best'] = all_time_best_modularity
+            all_modularities.append(record)
+            changed = []
+            stats['gain'] = cand_modularity - curr_modularity
+            stats['accepted'] = bool(cand_modularity > curr_modularity)
+            if cand_modularity > curr_modularity:
+                if fm_passes > 0:
+                    start = time.time()
+                    cand_state = polish(cand_state, fm_passes)
+                    cand_modularity = cand_state.modularity
+                    stats['t_local_search'] = time.time() - start
+                    stats['gain'] = cand_modularity - curr_modularity
+                    changed = np.nonzero(state.spins != cand_state.spins)[0]
+                else:
+                    indices = np.asarray(subset, dtype=np.intp)
+                    changed = indices[state.spins[indices] !=
+                                      cand_state.spins[indices]]
+                if ckpt is not None and (fm_passes > 0 or
+                                         parallel_subproblems > 1):
+                    # one apply of the changes, as a resumed run replays them
+                    start = time.time()
+                    cand_state = state.copy()
+                    cand_state.apply(changed, -state.spins[changed])
+                    cand_modularity = cand_state.modularity
+                    stats['gain'] = cand_modularity - curr_modularity
+                    t_gains = cand_state.t_gains - state.t_gains
+                    stats['t_gains'] += t_gains
+                    stats['t_evaluation'] += time.time() - start - t_gains
+                start = time.time()
+                heap.update(changed, cand_state)
+                stats['t_gains'] += time.time() - start
+                state = cand_state
+                curr_modularity = cand_modularity
+                it_stuck = 0
+            #    logging.info("New modularity found: {}".format(curr_modularity))
+            else:
+                it_stuck += 1
+            #    logging.info("Ignoring modularity: {}".format(cand_modularity))
+            best_updated = curr_modularity > all_time_best_modularity
+            if best_updated:
+                all_time_best_solution = state.spins.copy()
+                all_time_best_modularity = curr_modularity
+                if incumbent is not None:
+                    incumbent.publish(all_time_best_modularity,
+                                      all_time_best_solution)
+            telemetry_records.append(stats)
+            if ckpt is not None:
+                ckpt.append({
+                    'it': it,
+                    'it_stuck': it_stuck,
+                    'visited': roots,
+                    'changed': changed,
+                    'curr_modularity': curr_modularity,
+                    'best_updated': best_updated,
+                    'best_modularity': all_time_best_modularity,
+                    'all_modularities': record,
+                    'telemetry': stats,
+                    'np_random_state': np.random.get_state(),
+                    'random_state': random.getstate()
+                })
+            # after the checkpoint, so a resumed run does not write the iteration again
+            if telemetry_writer is not None:
+                telemetry_writer.write(stats)
+            if all_time_best_modularity >= 0.95 * optimal_modularity:
+                logging.info(
+                    "Found really good solution at iter {}, exiting".format(
+                        it))
+                break
+        if ckpt is not None and not finished:
+            ckpt.append({'finished': True, 'it': it})
+    finally:
+        # also when the run fails or is interrupted, so that no workers or open files are left behind
+        if pool is not None and pool is not solver_pool:
+            pool.close()
+        if workers is not None:
+            workers.terminate()
+            workers.join()
+        if ckpt is not None:
+            ckpt.close()
+        if telemetry_writer is not None:
+            telemetry_writer.close()
+    if return_telemetry:
+        return (all_time_best_modularity, all_time_best_solution.tolist(), it,
+                all_modularities, tm.to_array(telemetry_records))
+    return (all_time_best_modularity, all_time_best_solution.tolist(), it,
             all_modularities)
 
 
@@ -345,8 +1057,10 @@ if __name__ == "__main__":
         "--method",
         type=str,
         default='brute',
-        choices=['qaoa', 'brute', 'optimal'],
-        help="method to be used (brute is brute force)")
+        choices=['qaoa', 'brute', 'optimal', 'bnb'],
+        help=
+        "method to be used (brute is brute force, optimal is Gurobi through Pyomo, bnb is exact branch-and-bound)"
+    )
     parser.add_argument(
         "--qaoa-method",
         type=str,
@@ -381,6 +1095,55 @@ if __name__ == "__main__":
         help=
         "subset (subproblem) selection method (spectral is highest gain and its neighbors in spectral ordering, bfs is highest gain and its neighbors in bfs fashion, top_gain is greedy highest gain)"
     )
+    parser.add_argument(
+        "--persistency",
+        help=
+        "fix spins forced by roof duality before sending the subproblem to the solver",
+        action="store_true")
+    parser.add_argument(
+        "--parallel-subproblems",
+        type=int,
+        default=1,
+        help=
+        "number of disjoint subproblems solved concurrently in each iteration")
+    parser.add_argument(
+        "--portfolio",
+        type=int,
+        default=None,
+        help=
+        "run a portfolio of this many refinements (seeds --seed, --seed + 1, ..., subset selection cycling from --subset through spectral, bfs and top_gain) sharing the best solution, instead of a single one"
+    )
+    parser.add_argument(
+        "--portfolio-seeds",
+        type=int,
+        nargs='+',
+        default=None,
+        help="seeds of the portfolio instances (overrides --portfolio)")
+    parser.add_argument(
+        "--pipeline",
+        type=int,
+        default=0,
+        help=
+        "solve this many subproblems asynchronously in worker processes while the next ones are prepared (0 solves them one by one)"
+    )
+    parser.add_argument(
+        "--resume",
+        help=
+        "continue an interrupted run from its checkpoint (the output path, i.e. --label and all the other parameters, has to be the same)",
+        action="store_true")
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=None,
+        help=
+        "wall-clock budget in seconds; when it runs out the best solution found so far is returned (solver time limits shrink as it approaches)"
+    )
+    parser.add_argument(
+        "--telemetry",
+        type=str,
+        help=
+        "path to a JSONL (or .csv) file per-iteration timings and solver statistics are appended to"
+    )
     parser.add_argument(
         "--verbose", help="sets logging level to INFO", action="store_true")
     parser.add_argument(
@@ -397,6 +1160,33 @@ if __name__ == "__main__":
         "--mpi",
         help="use this flag if running with mpi (i.e. with libensemble)",
         action="store_true")
+    parser.add_argument(
+        "--distributed",
+        help=
+        "split the graph between the MPI ranks, each refining its own region (requires --mpi)",
+        action="store_true")
+    parser.add_argument(
+        "--sync-every",
+        type=int,
+        default=1,
+        help=
+        "number of iterations each rank makes between exchanges of the boundary spins (with --distributed)"
+    )
+    parser.add_argument(
+        "--init",
+        type=str,
+        default='random',
+        choices=['random', 'spectral'],
+        help=
+        "initial guess: random spins, or signs of the leading eigenvector of the modularity matrix"
+    )
+    parser.add_argument(
+        "--fm-passes",
+        type=int,
+        default=0,
+        help=
+        "number of FM local search passes polishing the initial guess and every accepted solution (0 to disable)"
+    )
     args = parser.parse_args()
 
     if args.verbose:
@@ -405,8 +1195,34 @@ if __name__ == "__main__":
     if args.qaoa_method == 'libensemble' and not args.mpi:
         raise ValueError(
             'Have to use --mpi flag when running with libensemble!')
+    if args.resume and not args.label:
+        raise ValueError(
+            'Have to use --label with --resume to find the checkpoint!')
+    portfolio = args.portfolio is not None or args.portfolio_seeds is not None
+    if portfolio and (args.resume or args.mpi or args.telemetry or
+                      args.parallel_subproblems > 1):
+        raise ValueError(
+            'Portfolio mode can not be used with --resume, --mpi, --telemetry or --parallel-subproblems!'
+        )
+
+    if args.distributed and (not args.mpi or args.qaoa_method == 'libensemble'
+                             or portfolio or args.resume or
+                             args.parallel_subproblems > 1):
+        raise ValueError(
+            'Have to use --mpi with --distributed, and it can not be combined with libensemble, --portfolio, --resume or --parallel-subproblems!'
+        )
+
+    if args.pipeline > 0 and (args.distributed or portfolio or args.resume or
+                              args.parallel_subproblems > 1):
+        raise ValueError(
+            'Can not use --pipeline with --distributed, --portfolio, --resume or --parallel-subproblems!'
+        )
 
-    main_proc = True
+    if args.mpi:
+        from mpi4py import MPI
+        main_proc = MPI.COMM_WORLD.Get_rank() == 0
+    else:
+        main_proc = True
 
     method_params = {
     }  # used to pass extra parameters to subproblem solver, like embedding for dwave. Dictionary.
@@ -429,28 +1245,29 @@ if __name__ == "__main__":
                     os.path.basename(args.graph), args.seed))
             sys.exit(0)
 
-    if args.method == 'qaoa':
-        import qcommunity.optimization.optimize as qaoa_opt
-    elif args.method == 'optimal':
+    if args.method == 'optimal':
         method_params['timelimit'] = args.pyomo_timelimit
 
+    # with --distributed only rank 0 holds the graph, the other ranks get their regions from it
+    load_graph = main_proc or not args.distributed
     if args.graph:
         # load from edgelist
-        G = import_konect(args.graph)
+        G = import_konect(args.graph) if load_graph else None
         solution_bitstring = None
         graph_name = os.path.basename(args.graph)
     elif args.pajek:
-        G = import_pajek(args.pajek)
+        G = import_pajek(args.pajek) if load_graph else None
         solution_bitstring = None
         graph_name = os.path.basename(args.pajek)
     elif args.edgelist:
-        G = import_edgelist(args.edgelist)
+        G = import_edgelist(args.edgelist) if load_graph else None
         solution_bitstring = None
         graph_name = os.path.basename(args.edgelist)
     else:
         # generate
         G, solution_bitstring = generate_graph(
-            args.graph_generator, args.l, args.r, seed=args.seed)
+            args.graph_generator, args.l, args.r,
+            seed=args.seed) if load_graph else (None, None)
         graph_name = None
 
     if args.label:
@@ -473,27 +1290,78 @@ if __name__ == "__main__":
               .format(outname))
         sys.exit(1)
 
-    best_found_modularity, best_found_bitstring, it, all_modularities = single_level_optimize_modularity(
-        G,
-        solution_bitstring=solution_bitstring,
-        random_seed=args.seed,
-        size_of_iteration=args.iter_size,
-        method=args.method,
-        subset_selection=args.subset,
-        stopping_criteria=args.stopping_criteria,
-        method_params=method_params,
-        qaoa_method=args.qaoa_method,
-        backend=args.backend,
-        backend_params=backend_params)
+    portfolio_results = None
+    if portfolio:
+        from qcommunity.modularity.portfolio import portfolio_optimize_modularity
+        strategies = ['spectral', 'bfs', 'top_gain']
+        strategies = strategies[strategies.index(
+            args.subset):] + strategies[:strategies.index(args.subset)]
+        checkpoint = None
+        best_found_modularity, best_found_bitstring, portfolio_results = portfolio_optimize_modularity(
+            G,
+            n_instances=args.portfolio,
+            random_seed=args.seed,
+            seeds=args.portfolio_seeds,
+            strategies=strategies,
+            time_budget=args.time_budget,
+            solution_bitstring=solution_bitstring,
+            size_of_iteration=args.iter_size,
+            method=args.method,
+            stopping_criteria=args.stopping_criteria,
+            method_params=method_params,
+            qaoa_method=args.qaoa_method,
+            backend=args.backend,
+            backend_params=backend_params,
+            persistency=args.persistency,
+            init=args.init,
+            fm_passes=args.fm_passes)
+        best_instance = max(portfolio_results,
+                            key=lambda res: res['best_modularity'])
+        it = sum(res['n_iter'] for res in portfolio_results)
+        all_modularities = best_instance['all_modularities']
+        telemetry = best_instance['telemetry']
+        for res in portfolio_results:
+            print(
+                "Instance {} (seed {}, {}): modularity {} after {} iterations, {} restarts"
+                .format(res['instance'], res['seed'], res['subset_selection'],
+                        res['best_modularity'], res['n_iter'],
+                        res['n_restarts']))
+    else:
+        # iteration by iteration checkpoint, removed once the results are saved
+        checkpoint = None if args.qaoa_method == 'libensemble' or args.distributed or args.pipeline > 0 else outname + ".checkpoint"
+        best_found_modularity, best_found_bitstring, it, all_modularities, telemetry = single_level_optimize_modularity(
+            G,
+            solution_bitstring=solution_bitstring,
+            random_seed=args.seed,
+            size_of_iteration=args.iter_size,
+            method=args.method,
+            subset_selection=args.subset,
+            stopping_criteria=args.stopping_criteria,
+            method_params=method_params,
+            qaoa_method=args.qaoa_method,
+            backend=args.backend,
+            backend_params=backend_params,
+            persistency=args.persistency,
+            parallel_subproblems=args.parallel_subproblems,
+            checkpoint=checkpoint,
+            resume=args.resume,
+            telemetry=args.telemetry,
+            return_telemetry=True,
+            time_budget=args.time_budget,
+            comm=MPI.COMM_WORLD if args.distributed else None,
+            sync_every=args.sync_every,
+            pipeline=args.pipeline,
+            init=args.init,
+            fm_passes=args.fm_passes)
     if solution_bitstring is not None:
         optimal_modularity = gm.compute_modularity_c(G, solution_bitstring)
     else:
         optimal_modularity = None
-    print("\n\nFound modularity {} after {} iterations, optimal {}".format(
-        best_found_modularity / (4.0 * G.number_of_edges()), it,
-        optimal_modularity))
 
     if main_proc:
+        print("\n\nFound modularity {} after {} iterations, optimal {}".format(
+            best_found_modularity / (4.0 * G.number_of_edges()), it,
+            optimal_modularity))
         res = {
             'optimal_modularity':
                 optimal_modularity,
@@ -519,6 +1387,12 @@ if __name__ == "__main__":
                 it,
             'all_modularities':
                 all_modularities,
+            'telemetry':
+                telemetry,
+            'portfolio':
+                portfolio_results,
+            'time_budget':
+                args.time_budget,
             'backend':
                 args.backend,
             'backend_params':
@@ -532,3 +1406,5 @@ if __name__ == "__main__":
         }
         pickle.dump(res, open(outname, "wb"))
         print("Dumped pickle to ", outname)
+        if checkpoint is not None and os.path.isfile(checkpoint):
+            os.remove(checkpoint)
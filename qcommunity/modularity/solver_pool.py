@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+# Long-lived pool of brute force workers for repeated subproblem solves
+# Subproblem matrices are passed to the workers through multiprocessing.shared_memory instead of being pickled into every task
+# The exhaustive search is split into many more chunks than workers and scheduled dynamically
+
+import logging
+import math
+import multiprocessing
+import time
+import weakref
+from itertools import product
+from multiprocessing import Pool, resource_tracker, shared_memory
+from operator import itemgetter
+import numpy as np
+import qcommunity.modularity.graphs as gm
+from qcommunity.modularity.modularity_operator import as_dense
+
+# number of chunks per worker the exhaustive search is split into (for load balancing)
+CHUNKS_PER_WORKER = 8
+
+# shared memory blocks attached in the current worker, by name
+_attached_blocks = {}
+
+
+def _attach_shared_block(name):
+    if name not in _attached_blocks:
+        # the block was reallocated by the parent, drop the stale ones
+        for old_name in list(_attached_blocks):
+            _attached_blocks.pop(old_name).close()
+        _attached_blocks[name] = shared_memory.SharedMemory(name=name)
+    return _attached_blocks[name]
+
+
+def _shared_view(buf, n_nodes):
+    """
+    Layout of the shared block: stop flag, B (row major), C
+    """
+    data = np.ndarray((1 + n_nodes * n_nodes + n_nodes, ),
+                      dtype=np.float64,
+                      buffer=buf)
+    return (data[:1], data[1:1 + n_nodes * n_nodes].reshape(n_nodes, n_nodes),
+            data[1 + n_nodes * n_nodes:])
+
+
+def _shared_gray_code_search(args):
+    name, n_nodes, prefix, deadline = args
+    start = time.time()
+    block = _attach_shared_block(name)
+    stop, B, C = _shared_view(block.buf, n_nodes)
+    if stop[0]:
+        return None, None, prefix, 0, time.time() - start
+    # a chunk past the deadline still scores its first block, so every chunk returns a bitstring
+    value, bitstring, n_evaluated = gm._gray_code_search(
+        prefix,
+        B,
+        C,
+        should_stop=lambda: stop[0] != 0 or
+        (deadline is not None and time.time() > deadline))
+    return value, bitstring, prefix, n_evaluated, time.time() - start
+
+
+def _release(pool, block):
+    pool.terminate()
+    if block is not None:
+        block.close()
+        block.unlink()
+
+
+class SolverPool:
+    """
+    Pool of worker processes that stays alive for the whole refinement run
+    Use as a context manager or call close() when done; the workers and the shared memory are also released when the pool is garbage collected or the interpreter exits
+    """
+
+    def __init__(self, num_workers=None):
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self.num_workers = num_workers
+        # per-chunk statistics of the last solve
+        self.chunk_stats = []
+        # workers must share the parent's resource tracker, otherwise each of them would unlink the shared memory on exit
+        resource_tracker.ensure_running()
+        self.pool = Pool(num_workers)
+        self.block = None
+        self._finalizer = weakref.finalize(self, _release, self.pool, None)
+
+    def _share(self, B, C):
+        """
+        Copies B and C into the shared block, growing (reallocating) it if needed
+        """
+        n_nodes = B.shape[0]
+        size = 8 * (1 + n_nodes * n_nodes + n_nodes)
+        if self.block is None or self.block.size < size:
+            self._finalizer.detach()
+            if self.block is not None:
+                self.block.close()
+                self.block.unlink()
+            self.block = shared_memory.SharedMemory(create=True,
+                                                    size=max(size, 8))
+            self._finalizer = weakref.finalize(self, _release, self.pool,
+                                               self.block)
+        stop, B_shared, C_shared = _shared_view(self.block.buf, n_nodes)
+        stop[0] = 0
+        B_shared[:] = B
+        C_shared[:] = C
+
+    def _prefix_len(self, n_nodes):
+        """
+        Number of spins fixed per chunk, so that there are about CHUNKS_PER_WORKER chunks per worker
+        Problems that fit into a single Gray code block are not split
+        """
+        wanted = int(
+            math.ceil(math.log(self.num_workers * CHUNKS_PER_WORKER, 2)))
+        return max(0, min(wanted, n_nodes - 1 - gm.GRAY_CODE_BLOCK_SIZE))
+
+    def optimize_modularity(self,
+                            n_nodes,
+                            B,
+                            C=None,
+                            target=None,
+                            deadline=None):
+        """
+        Same as graphs.optimize_modularity, using the persistent workers
+        Chunks are handed out with imap_unordered, so idle workers pick up the remaining ones
+        :param target: stop all chunks as soon as a bitstring with value >= target is found (optional)
+        :param deadline: time.time() after which the chunks return the best bitstring found so far (the result is then not guaranteed to be optimal, optional)
+        :return: best value, best bitstring (0s and 1s)
+        :rtype: tuple
+        """
+        B = as_dense(B)
+        if C is None:
+            C = np.zeros(n_nodes)
+        C = np.asarray(C, dtype=np.float64).ravel()
+        self._share(B, C)
+        stop, _, _ = _shared_view(self.block.buf, n_nodes)
+        params = [(self.block.name, n_nodes, list(x), deadline)
+                  for x in product([0, 1], repeat=self._prefix_len(n_nodes))]
+        results = []
+        self.chunk_stats = []
+        # always drain the iterator: the shared block is reused by the next call
+        for value, bitstring, prefix, n_evaluated, elapsed in self.pool.imap_unordered(
+                _shared_gray_code_search, params):
+            self.chunk_stats.append({
+                'prefix':
+                prefix,
+                'evaluated':
+                n_evaluated,
+                'time':
+                elapsed,
+                'throughput':
+                n_evaluated / elapsed if elapsed > 0 else 0.0
+            })
+            if bitstring is None:
+                continue
+            results.append((value, bitstring))
+            if target is not None and value >= target:
+                stop[0] = 1
+        throughputs = [x['throughput'] for x in self.chunk_stats]
+        logging.info(
+            "Brute force on {} spins: {} chunks on {} workers, throughput per chunk {:.3g} bitstrings/s (min {:.3g}, max {:.3g})"
+            .format(n_nodes, len(params), self.num_workers,
+                    np.mean(throughputs), min(throughputs), max(throughputs)))
+        return max(results, key=itemgetter(0))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self._finalizer.detach()
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SerialSolver:
+    """
+    Drop-in replacement of SolverPool that searches in the calling process
+    For MPI ranks, which already occupy one core each and should not fork workers
+    """
+
+    def __init__(self):
+        self.num_workers = 1
+        self.chunk_stats = []
+
+    def optimize_modularity(self,
+                            n_nodes,
+                            B,
+                            C=None,
+                            target=None,
+                            deadline=None):
+        """
+        Same as SolverPool.optimize_modularity (target is ignored)
+        :return: best value, best bitstring (0s and 1s)
+        :rtype: tuple
+        """
+        if C is None:
+            C = np.zeros(n_nodes)
+        start = time.time()
+        value, bitstring, n_evaluated = gm._gray_code_search(
+            [],
+            as_dense(B),
+            np.asarray(C, dtype=np.float64).ravel(),
+            should_stop=None
+            if deadline is None else lambda: time.time() > deadline)
+        elapsed = time.time() - start
+        self.chunk_stats = [{
+            'prefix': [],
+            'evaluated':
+            n_evaluated,
+            'time':
+            elapsed,
+            'throughput':
+            n_evaluated / elapsed if elapsed > 0 else 0.0
+        }]
+        return value, bitstring
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
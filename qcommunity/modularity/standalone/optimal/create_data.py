@@ -2,6 +2,7 @@ import networkx as nx
 import random, copy
 import sys, os
 import numpy as np
+from qcommunity.modularity.modularity_operator import ModularityOperator
 
 
 def graph2dat(graph):
@@ -13,15 +14,17 @@ def graph2dat(graph):
     data_var['bias'] = 'param bias := \n'
     data_var['weight'] = 'param w := \n'
 
-    modularity_mat = nx.modularity_matrix(graph, nodelist=sorted(graph.nodes()))
+    modularity_mat = ModularityOperator.from_graph(
+        graph, nodelist=sorted(graph.nodes()))
     n = nx.number_of_nodes(graph)
     for i in range(n - 1):
+        row = modularity_mat.row(i)
         for j in range(i, n):
-            w = -modularity_mat.item((i, j))  # neg value
+            w = -row[j]  # neg value
             data_var['couplers'] += ' '.join([str(i), str(j), '\n'])
             data_var['weight'] += ' '.join([str(i), str(j), str(w), '\n'])
     i, j = n - 1, n - 1
-    w = -modularity_mat.item((i, j))  # neg value
+    w = -modularity_mat[i, j]  # neg value
     data_var['couplers'] += ' '.join([str(i), str(j), '\n'])
     data_var['weight'] += ' '.join([str(i), str(j), str(w), '\n'])
     for i in range(n):
@@ -8,6 +8,7 @@ import numpy as np
 import multiprocessing
 import argparse
 import qcommunity.modularity.graphs as gm
+from qcommunity.modularity.modularity_operator import ModularityOperator
 from qcommunity.modularity.standalone.optimal.create_data import graph2dat
 from qcommunity.utils.import_graph import generate_graph, import_pajek
 
@@ -53,7 +54,7 @@ def get_modularity(graph):
             ising_partition[index] = -1
             part0.append(index)
     #print(ising_partition)
-    mod_matrix = nx.modularity_matrix(graph)
+    mod_matrix = ModularityOperator.from_graph(graph)
     mymod = compute_modularity(graph, mod_matrix, ising_partition)
     res = {
         'unscaled': unscaled,
@@ -77,12 +78,9 @@ def ising_part2file(folder, ising_partition):
 
 
 def compute_modularity(graph, mod_matrix, partition):
-    n = mod_matrix.shape[0]
-    x = np.array(partition).reshape(n, 1)
     scale = 0.25 / nx.number_of_edges(graph)
     #scale = 1
-    mod = x.transpose() * mod_matrix * x
-    return mod.item(0) * scale
+    return mod_matrix.quadratic_form(partition) * scale
 
 
 def data_to_graph(filename):
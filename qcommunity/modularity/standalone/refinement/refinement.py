@@ -24,6 +24,7 @@ from pyomo.environ import *
 sys.path.insert(0, '../Optimal/')
 import minimize_ising_model
 from networkx.utils import reverse_cuthill_mckee_ordering
+import qcommunity.modularity.graphs as gm
 
 #from networkx.algorithms.community.quality import modularity
 
@@ -159,16 +160,9 @@ def get_random_nodes(graph, hardware_size):
 
 def _node_gain(node, mod_matrix, ptn):
     ''' return change in modularity of moving node to new part'''
-    int_deg = 0
-    ext_deg = 0
-    for i in range(mod_matrix.shape[0]):
-        if i != node:
-            if ptn[i] == ptn[node]:
-                int_deg += mod_matrix.item((i, node))
-            else:
-                ext_deg += mod_matrix.item((i, node))
-    #return  -2*int_deg - mod_matrix.item((node, node))
-    return 4 * (ext_deg - int_deg)  # min-cut
+    # same expression as gm.compute_all_gains, restricted to a single row
+    row = np.asarray(mod_matrix[node]).ravel()
+    return 4 * (row[node] - ptn[node] * row.dot(ptn))
 
 
 def verify_gain(node, graph, mod_matrix, ptn):
@@ -181,13 +175,8 @@ def verify_gain(node, graph, mod_matrix, ptn):
 
 def get_top_gain_nodes(graph, mod_matrix, ptn, hardware_size):
     ''' return top gain nodes '''
-    node_gain = []
-    for node in sorted(graph.nodes()):
-        #noise = random.random() * 10**(-5)
-        noise = 0
-        gain = _node_gain(node, mod_matrix, ptn) + noise
-        node_gain.append((gain, node))
-        #gain2 = verify_gain(node, graph, mod_matrix, ptn)
+    gains = gm.compute_all_gains(mod_matrix, ptn)
+    node_gain = [(gains[node], node) for node in sorted(graph.nodes())]
     sort_gain = sorted(node_gain, reverse=True)
 
     #gains = [0.25/nx.number_of_edges(graph)*gain for gain, _ in sort_gain]
@@ -198,10 +187,8 @@ def get_top_gain_nodes(graph, mod_matrix, ptn, hardware_size):
 
 
 def get_top_spectral_gain(graph, mod_matrix, ptn, hardware_size, sp_order):
-    node_gain = []
-    for node in sorted(graph.nodes()):
-        gain = _node_gain(node, mod_matrix, ptn)
-        node_gain.append((gain, node))
+    gains = gm.compute_all_gains(mod_matrix, ptn)
+    node_gain = [(gains[node], node) for node in sorted(graph.nodes())]
     sort_gain = sorted(node_gain, reverse=True)
     #gains = [0.25/nx.number_of_edges(graph)*gain for gain, _ in sort_gain]
     #print gains
@@ -330,10 +317,8 @@ def get_spectral_boundary(graph, mod_matrix, ptn, hardware_size, sp_order):
 
 
 def tg_sp_same_part(graph, mod_matrix, ptn, hardware_size, sp_order):
-    node_gain = []
-    for node in graph.nodes():
-        gain = _node_gain(node, mod_matrix, ptn)
-        node_gain.append((gain, node))
+    gains = gm.compute_all_gains(mod_matrix, ptn)
+    node_gain = [(gains[node], node) for node in graph.nodes()]
     top_node = max(node_gain)[1]
     return spectral_neigh_same_part(top_node, graph, mod_matrix, ptn,
                                     hardware_size, sp_order)
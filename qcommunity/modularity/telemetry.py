@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Per-iteration telemetry of refinement: wall-clock time of every phase, subproblem size, gain and solver statistics
+# Records are streamed to a JSONL or CSV file as they are produced and collected into a NumPy structured array
+
+import csv
+import json
+import numpy as np
+
+# t_gains: updating the flip gains of the candidate (PartitionState.t_gains) and, for an accepted move, re-keying the changed vertices in the gain heap; for distributed regions, computing the gains of the region
+# t_selection: picking the subset(s)
+# t_construction: building B_sub and C (and the roof duality reduction)
+# t_solve: solver call(s)
+# t_evaluation: applying the candidate and computing its modularity (merging, for parallel subproblems), without t_gains
+# solver_evaluated: bitstrings scored by brute force (objective evaluations budgeted for qaoa), solver_nodes: branch-and-bound nodes, n_fixed: spins fixed by roof duality
+# time_remaining: time budget left at the start of the iteration (-1 without a budget), solver_time_limit: time limit given to the solver (0 is none)
+# t_local_search: FM local search polishing an accepted solution (see local_search.py)
+TELEMETRY_DTYPE = np.dtype([('it', np.int32), ('subset_size', np.int32),
+                            ('n_subproblems', np.int16), ('gain', np.float64),
+                            ('accepted', np.bool_), ('t_gains', np.float32),
+                            ('t_selection', np.float32),
+                            ('t_construction', np.float32),
+                            ('t_solve', np.float32),
+                            ('t_evaluation', np.float32),
+                            ('n_fixed', np.int32),
+                            ('solver_evaluated', np.int64),
+                            ('solver_nodes', np.int64),
+                            ('time_remaining', np.float32),
+                            ('solver_time_limit', np.float32),
+                            ('t_local_search', np.float32)])
+
+
+def new_record(it):
+    """
+    Telemetry record of iteration it with all other fields zeroed
+    :rtype: dict
+    """
+    record = {name: TELEMETRY_DTYPE[name].type(0).item()
+              for name in TELEMETRY_DTYPE.names}
+    record['it'] = it
+    return record
+
+
+def to_array(records):
+    """
+    :param records: list of records (see new_record)
+    :rtype: numpy.ndarray with dtype TELEMETRY_DTYPE
+    """
+    return np.array(
+        [tuple(r[name] for name in TELEMETRY_DTYPE.names) for r in records],
+        dtype=TELEMETRY_DTYPE)
+
+
+class TelemetryWriter:
+    """
+    Appends records to a JSONL file, or to a CSV file if the path ends with .csv; every record is flushed as it is written
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.csv = path.endswith('.csv')
+        self.f = open(path, 'a')
+        if self.csv:
+            self.writer = csv.DictWriter(self.f,
+                                         fieldnames=TELEMETRY_DTYPE.names)
+            if self.f.tell() == 0:
+                self.writer.writeheader()
+
+    def write(self, record):
+        if self.csv:
+            self.writer.writerow(record)
+        else:
+            self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
@@ -7,11 +7,11 @@ import networkx as nx
 import numpy as np
 # import matplotlib.pyplot as plt
 from networkx.generators.classic import barbell_graph
-import copy
 import sys
 import warnings
 
 import qcommunity.modularity.graphs as gm
+from qcommunity.modularity.modularity_operator import ModularityOperator
 from qcommunity.utils.import_graph import generate_graph
 from ibmqxbackend.ansatz import IBMQXVarForm
 
@@ -41,14 +41,12 @@ def get_obj(n_nodes,
         if obj_params == 'ndarray':
 
             def obj_val(x):
-                resstrs = var_form.run(x)
-                modularities = [
-                    gm.compute_modularity(n_nodes, B, x, C=C) for x in resstrs
-                ]
+                resstrs = gm.to_spins(var_form.run(x), n_nodes)
+                modularities = gm.compute_modularity_batch(B, resstrs, C=C)
                 y = np.mean(modularities)
                 if return_x:
-                    all_x.append(copy.deepcopy(x))
-                    all_vals.append({'max': max(modularities), 'mean': y})
+                    all_x.append(np.array(x, copy=True))
+                    all_vals.append({'max': np.max(modularities), 'mean': y})
                 print("Actual modularity (to be maximized): {}".format(y))
                 return sign * y
         else:
@@ -75,7 +73,7 @@ def get_obj_val(graph_generator_name,
                 return_x=False):
     # Generate the graph
     G, _ = generate_graph(graph_generator_name, left, right, seed=seed)
-    B = nx.modularity_matrix(G).A
+    B = ModularityOperator.from_graph(G)
     return get_obj(
         G.number_of_nodes(),
         B,
@@ -17,6 +17,7 @@ import pickle
 from operator import itemgetter
 
 import qcommunity.modularity.graphs as gm
+from qcommunity.modularity.modularity_operator import ModularityOperator
 from qcommunity.utils.import_graph import generate_graph
 from ibmqxbackend.ansatz import IBMQXVarForm
 
@@ -37,14 +38,15 @@ def run_angles(n_nodes,
                     angles, backend))
         var_form = IBMQXVarForm(
             num_qubits=n_nodes, depth=backend_params['depth'])
-        resstrs = var_form.run(
-            angles, backend_name=backend_params['backend_device'])
+        resstrs = gm.to_spins(
+            var_form.run(angles,
+                         backend_name=backend_params['backend_device']),
+            n_nodes)
     else:
         raise ValueError("Unsupported backend: {}".format(backend))
-    modularities = [
-        (gm.compute_modularity(n_nodes, B, x, C=C), x) for x in resstrs
-    ]
-    return max(modularities, key=itemgetter(0))
+    modularities = gm.compute_modularity_batch(B, resstrs, C=C)
+    best = int(np.argmax(modularities))
+    return float(modularities[best]), resstrs[best]
 
 
 def test_angles(graph_generator_name,
@@ -69,7 +71,7 @@ def test_angles(graph_generator_name,
     # Use angles
 
     # Using NetworkX modularity matrix
-    B = nx.modularity_matrix(G).A
+    B = ModularityOperator.from_graph(G)
 
     # Compute ideal cost
     if compute_optimal:
@@ -105,8 +107,8 @@ def test_angles(graph_generator_name,
             print("{} : {}".format(k, v))
 
     # Raw results
-    modularities = [gm.compute_modularity(G, B, x) for x in resstrs]
-    mod_max = max(modularities)
+    modularities = gm.compute_modularity_batch(B, resstrs)
+    mod_max = np.max(modularities)
     # Probability of getting best modularity
     if compute_optimal:
         mod_pmax = float(np.sum(np.isclose(
@@ -0,0 +1,48 @@
+import sys
+import types
+import networkx as nx
+import pytest
+import qcommunity.modularity.graphs as gm
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "mpi: runs several MPI ranks with mpirun (deselect with -m 'not mpi')")
+
+
+@pytest.fixture
+def small_graph():
+    """
+    Two dense blocks of 10 vertices with a few edges between them
+    """
+    return nx.convert_node_labels_to_integers(
+        nx.planted_partition_graph(2, 10, 0.8, 0.05, seed=1))
+
+
+@pytest.fixture
+def fake_qaoa(monkeypatch):
+    """
+    Replaces qcommunity.optimization.optimize (which needs qiskit) by an exact solver with the same interface
+    Forked workers inherit the replacement
+    """
+
+    def optimize_modularity(n_nodes,
+                            B,
+                            C=None,
+                            params=None,
+                            method=None,
+                            backend=None,
+                            backend_params=None):
+        return gm.optimize_modularity(n_nodes, B, C)
+
+    module = types.ModuleType('qcommunity.optimization.optimize')
+    module.optimize_modularity = optimize_modularity
+    monkeypatch.setitem(sys.modules, 'qcommunity.optimization.optimize',
+                        module)
+    import qcommunity.optimization
+    monkeypatch.setattr(qcommunity.optimization,
+                        'optimize',
+                        module,
+                        raising=False)
+    return module
@@ -0,0 +1,151 @@
+import json
+import networkx as nx
+import pytest
+import qcommunity.modularity.single_level_refinement as slr
+
+
+def _run(G, path, **params):
+    return slr.single_level_optimize_modularity(G,
+                                                random_seed=1,
+                                                size_of_iteration=6,
+                                                subset_selection='top_gain',
+                                                checkpoint=str(path),
+                                                resume=True,
+                                                **params)
+
+
+def test_resume_same_parameters(small_graph, tmp_path):
+    path = tmp_path / 'run.checkpoint'
+    modularity, solution, it, _ = _run(small_graph, path, fm_passes=1)
+    resumed, resumed_solution, resumed_it, _ = _run(small_graph,
+                                                    path,
+                                                    fm_passes=1)
+    assert resumed == modularity
+    assert resumed_solution == solution
+    assert resumed_it == it
+
+
+@pytest.mark.parametrize('params', [{
+    'init': 'spectral'
+}, {
+    'fm_passes': 2
+}, {
+    'time_budget': 60
+}, {
+    'method_params': {
+        'timelimit': 10
+    }
+}, {
+    'qaoa_method': 'COBYLA'
+}, {
+    'backend': 'IBMQX_noisy'
+}, {
+    'backend_params': {
+        'backend_device': None,
+        'depth': 2
+    }
+}])
+def test_resume_different_parameters(small_graph, tmp_path, params):
+    path = tmp_path / 'run.checkpoint'
+    _run(small_graph, path, fm_passes=1)
+    with pytest.raises(ValueError):
+        _run(small_graph, path, **dict({'fm_passes': 1}, **params))
+
+
+@pytest.mark.parametrize('change', ['edge', 'weight'])
+def test_resume_different_graph(small_graph, tmp_path, change):
+    # same number of nodes (and edges, for a changed edge), different graph
+    path = tmp_path / 'run.checkpoint'
+    _run(small_graph, path)
+    G = nx.Graph(small_graph)
+    u, v = next(iter(G.edges()))
+    if change == 'edge':
+        G.remove_edge(u, v)
+        G.add_edge(*next(e for e in nx.non_edges(G) if e != (u, v)))
+    else:
+        G[u][v]['weight'] = 2.0
+    with pytest.raises(ValueError):
+        _run(G, path)
+
+
+def test_closed_on_error(small_graph, tmp_path, monkeypatch):
+    opened = []
+
+    def recording(init):
+
+        def wrapper(self, path):
+            init(self, path)
+            opened.append(self)
+
+        return wrapper
+
+    for cls in [slr.RefinementCheckpoint, slr.tm.TelemetryWriter]:
+        monkeypatch.setattr(cls, '__init__', recording(cls.__init__))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('solver failed')
+
+    monkeypatch.setattr(slr, 'iteration_step', fail)
+    with pytest.raises(RuntimeError):
+        _run(small_graph,
+             tmp_path / 'run.checkpoint',
+             telemetry=str(tmp_path / 'telemetry.csv'))
+    checkpoint, writer = opened
+    assert checkpoint.f is None
+    assert writer.f.closed
+
+
+@pytest.mark.parametrize('params', [{
+    'subset_selection': 'spectral'
+}, {
+    'subset_selection': 'bfs'
+}, {
+    'subset_selection': 'top_gain'
+}, {
+    'subset_selection': 'spectral',
+    'fm_passes': 1
+}, {
+    'subset_selection': 'top_gain',
+    'parallel_subproblems': 2
+}])
+def test_resume_after_interruption(small_graph, tmp_path, monkeypatch, params):
+
+    def run(name):
+        return slr.single_level_optimize_modularity(
+            small_graph,
+            random_seed=3,
+            size_of_iteration=4,
+            checkpoint=str(tmp_path / '{}.checkpoint'.format(name)),
+            resume=True,
+            telemetry=str(tmp_path / '{}.jsonl'.format(name)),
+            return_telemetry=True,
+            **params)
+
+    expected = run('uninterrupted')
+    assert expected[2] > 3
+    # the solver fails in the fourth iteration
+    step = 'parallel_iteration_step' if 'parallel_subproblems' in params else 'iteration_step'
+    solve = getattr(slr, step)
+    calls = []
+
+    def interrupted(*args, **kwargs):
+        calls.append(None)
+        if len(calls) > 3:
+            raise KeyboardInterrupt()
+        return solve(*args, **kwargs)
+
+    monkeypatch.setattr(slr, step, interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        run('interrupted')
+    monkeypatch.setattr(slr, step, solve)
+    modularity, solution, it, all_modularities, telemetry = run('interrupted')
+    assert modularity == expected[0]
+    assert solution == expected[1]
+    assert it == expected[2]
+    assert all_modularities == expected[3]
+    assert telemetry['subset_size'].tolist(
+    ) == expected[4]['subset_size'].tolist()
+    # every iteration written once
+    with open(tmp_path / 'interrupted.jsonl') as f:
+        written = [json.loads(line)['it'] for line in f]
+    assert written == expected[4]['it'].tolist()
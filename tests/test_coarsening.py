@@ -0,0 +1,83 @@
+import networkx as nx
+import numpy as np
+import pytest
+import qcommunity.modularity.coarsening as coarsening
+from qcommunity.modularity.modularity_operator import ModularityOperator
+
+
+def _graph(seed=1):
+    G = nx.convert_node_labels_to_integers(
+        nx.planted_partition_graph(4, 25, 0.3, 0.02, seed=seed))
+    rng = np.random.RandomState(seed)
+    for u, v in G.edges():
+        G[u][v]['weight'] = float(rng.randint(1, 4))
+    return G
+
+
+def _operator(G):
+    return ModularityOperator.from_graph(G,
+                                         nodelist=sorted(G.nodes()),
+                                         weight='weight')
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_matching(seed):
+    A = _operator(_graph(seed)).A
+    partner = coarsening.match(A, seed=seed)
+    n_nodes = A.shape[0]
+    # an involution pairing only adjacent vertices
+    assert np.array_equal(partner[partner], np.arange(n_nodes))
+    matched = np.nonzero(partner != np.arange(n_nodes))[0]
+    assert len(matched) > 0
+    assert np.all(A[matched, partner[matched]] != 0)
+    aggregate, P = coarsening.aggregation(partner)
+    assert np.array_equal(aggregate[partner], aggregate)
+    assert P.shape == (n_nodes, len(matched) // 2 + n_nodes - len(matched))
+    assert np.array_equal(np.asarray(P.sum(axis=1)).ravel(), np.ones(n_nodes))
+
+
+def test_levels_preserve_weight_and_modularity():
+    hierarchy = coarsening.coarsen(_graph(), coarsest_size=10)
+    assert len(hierarchy) > 2
+    rng = np.random.RandomState(0)
+    for (B, aggregate), (B_coarse, _) in zip(hierarchy, hierarchy[1:]):
+        # P^T A P keeps the total edge weight and the degrees of the merged vertices
+        assert np.isclose(B_coarse.A.sum(), B.A.sum())
+        assert np.allclose(B_coarse.k, np.bincount(aggregate, weights=B.k))
+        assert B_coarse.two_m == B.two_m
+        # projecting a partition keeps its modularity
+        s = rng.choice([-1, 1], B_coarse.shape[0])
+        assert np.isclose(B.quadratic_form(s[aggregate]),
+                          B_coarse.quadratic_form(s))
+
+
+def test_cache_key(tmp_path):
+    G = _graph()
+    key = coarsening.hierarchy_key(_operator(G), coarsest_size=10)
+    assert coarsening.hierarchy_key(_operator(_graph()),
+                                    coarsest_size=10) == key
+    assert coarsening.hierarchy_key(_operator(G), coarsest_size=20) != key
+    u, v = next(iter(G.edges()))
+    H = G.copy()
+    H[u][v]['weight'] += 1
+    assert coarsening.hierarchy_key(_operator(H), coarsest_size=10) != key
+    H = G.copy()
+    H.remove_edge(u, v)
+    x, y = next(e for e in nx.non_edges(H) if set(e) != {u, v})
+    H.add_edge(x, y, weight=G[u][v]['weight'])
+    assert coarsening.hierarchy_key(_operator(H), coarsest_size=10) != key
+    # a changed graph is coarsened again instead of being read from the cache
+    hierarchy, _, path = coarsening.load_or_coarsen(G,
+                                                    cache_dir=str(tmp_path),
+                                                    coarsest_size=10)
+    cached, _, cached_path = coarsening.load_or_coarsen(
+        G, cache_dir=str(tmp_path), coarsest_size=10)
+    assert cached_path == path
+    assert len(cached) == len(hierarchy)
+    for (B, aggregate), (B_cached, aggregate_cached) in zip(hierarchy, cached):
+        assert (B.A != B_cached.A).nnz == 0
+        assert np.array_equal(aggregate, aggregate_cached)
+    _, _, other_path = coarsening.load_or_coarsen(H,
+                                                  cache_dir=str(tmp_path),
+                                                  coarsest_size=10)
+    assert other_path != path
@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import networkx as nx
+import numpy as np
+import pytest
+import qcommunity.modularity.distributed as distributed
+import qcommunity.modularity.single_level_refinement as slr
+from qcommunity.modularity.modularity_operator import ModularityOperator
+
+# run on every rank by test_ranks, prints the result on rank 0
+RANKS_SCRIPT = '''
+import json, sys
+import networkx as nx
+from mpi4py import MPI
+import qcommunity.modularity.distributed as distributed
+
+hand_overs = []
+hand_over = distributed.Region.hand_over
+
+
+def counting(self, target, spins):
+    hand_overs.append(None)
+    return hand_over(self, target, spins)
+
+
+distributed.Region.hand_over = counting
+comm = MPI.COMM_WORLD
+seed = int(sys.argv[1])
+G = nx.convert_node_labels_to_integers(
+    nx.planted_partition_graph(2, 16, 0.6, 0.05,
+                               seed=seed)) if comm.Get_rank() == 0 else None
+modularity, solution, it, _, _ = distributed.distributed_optimize_modularity(
+    G, comm, random_seed=seed, size_of_iteration=4,
+    solver_params={'method': 'brute'})
+hand_overs = comm.gather(len(hand_overs), root=0)
+if comm.Get_rank() == 0:
+    print(json.dumps({'modularity': modularity, 'solution': solution.tolist(),
+                      'hand_overs': hand_overs}))
+'''
+
+
+def test_distributed_qaoa(small_graph, fake_qaoa):
+    # subproblems are solved with qaoa on every rank, where the CLI never imported it
+    MPI = pytest.importorskip('mpi4py.MPI')
+    modularity, solution, it, _, _ = distributed.distributed_optimize_modularity(
+        small_graph,
+        MPI.COMM_WORLD.Split(MPI.COMM_WORLD.Get_rank()),
+        random_seed=1,
+        size_of_iteration=6,
+        solver_params={
+            'method': 'qaoa',
+            'backend_params': {
+                'backend_device': None,
+                'depth': 1
+            }
+        })
+    B = ModularityOperator.from_graph(small_graph,
+                                      nodelist=sorted(small_graph.nodes()))
+    assert it > 0
+    assert np.isclose(B.quadratic_form(solution), modularity)
+    assert modularity > 0
+
+
+def test_regions(small_graph):
+    B = ModularityOperator.from_graph(small_graph,
+                                      nodelist=sorted(small_graph.nodes()))
+    ordering = np.random.RandomState(0).permutation(B.shape[0])
+    spins = np.where(np.arange(B.shape[0]) % 2 == 0, 1, -1).astype(np.int8)
+    chunks = distributed.decompose(ordering, 3)
+    other_chunks = distributed.decompose(ordering, 3, shifted=True)
+    regions = distributed._regions(B.A, chunks, other_chunks, spins)
+    other_regions = distributed._regions(B.A, other_chunks, chunks, spins)
+    for r, region in enumerate(regions):
+        vertices = region['vertices']
+        n_owned = region['n_owned']
+        assert vertices[:n_owned].tolist() == chunks[r].tolist()
+        # rows of the region, renumbered locally
+        A = region['A'].toarray()
+        assert np.array_equal(A, B.A[vertices[:n_owned]][:,
+                                                         vertices].toarray())
+        assert np.array_equal(region['spins'], spins[vertices])
+        # both sides of every exchange agree on the vertices and their order
+        for q, local in region['recv'].items():
+            sent = regions[q]['vertices'][regions[q]['send'][r]]
+            assert vertices[local].tolist() == sent.tolist()
+        for q, local in region['handoff'].items():
+            other = other_regions[q]
+            received = other['vertices'][other['handoff'][r]]
+            assert vertices[local].tolist() == received.tolist()
+    # every halo vertex is received from its owner
+    for region in regions:
+        halo = region['vertices'][region['n_owned']:]
+        received = np.concatenate(
+            [region['vertices'][local] for local in region['recv'].values()])
+        assert sorted(received.tolist()) == sorted(halo.tolist())
+
+
+@pytest.mark.mpi
+@pytest.mark.skipif(shutil.which('mpirun') is None, reason='needs mpirun')
+@pytest.mark.parametrize('n_ranks', [2, 4])
+@pytest.mark.parametrize('seed', [1, 2])
+def test_ranks(n_ranks, seed):
+    # the partition found by several ranks (halo exchange, hand over to the shifted split, gather) is the one found by a serial run
+    pytest.importorskip('mpi4py.MPI')
+    env = dict(os.environ,
+               OMPI_ALLOW_RUN_AS_ROOT='1',
+               OMPI_ALLOW_RUN_AS_ROOT_CONFIRM='1',
+               OMPI_MCA_rmaps_base_oversubscribe='1')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [x for x in [env.get('PYTHONPATH')] if x])
+    out = subprocess.run([
+        'mpirun', '-n',
+        str(n_ranks), sys.executable, '-c', RANKS_SCRIPT,
+        str(seed)
+    ],
+                         env=env,
+                         stdout=subprocess.PIPE,
+                         check=True,
+                         timeout=300).stdout.decode()
+    res = json.loads(out.strip().splitlines()[-1])
+    assert all(n > 0 for n in res['hand_overs'])
+    G = nx.convert_node_labels_to_integers(
+        nx.planted_partition_graph(2, 16, 0.6, 0.05, seed=seed))
+    B = ModularityOperator.from_graph(G, nodelist=sorted(G.nodes()))
+    solution = np.array(res['solution'])
+    assert np.isclose(B.quadratic_form(solution), res['modularity'])
+    modularity, serial_solution, _, _ = slr.single_level_optimize_modularity(
+        G, random_seed=seed, size_of_iteration=4)
+    assert np.isclose(res['modularity'], modularity)
+    assert abs(solution.dot(serial_solution)) == len(solution)
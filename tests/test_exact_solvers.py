@@ -0,0 +1,115 @@
+from itertools import product
+import networkx as nx
+import numpy as np
+import pytest
+import qcommunity.modularity.graphs as gm
+import qcommunity.modularity.bnb as bnb
+import qcommunity.modularity.persistency as pers
+import qcommunity.modularity.single_level_refinement as slr
+from qcommunity.modularity.solver_pool import SolverPool, SerialSolver
+
+
+def _problem(n_nodes, seed, linear):
+    """
+    Modularity matrix of a random graph, with a random linear term C (as of a subset of a larger graph) or none
+    """
+    G = nx.gnp_random_graph(n_nodes, 0.4, seed=seed)
+    B = nx.modularity_matrix(G, nodelist=range(n_nodes))
+    B = np.asarray(B, dtype=np.float64)
+    rng = np.random.RandomState(seed)
+    C = rng.randint(-4, 5, n_nodes).astype(
+        np.float64) if linear else np.zeros(n_nodes)
+    return B, C
+
+
+def _enumerate(B, C):
+    """
+    Values of all assignments, by itertools.product
+    """
+    n_nodes = len(C)
+    S = list(product([-1, 1], repeat=n_nodes))
+    values = np.array([gm.compute_modularity(n_nodes, B, s, C) for s in S])
+    return np.array(S), values
+
+
+PROBLEMS = [(n_nodes, seed, linear) for n_nodes in [5, 8, 12]
+            for seed in [0, 1] for linear in [False, True]]
+
+
+@pytest.mark.parametrize('block_size', [3, 12])
+@pytest.mark.parametrize('n_nodes,seed,linear', PROBLEMS)
+def test_gray_code(n_nodes, seed, linear, block_size, monkeypatch):
+    # a small block makes the Gray code walk (and the chunking by prefix) do the work
+    monkeypatch.setattr(gm, 'GRAY_CODE_BLOCK_SIZE', block_size)
+    B, C = _problem(n_nodes, seed, linear)
+    _, values = _enumerate(B, C)
+    for solver in [SerialSolver(), SolverPool(2)]:
+        with solver:
+            value, bitstring = gm.optimize_modularity(n_nodes,
+                                                      B,
+                                                      C,
+                                                      pool=solver)
+        assert np.isclose(value, values.max())
+        assert np.isclose(gm.compute_modularity(n_nodes, B, bitstring, C),
+                          value)
+
+
+@pytest.mark.parametrize('n_nodes,seed,linear', PROBLEMS)
+def test_bnb(n_nodes, seed, linear):
+    B, C = _problem(n_nodes, seed, linear)
+    _, values = _enumerate(B, C)
+    stats = {}
+    value, spins = bnb.optimize_modularity(n_nodes, B, C, stats=stats)
+    assert np.isclose(value, values.max())
+    assert np.isclose(gm.compute_modularity(n_nodes, B, spins, C), value)
+    assert stats['solver_nodes'] > 0
+    # starting from the worst assignment does not change the optimum
+    S, _ = _enumerate(B, C)
+    value, _ = bnb.optimize_modularity(n_nodes,
+                                       B,
+                                       C,
+                                       initial=S[np.argmin(values)])
+    assert np.isclose(value, values.max())
+
+
+@pytest.mark.parametrize('n_nodes,seed,linear', PROBLEMS)
+def test_persistency(n_nodes, seed, linear):
+    B, C = _problem(n_nodes, seed, linear)
+    S, values = _enumerate(B, C)
+    optimal = np.isclose(values, values.max())
+    # weak persistency: some optimal assignment agrees with all fixed spins
+    fixed, fixed_values = pers.persistent_spins(B, C)
+    agree = np.all(S[:, fixed] == fixed_values, axis=1)
+    assert np.any(optimal & agree)
+    # strong persistency: every optimal assignment does
+    fixed, fixed_values = pers.persistent_spins(B, C, strong=True)
+    assert np.all(S[optimal][:, fixed] == fixed_values)
+    # the reduced problem has the same optimum
+    for method in ['brute', 'bnb']:
+        spins = slr.reduce_and_solve_subproblem(B, C, -np.ones(n_nodes), True,
+                                                {
+                                                    'method': method,
+                                                    'pool': SerialSolver()
+                                                })
+        assert np.isclose(gm.compute_modularity(n_nodes, B, spins, C),
+                          values.max())
+
+
+def test_symmetry_and_ties():
+    # two disjoint triangles: without C the optimum is attained by s and -s (and the solvers may return either); C = e_0 breaks the tie
+    G = nx.disjoint_union(nx.complete_graph(3), nx.complete_graph(3))
+    B = np.asarray(nx.modularity_matrix(G, nodelist=range(6)))
+    for C in [np.zeros(6), np.eye(6)[0]]:
+        S, values = _enumerate(B, C)
+        optimal = S[np.isclose(values, values.max())]
+        with SerialSolver() as solver:
+            _, bitstring = gm.optimize_modularity(6, B, C, pool=solver)
+        _, spins = bnb.optimize_modularity(6, B, C)
+        for res in [gm.to_spins(bitstring), spins]:
+            assert any(np.array_equal(res, s) for s in optimal)
+        if C.any():
+            assert len(optimal) == 1
+            assert optimal[0][0] == 1
+        else:
+            assert len(optimal) == 2
+            assert np.array_equal(optimal[0], -optimal[1])
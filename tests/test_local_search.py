@@ -0,0 +1,48 @@
+import networkx as nx
+import numpy as np
+import pytest
+from qcommunity.modularity.local_search import fm_pass, fm_refine
+from qcommunity.modularity.modularity_operator import ModularityOperator
+
+
+def _operator(seed, weighted):
+    G = nx.convert_node_labels_to_integers(
+        nx.planted_partition_graph(2, 30, 0.3, 0.05, seed=seed))
+    rng = np.random.RandomState(seed)
+    if weighted:
+        for u, v in G.edges():
+            G[u][v]['weight'] = rng.rand() * 3
+    return ModularityOperator.from_graph(G,
+                                         nodelist=sorted(G.nodes()),
+                                         weight='weight')
+
+
+@pytest.mark.parametrize('max_stall', [None, 5])
+@pytest.mark.parametrize('weighted', [False, True])
+@pytest.mark.parametrize('seed', range(4))
+def test_fm_pass_never_worse(seed, weighted, max_stall):
+    B = _operator(seed, weighted)
+    rng = np.random.RandomState(seed)
+    for _ in range(5):
+        spins = rng.choice([-1, 1], B.shape[0]).astype(np.int8)
+        before = spins.copy()
+        improved, gain = fm_pass(B, spins, max_stall=max_stall)
+        assert np.array_equal(spins, before)
+        assert gain >= 0
+        assert np.isclose(B.quadratic_form(improved),
+                          B.quadratic_form(spins) + gain)
+        # a pass from the result does not lower it either
+        again, gain = fm_pass(B, improved, max_stall=max_stall)
+        assert gain >= 0
+        assert B.quadratic_form(again) >= B.quadratic_form(improved) - 1e-9
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_fm_refine_monotone(weighted):
+    B = _operator(0, weighted)
+    spins = np.random.RandomState(1).choice([-1, 1], B.shape[0])
+    improved, total, n_passes = fm_refine(B, spins, max_passes=20)
+    assert 1 <= n_passes <= 20
+    assert total > 0
+    assert np.isclose(B.quadratic_form(improved),
+                      B.quadratic_form(spins) + total)
@@ -0,0 +1,32 @@
+import networkx as nx
+import qcommunity.modularity.multiscale as multiscale
+from qcommunity.modularity.solver_pool import SolverPool
+
+
+def test_one_solver_pool(monkeypatch):
+    # the coarsest level and the refinement of every level share one pool, which is closed at the end
+    pools = []
+    init = SolverPool.__init__
+    close = SolverPool.close
+
+    def recording_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        pools.append(self)
+        self.closed = False
+
+    def recording_close(self):
+        close(self)
+        self.closed = True
+
+    monkeypatch.setattr(SolverPool, '__init__', recording_init)
+    monkeypatch.setattr(SolverPool, 'close', recording_close)
+    G = nx.convert_node_labels_to_integers(
+        nx.planted_partition_graph(2, 40, 0.3, 0.02, seed=1))
+    modularity, solution = multiscale.cluster(G,
+                                              coarsest_size=20,
+                                              random_seed=1,
+                                              size_of_iteration=8)
+    assert len(pools) == 1
+    assert pools[0].closed
+    assert modularity > 0
+    assert len(solution) == G.number_of_nodes()
@@ -0,0 +1,22 @@
+import numpy as np
+import qcommunity.modularity.single_level_refinement as slr
+from qcommunity.modularity.modularity_operator import ModularityOperator
+
+
+def test_pipeline_qaoa(small_graph, fake_qaoa):
+    # the qaoa solver runs in the pipeline's worker processes, where the CLI never imported it
+    modularity, solution, it, _ = slr.single_level_optimize_modularity(
+        small_graph,
+        random_seed=1,
+        size_of_iteration=6,
+        method='qaoa',
+        backend_params={
+            'backend_device': None,
+            'depth': 1
+        },
+        pipeline=2)
+    B = ModularityOperator.from_graph(small_graph,
+                                      nodelist=sorted(small_graph.nodes()))
+    assert it > 0
+    assert np.isclose(B.quadratic_form(solution), modularity)
+    assert modularity > 0
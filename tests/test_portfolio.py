@@ -0,0 +1,24 @@
+import numpy as np
+from qcommunity.modularity.portfolio import portfolio_optimize_modularity
+from qcommunity.modularity.modularity_operator import ModularityOperator
+
+
+def test_portfolio_qaoa(small_graph, fake_qaoa):
+    # every instance solves its subproblems with qaoa inside a pool worker
+    best_modularity, best_solution, results = portfolio_optimize_modularity(
+        small_graph,
+        n_instances=2,
+        random_seed=1,
+        processes=2,
+        size_of_iteration=6,
+        method='qaoa',
+        backend_params={
+            'backend_device': None,
+            'depth': 1
+        })
+    B = ModularityOperator.from_graph(small_graph,
+                                      nodelist=sorted(small_graph.nodes()))
+    assert len(results) == 2
+    assert np.isclose(B.quadratic_form(best_solution), best_modularity)
+    assert best_modularity == max(res['best_modularity'] for res in results)
+    assert best_modularity > 0
@@ -0,0 +1,27 @@
+import networkx as nx
+import numpy as np
+import pytest
+from qcommunity.modularity.modularity_operator import ModularityOperator
+from qcommunity.modularity.recursive_bisection import recursive_bisection, labels_modularity
+
+
+@pytest.mark.parametrize('n_communities', [None, 2, 4])
+def test_planted_partition(n_communities):
+    # dense planted communities with few edges between them
+    n_planted = 2 if n_communities is None else n_communities
+    G = nx.convert_node_labels_to_integers(
+        nx.planted_partition_graph(n_planted, 10, 0.9, 0.02, seed=1))
+    planted = np.repeat(np.arange(n_planted), 10)
+    modularity, labels, _ = recursive_bisection(G,
+                                                n_communities=n_communities,
+                                                random_seed=1,
+                                                processes=2,
+                                                size_of_iteration=6)
+    # a label for every node, numbered from 0
+    assert len(labels) == G.number_of_nodes()
+    assert sorted(set(labels)) == list(range(n_planted))
+    # the planted partition, up to the numbering of the communities
+    pairs = set(zip(labels, planted.tolist()))
+    assert len(pairs) == n_planted
+    B = ModularityOperator.from_graph(G, nodelist=sorted(G.nodes()))
+    assert np.isclose(modularity, labels_modularity(B, labels))
@@ -0,0 +1,62 @@
+import numpy as np
+import qcommunity.modularity.single_level_refinement as slr
+from qcommunity.modularity.modularity_operator import ModularityOperator
+from qcommunity.modularity.partition import PartitionState
+from qcommunity.modularity.gain_heap import GainHeap
+
+
+def _state(G):
+    B = ModularityOperator.from_graph(G, nodelist=sorted(G.nodes()))
+    spins = np.where(np.arange(B.shape[0]) % 2 == 0, 1, -1)
+    return PartitionState(B, spins)
+
+
+def test_largest_gains_order(small_graph):
+    gains = _state(small_graph).gains
+    res = slr.largest_gains(gains, 5, excluded={0, 1})
+    expected = [
+        v for v in sorted(range(len(gains)), key=lambda v: (-gains[v], v))
+        if v not in {0, 1}
+    ][:5]
+    assert res.tolist() == expected
+
+
+def test_unmask_largest_distinct(small_graph):
+    state = _state(small_graph)
+    heap = GainHeap(state)
+    v = heap.largest(1)[0]
+    heap.mask(v)
+    heap.unmask(v)
+    assert sorted(heap.largest(state.B.shape[0])) == list(
+        range(state.B.shape[0]))
+
+
+def test_heap_follows_moves(small_graph):
+    state = _state(small_graph)
+    heap = GainHeap(state)
+    heap.mask(3)
+    rng = np.random.RandomState(0)
+    for _ in range(10):
+        changed = rng.choice(state.B.shape[0], 3, replace=False)
+        state.apply(changed, -state.spins[changed])
+        heap.update(changed, state)
+        expected = [
+            v for v in sorted(range(state.B.shape[0]),
+                              key=lambda v: (-state.gains[v], v)) if v != 3
+        ]
+        assert heap.largest(5) == expected[:5]
+        assert heap.largest(5, skip={expected[0]}) == expected[1:6]
+    assert heap.largest(state.B.shape[0]) == expected
+
+
+def test_released_root_selected_once(small_graph):
+    # a root released by the pipeline can be picked again, and only once
+    state = _state(small_graph)
+    heap = GainHeap(state)
+    visited = set()
+    _, root = slr.select_subset(small_graph, heap, visited, 'spectral', 6)
+    assert visited == {root}
+    visited.discard(root)
+    heap.unmask(root)
+    _, again = slr.select_subset(small_graph, heap, visited, 'spectral', 6)
+    assert again == root
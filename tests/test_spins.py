@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+import qcommunity.modularity.graphs as gm
+
+
+def test_spins_returned_as_is():
+    spins = np.array([1, -1, -1, 1], dtype=np.int8)
+    assert gm.to_spins(spins, 4) is spins
+    with pytest.raises(ValueError):
+        gm.to_spins(spins, 5)
+
+
+@pytest.mark.parametrize('bitstring', [[0, 1, 1, 0], [-1, 1, 1, -1],
+                                       np.array([0., 1., 1., 0.])])
+def test_bitstrings_converted(bitstring):
+    spins = gm.to_spins(bitstring, 4)
+    assert spins.dtype == np.int8
+    assert spins.tolist() == [-1, 1, 1, -1]
+
+
+@pytest.mark.parametrize(
+    'bitstring',
+    [[0, 2, 1, 0], [0, -1, 1, 0], [0.5, 1, 1, 0], ['0', '1', '1', '0']])
+def test_invalid_bitstrings(bitstring):
+    with pytest.raises(ValueError):
+        gm.to_spins(bitstring, 4)
@@ -0,0 +1,19 @@
+import pytest
+import qcommunity.modularity.single_level_refinement as slr
+
+
+@pytest.mark.parametrize('params', [{}, {
+    'parallel_subproblems': 2
+}, {
+    'pipeline': 2
+}])
+def test_gain_updates_timed(small_graph, params):
+    # the gain updates are reported in t_gains, not in t_evaluation
+    *_, telemetry = slr.single_level_optimize_modularity(small_graph,
+                                                         random_seed=1,
+                                                         size_of_iteration=6,
+                                                         return_telemetry=True,
+                                                         **params)
+    assert telemetry['accepted'].any()
+    assert (telemetry['t_gains'][telemetry['accepted']] > 0).all()
+    assert (telemetry['t_evaluation'] >= 0).all()